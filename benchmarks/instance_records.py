@@ -0,0 +1,106 @@
+"""
+Compare the cost of reading a large instance inventory as pydantic models
+(ec2.get_instances) and as compact records (ec2.get_instance_records).
+
+    python benchmarks/instance_records.py --instances 10000
+
+The describe_instances responses are built in memory, so no AWS account is needed.
+"""
+import os
+import sys
+import timeit
+import argparse
+import tracemalloc
+from datetime import datetime, timedelta
+
+from dateutil.tz import tzutc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cjob import ec2  # noqa: E402
+
+# Instances per describe_instances page, the most EC2 returns.
+PAGE_SIZE = 1000
+
+
+class FakePaginator:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return iter(self.pages)
+
+
+class FakeClient:
+    """
+    Just enough of an EC2 client to list instances.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get_paginator(self, name):
+        assert name == "describe_instances"
+        return FakePaginator(self.pages)
+
+
+def build_pages(count: int):
+    launched_at = datetime(2021, 1, 1, tzinfo=tzutc())
+    aws_instances = [
+        {
+            "InstanceId": f"i-{i:017x}",
+            "InstanceType": "r5.2xlarge",
+            "LaunchTime": launched_at + timedelta(seconds=i),
+            "State": {"Code": 16, "Name": "running"},
+            "PrivateIpAddress": f"10.0.{i // 256 % 256}.{i % 256}",
+            "NetworkInterfaces": [
+                {"Association": {"PublicIp": f"54.0.{i // 256 % 256}.{i % 256}"}}
+            ],
+            "Tags": [
+                {"Key": "Name", "Value": ec2.add_job_prefix(f"sweep-{i}")},
+                {"Key": ec2.CLUSTER_TAG, "Value": ec2.add_job_prefix("sweep")},
+                {"Key": ec2.RANK_TAG, "Value": str(i)},
+            ],
+        }
+        for i in range(count)
+    ]
+    return [
+        {"Reservations": [{"Instances": aws_instances[i : i + PAGE_SIZE]}]}
+        for i in range(0, count, PAGE_SIZE)
+    ]
+
+
+def measure(name: str, func, repeat: int):
+    seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+    tracemalloc.start()
+    result = func()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert result
+    print(f"{name:<24} {seconds * 1000:>10.1f} ms {size / 1024 ** 2:>10.2f} MiB")
+    return seconds, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--instances", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    client = FakeClient(build_pages(args.instances))
+    print(f"Reading {args.instances} instances, best of {args.repeat} runs")
+    print(f"{'':<24} {'time':>13} {'memory':>14}")
+    model_seconds, model_size = measure(
+        "get_instances", lambda: ec2.get_instances(client), args.repeat
+    )
+    record_seconds, record_size = measure(
+        "get_instance_records", lambda: ec2.get_instance_records(client), args.repeat
+    )
+    print(
+        f"Records are {model_seconds / record_seconds:.1f}x faster"
+        f" and {model_size / record_size:.1f}x smaller"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+"""
+Awaitable versions of the EC2 instance lifecycle and S3 transfer functions, for asyncio programs.
+Needs the "aio" extra, which installs aiobotocore: pip install "cjob[aio]"
+
+Clients are async context managers. Like the blocking clients, they share one token bucket
+per API family (see the throttle module), so many tasks can make calls at once:
+
+    async with aio.get_ec2_client() as client:
+        launch_kwargs = await aio.prepare_launch()
+        instance_ids = await asyncio.gather(
+            *[aio.create_job(client, f"cjob-sweep-{i}", launch_kwargs) for i in range(100)]
+        )
+        instances = await aio.wait_for_instances(client, instance_ids)
+
+Setting up launches (security group, key pair, AMI) happens once per program, so
+prepare_launch runs the blocking ec2 functions in a thread. Everything else is async,
+apart from reading and writing files, which runs in a thread pool of its own.
+"""
+import os
+import glob
+import asyncio
+import logging
+import subprocess
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:
+    raise ImportError('cjob.aio needs aiobotocore, install it with: pip install "cjob[aio]"')
+
+from . import ec2, s3, ssh, throttle
+from .config import get_settings
+from .client import get_ec2_client as get_blocking_ec2_client
+from .s3 import S3_UPLOAD_EXTRA_ARGS
+from .throttle import MAX_ATTEMPTS, backoff_delays, is_throttling_error, is_transient_error
+
+logger = logging.getLogger(__name__)
+
+# Connections kept open by each client, so that hundreds of calls can be in flight at once.
+MAX_POOL_CONNECTIONS = 200
+CLIENT_CONFIG = AioConfig(retries={"mode": "standard"}, max_pool_connections=MAX_POOL_CONNECTIONS)
+
+# Parts of one file to upload at once.
+MULTIPART_CONCURRENCY = 4
+DOWNLOAD_CHUNK_SIZE = 1024 ** 2
+# Downloaded chunks are buffered and written to disk in batches of this size.
+DOWNLOAD_WRITE_SIZE = 8 * 1024 ** 2
+# Files of a folder to transfer at once.
+DEFAULT_MAX_CONCURRENCY = 100
+# Threads for reading and writing files. These are kept apart from the default executor,
+# which is sized for the CPU count, so that transfers don't queue behind each other there.
+FILE_IO_MAX_WORKERS = 32
+
+_file_io_executor = ThreadPoolExecutor(
+    max_workers=FILE_IO_MAX_WORKERS, thread_name_prefix="cjob-file-io"
+)
+
+
+def with_backoff(func, max_attempts: int = MAX_ATTEMPTS, should_retry=is_throttling_error):
+    """
+    Wraps a coroutine function so that it is retried with backoff when should_retry(error) is true.
+    """
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        delays = backoff_delays()
+        attempt = 1
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= max_attempts or not should_retry(e):
+                    raise
+
+                delay = next(delays)
+                logger.info(
+                    "Call to %s failed (%s), retrying in %.1fs (attempt %s of %s).",
+                    func.__name__,
+                    e,
+                    delay,
+                    attempt + 1,
+                    max_attempts,
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    return wrapper
+
+
+class ThrottledClient(throttle.ThrottledClient):
+    """
+    Wraps an aiobotocore client so that its API calls are retried with backoff when throttled.
+    """
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name in self._operations:
+            return with_backoff(attr)
+
+        return attr
+
+
+def wrap_client(client, family: str) -> ThrottledClient:
+    """
+    Attach the shared rate limiter for an API family to an aiobotocore client.
+    """
+    throttle.register_limiter(client, family, is_async=True)
+    return ThrottledClient(client)
+
+
+@asynccontextmanager
+async def get_ec2_client(**kwargs):
+    """
+    Create an async EC2 client. Keyword arguments are passed on to create_client.
+    """
+    async with _create_client("ec2", **kwargs) as client:
+        yield wrap_client(client, "ec2")
+
+
+@asynccontextmanager
+async def get_s3_client(**kwargs):
+    """
+    Create an async S3 client. Keyword arguments are passed on to create_client.
+    """
+    async with _create_client("s3", **kwargs) as client:
+        yield wrap_client(client, "s3")
+
+
+def _create_client(service: str, **kwargs):
+    settings = get_settings()
+    session = get_session()
+    if settings.AWS_PROFILE:
+        session.set_config_variable("profile", settings.AWS_PROFILE)
+    else:
+        kwargs.setdefault("aws_access_key_id", settings.AWS_ACCESS_KEY_ID)
+        kwargs.setdefault("aws_secret_access_key", settings.AWS_SECRET_ACCESS_KEY)
+
+    kwargs.setdefault("region_name", settings.AWS_REGION)
+    kwargs.setdefault("config", CLIENT_CONFIG)
+    return session.create_client(service, **kwargs)
+
+
+async def prepare_launch(
+    client=None, ami_id: Optional[str] = None, datasets: List[str] = ()
+) -> dict:
+    """
+    Set up the security group, key pair and AMI needed to launch instances, using a
+    blocking EC2 client in a thread. The result can be shared by any number of create_job calls
+    with the same datasets (see ec2.get_launch_kwargs).
+    """
+    client = client or get_blocking_ec2_client()
+    return await _run_blocking(ec2.get_launch_kwargs, client, ami_id, datasets)
+
+
+async def create_job(
+    client,
+    job_id: str,
+    launch_kwargs: dict,
+    user_data: Optional[str] = None,
+    datasets: List[str] = (),
+) -> str:
+    """
+    Launch an EC2 instance for a job, returning the instance ID (see ec2.create_job).
+    """
+    logger.info("Creating EC2 instance for job %s...", job_id)
+    kwargs = ec2.build_run_kwargs(launch_kwargs, job_id, 1, user_data, datasets)
+    response = await client.run_instances(**kwargs)
+    return response["Instances"][0]["InstanceId"]
+
+
+async def stop_job(client, job_id: str):
+    """
+    Terminate the instances running a job, or every node of a cluster.
+    """
+    records = [r for r in await get_instance_records(client) if job_id in (r.name, r.cluster)]
+    instance_ids = [r.id for r in records]
+    logger.info("Stopping EC2 instances %s running job %s", instance_ids, job_id)
+    if instance_ids:
+        await client.terminate_instances(InstanceIds=instance_ids)
+
+    # Don't leave multiplexed SSH connections to a dead host lying around.
+    await asyncio.gather(*[_run_blocking(ssh.close_connection, r) for r in records])
+
+
+async def get_instances(client) -> List["ec2.EC2Instance"]:
+    return [record.to_model() for record in await get_instance_records(client)]
+
+
+async def get_instance_records(client) -> List["ec2.InstanceRecord"]:
+    """
+    Returns every cjob instance which hasn't been terminated, as compact records.
+    """
+    return await _describe_instance_records(client, Filters=ec2.INSTANCE_FILTERS)
+
+
+async def wait_for_instances(client, instance_ids: List[str]) -> List["ec2.EC2Instance"]:
+    """
+    Wait for some instances to be running, then return them in the same order.
+    """
+    logger.info("Waiting for EC2 instances %s to start...", instance_ids)
+    waiter = client.get_waiter("instance_running")
+    await waiter.wait(InstanceIds=instance_ids)
+    records = await _describe_instance_records(client, InstanceIds=instance_ids)
+    records = {r.id: r for r in records}
+    return [records[instance_id].to_model() for instance_id in instance_ids]
+
+
+async def wait_for_ssh(
+    instance: "ec2.EC2Instance",
+    ssh_key_path: Optional[str] = None,
+    timeout: float = 300,
+    interval: float = 5,
+    **options,
+) -> bool:
+    """
+    Wait until an instance accepts SSH connections.
+    Returns whether it became reachable before the timeout.
+    """
+    ssh_key_path = ssh_key_path or get_settings().EC2_KEY_FILE_PATH
+    args = ssh.build_ssh_args(instance.ip, ssh_key_path, ConnectTimeout=int(interval), **options)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            "true",
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            if await asyncio.wait_for(proc.wait(), interval * 2) == 0:
+                return True
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+        await asyncio.sleep(interval)
+
+    return False
+
+
+async def list_s3_keys(client, key_prefix: str, key_suffix: str) -> List[str]:
+    """Returns the item keys in a path in AWS S3"""
+    settings = get_settings()
+    paginator = client.get_paginator("list_objects_v2")
+    keys = []
+    async for page in paginator.paginate(Bucket=settings.S3_BUCKET_NAME, Prefix=key_prefix):
+        keys += [o["Key"] for o in page.get("Contents", []) if o["Key"].endswith(key_suffix)]
+
+    return keys
+
+
+async def upload_s3(client, src_path: str, dest_key: str, extra_args=S3_UPLOAD_EXTRA_ARGS):
+    """Upload a file or folder to AWS S3"""
+    if os.path.isfile(src_path):
+        await upload_file_s3(client, src_path, dest_key, extra_args)
+    elif os.path.isdir(src_path):
+        await upload_folder_s3(client, src_path, dest_key, extra_args)
+    else:
+        raise ValueError(f"Path is not a file or folder: {src_path}")
+
+
+async def upload_folder_s3(
+    client,
+    folder_path: str,
+    dest_folder_key: str,
+    extra_args=S3_UPLOAD_EXTRA_ARGS,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+):
+    """Upload a folder to S3, several files at a time"""
+    nodes = glob.glob(os.path.join(folder_path, "**", "*"), recursive=True)
+    files = [f for f in nodes if os.path.isfile(f)]
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def upload(src_path: str):
+        dest_key = os.path.join(dest_folder_key, os.path.relpath(src_path, folder_path))
+        async with semaphore:
+            await upload_file_s3(client, src_path, dest_key, extra_args)
+
+    await asyncio.gather(*[upload(f) for f in files])
+
+
+async def upload_file_s3(client, src_path: str, dest_key: str, extra_args=S3_UPLOAD_EXTRA_ARGS):
+    """Upload a file to S3, in parts if it's large"""
+    settings = get_settings()
+    logger.info("Uploading from %s to %s", src_path, dest_key)
+    size = os.path.getsize(src_path)
+    if size <= s3.MULTIPART_THRESHOLD:
+        body = await _run_file_io(_read_file, src_path)
+        await client.put_object(
+            Bucket=settings.S3_BUCKET_NAME, Key=dest_key, Body=body, **extra_args
+        )
+    else:
+        await _upload_multipart(client, src_path, dest_key, size, extra_args)
+
+
+async def download_s3(client, src_key: str, dest_path: str, retries: int = 5):
+    """Downloads a file from AWS S3"""
+    download = with_backoff(_download_s3, max_attempts=retries, should_retry=is_transient_error)
+    try:
+        await download(client, src_key, dest_path)
+    except Exception:
+        logger.error(f"Download to {dest_path} failed.")
+        raise
+
+
+async def delete_s3_keys(client, key_prefix: str):
+    """Delete every item in a path in AWS S3"""
+    settings = get_settings()
+    keys = await list_s3_keys(client, key_prefix, "")
+    await asyncio.gather(
+        *[
+            client.delete_objects(
+                Bucket=settings.S3_BUCKET_NAME,
+                Delete={"Objects": [{"Key": k} for k in keys[i : i + 1000]]},
+            )
+            for i in range(0, len(keys), 1000)
+        ]
+    )
+
+
+async def _describe_instance_records(client, **kwargs) -> List["ec2.InstanceRecord"]:
+    paginator = client.get_paginator("describe_instances")
+    records = []
+    async for page in paginator.paginate(**kwargs):
+        for reservation in page["Reservations"]:
+            for aws_instance in reservation["Instances"]:
+                record = ec2.read_instance_record(aws_instance)
+                if record:
+                    records.append(record)
+
+    return records
+
+
+async def _upload_multipart(client, src_path: str, dest_key: str, size: int, extra_args):
+    settings = get_settings()
+    bucket = settings.S3_BUCKET_NAME
+    response = await client.create_multipart_upload(Bucket=bucket, Key=dest_key, **extra_args)
+    upload_id = response["UploadId"]
+    semaphore = asyncio.Semaphore(MULTIPART_CONCURRENCY)
+    part_size = s3.get_part_size(size)
+
+    async def upload_part(part_number: int, offset: int) -> dict:
+        async with semaphore:
+            body = await _run_file_io(_read_file, src_path, offset, part_size)
+            response = await client.upload_part(
+                Bucket=bucket, Key=dest_key, UploadId=upload_id, PartNumber=part_number, Body=body
+            )
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    offsets = range(0, size, part_size)
+    tasks = [asyncio.ensure_future(upload_part(i + 1, o)) for i, o in enumerate(offsets)]
+    try:
+        parts = await asyncio.gather(*tasks)
+        await client.complete_multipart_upload(
+            Bucket=bucket, Key=dest_key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+        )
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await client.abort_multipart_upload(Bucket=bucket, Key=dest_key, UploadId=upload_id)
+        raise
+
+
+async def _download_s3(client, src_key: str, dest_path: str):
+    settings = get_settings()
+    logger.info("Downloading from %s to %s", src_key, dest_path)
+    response = await client.get_object(Bucket=settings.S3_BUCKET_NAME, Key=src_key)
+    stream = response["Body"]
+    try:
+        f = await _run_file_io(open, dest_path, "wb")
+        try:
+            batch = []
+            batch_size = 0
+            while True:
+                chunk = await stream.read(DOWNLOAD_CHUNK_SIZE)
+                if chunk:
+                    batch.append(chunk)
+                    batch_size += len(chunk)
+
+                if batch and (not chunk or batch_size >= DOWNLOAD_WRITE_SIZE):
+                    await _run_file_io(f.write, b"".join(batch))
+                    batch = []
+                    batch_size = 0
+
+                if not chunk:
+                    break
+        finally:
+            await _run_file_io(f.close)
+    finally:
+        stream.close()
+
+
+def _read_file(path: str, offset: int = 0, size: int = -1) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+async def _run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def _run_file_io(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_file_io_executor, func, *args)
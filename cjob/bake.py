@@ -0,0 +1,139 @@
+"""
+Bake job AMIs, so that instance setup runs once per version of the setup script,
+rather than once per job.
+
+A builder instance is launched from the base AMI with the setup script as its user data.
+Once the script has finished, an AMI is created from the instance and tagged with a hash
+of the setup script and the base AMI. create_job picks up that AMI automatically.
+"""
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+from dateutil import parser
+
+from . import ec2, ssh
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the setup script to finish on the builder instance.
+SETUP_TIMEOUT = 60 * 60
+# Number of old baked AMIs of each setup script version kept by garbage collection,
+# in case a rollback is needed.
+DEFAULT_KEEP_AMIS = 2
+# Lines of the setup log to show when setup fails.
+FAILURE_LOG_LINES = 50
+
+
+def bake(client, setup_path: str, force: bool = False) -> str:
+    """
+    Build an AMI by running a setup script on the base AMI, returning the AMI ID.
+    An existing AMI for the same setup script and base AMI is reused unless force is set.
+    """
+    base_ami_id = ec2.get_base_ami_id(client)
+    bake_hash = ec2.get_bake_hash(setup_path, base_ami_id)
+    ami_id = ec2.find_baked_ami(client, bake_hash)
+    if ami_id and not force:
+        logger.info("AMI %s is already baked from %s", ami_id, setup_path)
+        return ami_id
+
+    with open(setup_path, "r") as f:
+        setup_script = f.read()
+
+    if not setup_script.startswith("#!"):
+        # cloud-init only runs user data as a script if it has a shebang.
+        setup_script = "#!/bin/bash\n" + setup_script
+
+    job_id = ec2.add_job_prefix(f"bake-{bake_hash[:12]}")
+    instance_id = ec2.create_job(client, job_id, user_data=setup_script, ami_id=base_ami_id)
+    try:
+        instance = ec2.wait_for_instance(client, instance_id)
+        _wait_for_setup(instance)
+        ami_id = _create_image(client, instance_id, bake_hash, base_ami_id)
+    finally:
+        ec2.stop_job(client, job_id)
+
+    return ami_id
+
+
+def get_baked_amis(client) -> List[dict]:
+    """
+    Returns every AMI built by "cjob bake", newest first.
+    """
+    response = client.describe_images(
+        Owners=["self"], Filters=[{"Name": "tag-key", "Values": [ec2.BAKE_HASH_TAG]}]
+    )
+    images = response["Images"]
+    return sorted(images, key=lambda i: parser.parse(i["CreationDate"]), reverse=True)
+
+
+def collect_garbage(
+    client, keep: int = DEFAULT_KEEP_AMIS, keep_ami_id: Optional[str] = None
+) -> List[str]:
+    """
+    Deregister all but the newest few baked AMIs with each bake hash, and delete their snapshots.
+    The AMI for the current EC2_SETUP_SCRIPT, or keep_ami_id, is always kept.
+    Returns the IDs of the deregistered AMIs.
+    """
+    settings = get_settings()
+    keep_ami_ids = {keep_ami_id} if keep_ami_id else set()
+    if settings.EC2_SETUP_SCRIPT:
+        bake_hash = ec2.get_bake_hash(settings.EC2_SETUP_SCRIPT, ec2.get_base_ami_id(client))
+        keep_ami_ids.add(ec2.find_baked_ami(client, bake_hash))
+
+    images_by_hash = {}
+    for image in get_baked_amis(client):
+        if image["ImageId"] not in keep_ami_ids:
+            tags = {tag["Key"]: tag["Value"] for tag in image.get("Tags", [])}
+            images_by_hash.setdefault(tags.get(ec2.BAKE_HASH_TAG), []).append(image)
+
+    old_images = [i for images in images_by_hash.values() for i in images[keep:]]
+    deregistered = []
+    for image in old_images:
+        ami_id = image["ImageId"]
+        logger.info("Deregistering old baked AMI %s", ami_id)
+        client.deregister_image(ImageId=ami_id)
+        for mapping in image.get("BlockDeviceMappings", []):
+            snapshot_id = mapping.get("Ebs", {}).get("SnapshotId")
+            if snapshot_id:
+                logger.info("Deleting snapshot %s of AMI %s", snapshot_id, ami_id)
+                client.delete_snapshot(SnapshotId=snapshot_id)
+
+        deregistered.append(ami_id)
+
+    return deregistered
+
+
+def _wait_for_setup(instance: "ec2.EC2Instance"):
+    if not ssh.wait_for_ssh(instance):
+        raise TimeoutError(f"Could not SSH into builder instance {instance.id}")
+
+    logger.info("Waiting for setup script to finish on %s...", instance.id)
+    if not ssh.wait_for_user_data(instance, timeout=SETUP_TIMEOUT):
+        ssh.run(instance, f"tail -n {FAILURE_LOG_LINES} /var/log/cloud-init-output.log")
+        raise RuntimeError(f"Setup script failed on builder instance {instance.id}")
+
+
+def _create_image(client, instance_id: str, bake_hash: str, base_ami_id: str) -> str:
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    logger.info("Creating AMI from instance %s...", instance_id)
+    response = client.create_image(
+        InstanceId=instance_id,
+        Name=f"cjob-{bake_hash[:12]}-{timestamp}",
+        Description=f"Baked by cjob from {base_ami_id}",
+        TagSpecifications=[
+            {
+                "ResourceType": "image",
+                "Tags": [
+                    {"Key": ec2.BAKE_HASH_TAG, "Value": bake_hash},
+                    {"Key": ec2.BASE_AMI_TAG, "Value": base_ami_id},
+                ],
+            }
+        ],
+    )
+    ami_id = response["ImageId"]
+    waiter = client.get_waiter("image_available")
+    waiter.wait(ImageIds=[ami_id], WaiterConfig={"Delay": 15, "MaxAttempts": 120})
+    logger.info("Baked AMI %s", ami_id)
+    return ami_id
@@ -0,0 +1,152 @@
+"""
+Content-addressed code bundles, so a project is only uploaded once per version.
+
+A bundle is a deterministic tar.gz of a project folder, respecting .gitignore,
+stored in S3_BUCKET_NAME as bundles/<sha256>.tar.gz. Building the same files twice
+gives the same bytes, so the upload is skipped when that object already exists.
+Instances keep fetched bundles in BUNDLE_CACHE_DIR, so reused instances don't download
+the same bundle twice.
+"""
+import os
+import gzip
+import tarfile
+import logging
+import tempfile
+import subprocess
+from typing import List
+
+from botocore.exceptions import ClientError
+
+from . import s3
+from .cache import hash_path
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+BUNDLES_KEY_PREFIX = "bundles"
+BUNDLE_CACHE_DIR = "/var/cache/cjob/bundles"
+
+# Bundles are private, unlike the s3 module's default uploads.
+BUNDLE_UPLOAD_EXTRA_ARGS = {}
+
+FETCH_TEMPLATE = """
+BUNDLE_PATH={cache_dir}/{bundle_hash}.tar.gz
+if [ ! -f "$BUNDLE_PATH" ]; then
+    mkdir -p {cache_dir}
+    aws s3 cp --quiet s3://{bucket}/{bundle_key} "$BUNDLE_PATH.tmp"
+    mv "$BUNDLE_PATH.tmp" "$BUNDLE_PATH"
+fi
+mkdir -p "{dest_path}"
+tar -xzf "$BUNDLE_PATH" -C "{dest_path}"
+"""
+
+
+def get_bundle_key(bundle_hash: str) -> str:
+    return f"{BUNDLES_KEY_PREFIX}/{bundle_hash}.tar.gz"
+
+
+def list_bundle_files(folder: str) -> List[str]:
+    """
+    List the files in a project folder, relative to it, leaving out anything git ignores.
+    Folders which aren't in a git repo include everything except .git.
+    """
+    try:
+        output = subprocess.check_output(
+            ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"],
+            cwd=folder,
+            stderr=subprocess.DEVNULL,
+        )
+        paths = [p for p in output.decode().split("\0") if p]
+    except (OSError, subprocess.CalledProcessError):
+        paths = []
+        for root, dirs, filenames in os.walk(folder):
+            dirs[:] = [d for d in dirs if d != ".git"]
+            for filename in filenames:
+                paths.append(os.path.relpath(os.path.join(root, filename), folder))
+
+    # Deleted files are still listed by git until the deletion is staged,
+    # and submodules are listed as folders.
+    return sorted(
+        p
+        for p in set(paths)
+        if os.path.islink(os.path.join(folder, p)) or os.path.isfile(os.path.join(folder, p))
+    )
+
+
+def build_bundle(folder: str, dest_path: str) -> str:
+    """
+    Write a deterministic tar.gz of a project folder, returning its SHA-256 hash.
+    File order, timestamps and owners are normalised, so that the archive only changes
+    when the files' names, contents or executable bits change.
+    """
+    with open(dest_path, "wb") as f:
+        # Leave the file name and timestamp out of the gzip header.
+        with gzip.GzipFile(filename="", mode="wb", fileobj=f, mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode="w", format=tarfile.PAX_FORMAT) as tar:
+                for path in list_bundle_files(folder):
+                    _add_file(tar, os.path.join(folder, path), path)
+
+    return hash_path(dest_path)
+
+
+def upload_bundle(s3_client, folder: str) -> str:
+    """
+    Bundle a project folder and upload it, unless an identical bundle is already in S3.
+    Returns the bundle's hash.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bundle_path = os.path.join(tmp_dir, "bundle.tar.gz")
+        bundle_hash = build_bundle(folder, bundle_path)
+        key = get_bundle_key(bundle_hash)
+        if bundle_exists(s3_client, bundle_hash):
+            logger.info("Bundle %s is already uploaded.", bundle_hash[:12])
+        else:
+            size_mb = os.path.getsize(bundle_path) / 1e6
+            logger.info("Uploading bundle %s (%.1f MB)", bundle_hash[:12], size_mb)
+            s3.upload_file_s3(s3_client, bundle_path, key, BUNDLE_UPLOAD_EXTRA_ARGS)
+
+    return bundle_hash
+
+
+def bundle_exists(s3_client, bundle_hash: str) -> bool:
+    settings = get_settings()
+    try:
+        s3_client.head_object(Bucket=settings.S3_BUCKET_NAME, Key=get_bundle_key(bundle_hash))
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return False
+
+        raise
+
+    return True
+
+
+def build_fetch_script(bundle_hash: str, dest_path: str) -> str:
+    """
+    Build shell commands which fetch a bundle on an instance and extract it to dest_path.
+    The destination is double quoted, so it may use shell variables like $HOME.
+    The instance needs the AWS CLI and read access to S3_BUCKET_NAME.
+    """
+    settings = get_settings()
+    return FETCH_TEMPLATE.format(
+        cache_dir=BUNDLE_CACHE_DIR,
+        bundle_hash=bundle_hash,
+        bucket=settings.S3_BUCKET_NAME,
+        bundle_key=get_bundle_key(bundle_hash),
+        dest_path=dest_path,
+    )
+
+
+def _add_file(tar: tarfile.TarFile, path: str, arcname: str):
+    info = tar.gettarinfo(path, arcname)
+    info.mtime = 0
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    info.pax_headers = {}
+    if info.isfile():
+        info.mode = 0o755 if info.mode & 0o100 else 0o644
+        with open(path, "rb") as f:
+            tar.addfile(info, f)
+    else:
+        info.mode = 0o777
+        tar.addfile(info)
@@ -0,0 +1,166 @@
+"""
+Content-addressed job results, so identical jobs are only ever run once.
+
+A cache key is a hash of a job's code, input files and arguments.
+Results are stored in S3_BUCKET_NAME under cache/<key>/, with a "status" object
+written last to mark the entry as complete. Entries expire after CACHE_TTL_HOURS.
+"""
+import os
+import json
+import pickle
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional, Any
+
+from dateutil.tz import tzutc
+from botocore.exceptions import ClientError
+
+from .s3 import list_s3_keys
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY_PREFIX = "cache"
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def hash_path(path: str) -> str:
+    """
+    Hash a file's contents, or the names and contents of every file in a folder.
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, filenames in os.walk(path):
+            dirs.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(root, filename)
+                digest.update(os.path.relpath(file_path, path).encode())
+                digest.update(hash_path(file_path).encode())
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def compute_cache_key(
+    code_paths: List[str] = (), input_paths: List[str] = (), args: Any = None
+) -> str:
+    """
+    Build a cache key from a job's code, its input files and its arguments.
+    Arguments must be JSON serializable, or have a stable repr().
+    """
+    data = {
+        "code": [hash_path(p) for p in code_paths],
+        "inputs": [[os.path.basename(os.path.normpath(p)), hash_path(p)] for p in input_paths],
+        "args": args,
+    }
+    text = json.dumps(data, sort_keys=True, default=repr)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def get_cache_uri(cache_key: str) -> str:
+    settings = get_settings()
+    return f"s3://{settings.S3_BUCKET_NAME}/{_entry_key(cache_key)}"
+
+
+def is_cached(s3_client, cache_key: str) -> bool:
+    """Whether a complete, unexpired result exists for a cache key"""
+    settings = get_settings()
+    try:
+        response = s3_client.head_object(
+            Bucket=settings.S3_BUCKET_NAME, Key=f"{_entry_key(cache_key)}/status"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return False
+
+        raise
+
+    return not _is_expired(response["LastModified"])
+
+
+def get_cached_object(s3_client, cache_key: str) -> Optional[Any]:
+    """Returns a cached Python object, or None if there isn't one"""
+    if not is_cached(s3_client, cache_key):
+        return None
+
+    settings = get_settings()
+    key = f"{_entry_key(cache_key)}/result.pickle"
+    response = s3_client.get_object(Bucket=settings.S3_BUCKET_NAME, Key=key)
+    return pickle.loads(response["Body"].read())
+
+
+def put_cached_object(s3_client, cache_key: str, obj: Any):
+    """Cache a Python object, which must be picklable"""
+    settings = get_settings()
+    entry_key = _entry_key(cache_key)
+    s3_client.put_object(
+        Bucket=settings.S3_BUCKET_NAME, Key=f"{entry_key}/result.pickle", Body=pickle.dumps(obj)
+    )
+    s3_client.put_object(Bucket=settings.S3_BUCKET_NAME, Key=f"{entry_key}/status", Body=b"0\n")
+
+
+def copy_cached_result(s3_client, cache_key: str, dest_key: str):
+    """
+    Copy a cached result to another path in S3, eg. a submitted job's folder.
+    The status is copied last, so that readers never see a partial result.
+    """
+    settings = get_settings()
+    entry_key = _entry_key(cache_key)
+    keys = list_s3_keys(s3_client, f"{entry_key}/", "")
+    keys.sort(key=lambda k: k == f"{entry_key}/status")
+    for key in keys:
+        s3_client.copy_object(
+            Bucket=settings.S3_BUCKET_NAME,
+            Key=dest_key + key[len(entry_key) :],
+            CopySource={"Bucket": settings.S3_BUCKET_NAME, "Key": key},
+        )
+
+
+def evict_expired(s3_client) -> List[str]:
+    """
+    Delete cache entries older than CACHE_TTL_HOURS, and incomplete entries
+    left behind by failed jobs. Returns the evicted cache keys.
+    """
+    settings = get_settings()
+    entries = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    pages = paginator.paginate(Bucket=settings.S3_BUCKET_NAME, Prefix=f"{CACHE_KEY_PREFIX}/")
+    for page in pages:
+        for obj in page.get("Contents", []):
+            cache_key = obj["Key"].split("/")[1]
+            entry = entries.setdefault(cache_key, {"keys": [], "status_at": None, "newest": None})
+            entry["keys"].append(obj["Key"])
+            if obj["Key"].endswith("/status"):
+                entry["status_at"] = obj["LastModified"]
+
+            if not entry["newest"] or obj["LastModified"] > entry["newest"]:
+                entry["newest"] = obj["LastModified"]
+
+    evicted = []
+    for cache_key, entry in entries.items():
+        # Incomplete entries are given the same TTL, in case a job is still writing them.
+        if _is_expired(entry["status_at"] or entry["newest"]):
+            logger.info("Evicting cached result %s", cache_key)
+            for i in range(0, len(entry["keys"]), 1000):
+                objects = [{"Key": k} for k in entry["keys"][i : i + 1000]]
+                s3_client.delete_objects(
+                    Bucket=settings.S3_BUCKET_NAME, Delete={"Objects": objects}
+                )
+
+            evicted.append(cache_key)
+
+    return evicted
+
+
+def _entry_key(cache_key: str) -> str:
+    return f"{CACHE_KEY_PREFIX}/{cache_key}"
+
+
+def _is_expired(modified_at: datetime) -> bool:
+    settings = get_settings()
+    age = datetime.utcnow().replace(tzinfo=tzutc()) - modified_at
+    return age > timedelta(hours=settings.CACHE_TTL_HOURS)
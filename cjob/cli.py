@@ -8,11 +8,18 @@ import click
 import timeago
 from tabulate import tabulate
 
-from . import ec2
+from . import bake, bundle, cache, cluster, datasets, ec2, jobqueue, logs, recommend, rsync
 from .config import get_settings
-from .client import get_ec2_client
+from .client import get_ec2_client, get_s3_client, get_pricing_client
 from .timer import Timer
-from .ssh import ssh_interactive
+from .ssh import ssh_interactive, run_many, DEFAULT_MAX_WORKERS
+from .submit import (
+    submit_job,
+    wait_job,
+    get_job_status,
+    download_result,
+    DEFAULT_POLL_SECONDS,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -40,13 +47,239 @@ def ssh(name: str):
     client = get_ec2_client()
     instance = ec2.find_instance(client, name)
     if instance and instance.is_running():
-        ssh_interactive(instance, settings.KEY_FILE_PATH)
+        ssh_interactive(instance, settings.EC2_KEY_FILE_PATH)
     elif instance:
         logger.info(f"Instance {name} not running")
     else:
         logger.info(f"Instance {name} not found")
 
 
+@cli.command("exec", context_settings={"ignore_unknown_options": True})
+@click.argument("name")
+@click.argument("cmd", nargs=-1, required=True, type=click.UNPROCESSED)
+@click.option("--max-workers", default=DEFAULT_MAX_WORKERS, help="Max instances to run on at once.")
+@click.option("--timeout", type=float, default=None, help="Seconds to wait for each instance.")
+def exec_command(name: str, cmd, max_workers: int, timeout: float):
+    """
+    Run a command on every matching EC2 instance at once.
+    Name can be a job name, a glob pattern like "sweep-*", or "all".
+
+    eg. cjob exec "sweep-*" -- nproc
+    """
+    settings = get_settings()
+    client = get_ec2_client()
+    instances = ec2.match_instances(client, name)
+    if not instances:
+        logger.info(f"No running instances match {name}")
+        sys.exit(-1)
+
+    exit_codes = run_many(
+        instances,
+        " ".join(cmd),
+        settings.EC2_KEY_FILE_PATH,
+        max_workers=max_workers,
+        timeout=timeout,
+    )
+    table_data = [
+        [instance_name, "timed out" if code is None else code]
+        for instance_name, code in exit_codes.items()
+    ]
+    table_str = tabulate(table_data, headers=["Name", "Exit code"])
+    print("\n", table_str, "\n")
+    if any(code != 0 for code in exit_codes.values()):
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument("name")
+@click.argument("local_path", type=click.Path(exists=True))
+@click.argument("remote_path")
+@click.option("--streams", default=rsync.DEFAULT_STREAMS, help="Parallel streams for big folders.")
+@click.option("--max-workers", default=DEFAULT_MAX_WORKERS, help="Max instances to push to.")
+def push(name: str, local_path: str, remote_path: str, streams: int, max_workers: int):
+    """
+    Copy local files to an EC2 instance, sending only what has changed.
+    Name can be a job name, a glob pattern like "sweep-*", or "all",
+    to push to many instances at once.
+    """
+    settings = get_settings()
+    client = get_ec2_client()
+    instances = ec2.match_instances(client, name)
+    if not instances:
+        logger.info(f"No running instances match {name}")
+        sys.exit(-1)
+
+    exit_codes = rsync.push_many(
+        instances,
+        local_path,
+        remote_path,
+        settings.EC2_KEY_FILE_PATH,
+        streams=streams,
+        max_workers=max_workers,
+    )
+    if any(code != 0 for code in exit_codes.values()):
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument("name")
+@click.argument("remote_path")
+@click.argument("local_path")
+def pull(name: str, remote_path: str, local_path: str):
+    """
+    Copy files from an EC2 instance, sending only what has changed.
+    """
+    settings = get_settings()
+    client = get_ec2_client()
+    instance = ec2.find_instance(client, ec2.add_job_prefix(name))
+    if instance and instance.is_running():
+        exit_code = rsync.pull(instance, remote_path, local_path, settings.EC2_KEY_FILE_PATH)
+        sys.exit(exit_code)
+    elif instance:
+        logger.info(f"Instance {name} not running")
+    else:
+        logger.info(f"Instance {name} not found")
+
+    sys.exit(-1)
+
+
+@cli.command("logs")
+@click.argument("name")
+@click.option("--path", default=logs.DEFAULT_LOG_PATH, help="Log file to follow on the instance.")
+@click.option("--archived", is_flag=True, help="Print logs saved in S3 instead of following.")
+def show_logs(name: str, path: str, archived: bool):
+    """
+    Follow a log file on matching EC2 instances, archiving it to S3 as it goes.
+    Name can be a job name, a glob pattern like "sweep-*", or "all".
+    Use --archived to read the logs of a job after its instance is gone.
+    """
+    s3_client = get_s3_client()
+    if archived:
+        for line in logs.read_logs(s3_client, ec2.add_job_prefix(name)):
+            print(line)
+
+        return
+
+    client = get_ec2_client()
+    instances = ec2.match_instances(client, name)
+    if not instances:
+        logger.info(f"No running instances match {name}")
+        sys.exit(-1)
+
+    logs.stream_logs(s3_client, instances, path)
+
+
+@cli.command()
+@click.argument("name")
+@click.option("--script", required=True, type=click.Path(exists=True), help="Script to run.")
+@click.option("--input", "inputs", multiple=True, type=click.Path(exists=True), help="Input file.")
+@click.option(
+    "--bundle",
+    "bundle_path",
+    type=click.Path(exists=True, file_okay=False),
+    help="Project folder to ship to ~/job/code, uploaded only if it has changed.",
+)
+@click.option(
+    "--lockfile",
+    "lockfile_path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="requirements.txt or poetry.lock to build the job's Python environment from.",
+)
+@click.option(
+    "--dataset", "dataset_names", multiple=True, help="Dataset to mount at /mnt/datasets/<name>."
+)
+@click.option("--no-cache", is_flag=True, help="Run the job even if its result is cached.")
+def submit(
+    name: str,
+    script: str,
+    inputs,
+    bundle_path: str,
+    lockfile_path: str,
+    dataset_names,
+    no_cache: bool,
+):
+    """
+    Run a script on a new EC2 instance without staying connected to it.
+    Use "cjob wait" and "cjob result" to get the results.
+    Python environments are built once per lockfile and reused by later jobs.
+    Jobs with the same script, inputs, bundle and lockfile as a cached result are not run again.
+    """
+    if name == "all":
+        logger.error("Cannot name a job instance 'all'.")
+        sys.exit(-1)
+
+    ec2_client = get_ec2_client()
+    s3_client = get_s3_client()
+    job_id = ec2.add_job_prefix(name)
+    if ec2.find_instance(ec2_client, job_id):
+        logger.error(f"A job instance with name {name} already exists.")
+        sys.exit(-1)
+
+    bundle_hash = bundle.upload_bundle(s3_client, bundle_path) if bundle_path else None
+    if no_cache:
+        cache_key = None
+    else:
+        code_paths = [script, lockfile_path] if lockfile_path else [script]
+        snapshots = [ec2.find_dataset_snapshot(ec2_client, d) for d in dataset_names]
+        snapshot_ids = [s["SnapshotId"] if s else None for s in snapshots]
+        args = {"bundle": bundle_hash, "datasets": snapshot_ids}
+        cache_key = cache.compute_cache_key(code_paths, inputs, args)
+
+    instance_id = submit_job(
+        ec2_client,
+        s3_client,
+        job_id,
+        script,
+        inputs,
+        cache_key,
+        bundle_hash,
+        lockfile_path,
+        dataset_names,
+    )
+    if instance_id:
+        logger.info(f"Submitted job {name} to instance {instance_id}")
+    else:
+        logger.info(f"Job {name} has a cached result, no instance launched.")
+
+
+@cli.command()
+@click.argument("name")
+@click.option("--poll", default=DEFAULT_POLL_SECONDS, help="Seconds between status checks.")
+@click.option("--timeout", type=float, default=None, help="Seconds to wait before giving up.")
+def wait(name: str, poll: float, timeout: float):
+    """
+    Wait for a submitted job to finish, exiting with the job's exit code.
+    """
+    job_id = ec2.add_job_prefix(name)
+    s3_client = get_s3_client()
+    with Timer(f"Waiting for job {name}"):
+        # Cached jobs have a status without ever having an instance.
+        exit_code = get_job_status(s3_client, job_id)
+        if exit_code is None:
+            exit_code = wait_job(s3_client, job_id, get_ec2_client(), poll, timeout)
+
+    logger.info(f"Job {name} finished with exit code {exit_code}")
+    sys.exit(exit_code)
+
+
+@cli.command()
+@click.argument("name")
+@click.argument("dest", default=".")
+def result(name: str, dest: str):
+    """
+    Download the outputs of a finished job.
+    """
+    s3_client = get_s3_client()
+    job_id = ec2.add_job_prefix(name)
+    exit_code = get_job_status(s3_client, job_id)
+    if exit_code is None:
+        logger.error(f"Job {name} has not finished.")
+        sys.exit(-1)
+
+    paths = download_result(s3_client, job_id, dest)
+    logger.info(f"Job {name} exited with code {exit_code}, downloaded {len(paths)} output files.")
+
+
 @cli.command()
 @click.argument("name")
 def start(name: str):
@@ -74,20 +307,100 @@ def start(name: str):
 @click.argument("name")
 def stop(name: str):
     """
-    Destroy an EC2 instance with a given name.
+    Destroy an EC2 instance with a given name, or every node of a cluster.
     Destroys all cjob instances if name is "all".
     """
     client = get_ec2_client()
     if name == "all":
-        for instance in ec2.get_instances(client):
+        for instance in ec2.get_instance_records(client):
             msg = f"Something has gone wrong. Instance named {instance.name} should not be deleted because it does not have the right prefix in its name."
             assert ec2.has_job_prefix(instance.name), msg
-            ec2.stop_job(instance.name)
+            ec2.stop_job(client, instance.name)
     else:
         job_id = ec2.add_job_prefix(name)
         ec2.stop_job(client, job_id)
 
 
+@cli.command("cluster")
+@click.argument("name")
+@click.option("--nodes", required=True, type=int, help="Number of nodes to launch.")
+@click.option("--slots", default=1, help="Processes per node, for the MPI hostfile.")
+@click.option(
+    "--dataset", "dataset_names", multiple=True, help="Dataset to mount at /mnt/datasets/<name>."
+)
+def launch_cluster(name: str, nodes: int, slots: int, dataset_names):
+    """
+    Launch several EC2 instances close together, for distributed jobs.
+    Each node gets a hostfile of private IPs at ~/hostfile,
+    and its rank and the master node's address in ~/cluster.env.
+    """
+    if name == "all":
+        logger.error("Cannot name a cluster 'all'.")
+        sys.exit(-1)
+
+    client = get_ec2_client()
+    job_id = ec2.add_job_prefix(name)
+    if [i for i in ec2.get_instance_records(client) if job_id in (i.name, i.cluster)]:
+        logger.error(f"A job instance or cluster with name {name} already exists.")
+        sys.exit(-1)
+
+    with Timer(f"Launching cluster {name} with {nodes} nodes"):
+        nodes = cluster.launch_cluster(client, job_id, nodes, slots, datasets=dataset_names)
+
+    table_data = [[n.rank, n.name, n.ip, n.private_ip] for n in nodes]
+    click.echo(tabulate(table_data, headers=["Rank", "Name", "IP", "Private IP"]))
+
+
+@cli.group()
+def queue():
+    """
+    Queue up many small jobs and run them on a shared pool of EC2 instances.
+    """
+
+
+@queue.command("add", context_settings={"ignore_unknown_options": True})
+@click.argument("cmd", nargs=-1, required=True, type=click.UNPROCESSED)
+@click.option("--cpus", default=1.0, help="vCPUs the job needs.")
+@click.option("--memory", default=1024, help="Memory the job needs, in MB.")
+@click.option("--db", default=jobqueue.DEFAULT_QUEUE_PATH, help="Queue database file.")
+def queue_add(cmd, cpus: float, memory: int, db: str):
+    """
+    Add a job to the queue.
+
+    eg. cjob queue add --cpus 2 -- python train.py --seed 1
+    """
+    job_id = jobqueue.JobQueue(db).add(" ".join(cmd), cpus, memory)
+    logger.info(f"Queued job {job_id}")
+
+
+@queue.command("status")
+@click.option("--db", default=jobqueue.DEFAULT_QUEUE_PATH, help="Queue database file.")
+def queue_status(db: str):
+    """Print the status of all queued jobs"""
+    jobs = jobqueue.JobQueue(db).get_jobs()
+    table_data = [[j.id, j.state, j.instance, j.exit_code, j.command] for j in jobs]
+    table_str = tabulate(table_data, headers=["ID", "Status", "Instance", "Exit code", "Command"])
+    print("\n", table_str, "\n")
+
+
+@queue.command("run")
+@click.option("--max-instances", default=1, help="Max instances in the pool.")
+@click.option(
+    "--idle-grace",
+    default=jobqueue.DEFAULT_IDLE_GRACE_SECONDS,
+    help="Seconds before idle instances are terminated.",
+)
+@click.option("--db", default=jobqueue.DEFAULT_QUEUE_PATH, help="Queue database file.")
+def queue_run(max_instances: int, idle_grace: float, db: str):
+    """
+    Run every queued job, then tear down the pool.
+    """
+    client = get_ec2_client()
+    scheduler = jobqueue.Scheduler(client, jobqueue.JobQueue(db), max_instances, idle_grace)
+    with Timer("Running queued jobs"):
+        scheduler.run()
+
+
 @cli.command()
 def settings():
     """
@@ -101,7 +414,7 @@ def settings():
 def status():
     """Print the status of all your EC2 instances"""
     client = get_ec2_client()
-    instances = ec2.get_instances(client)
+    instances = ec2.get_instance_records(client)
     now = datetime.utcnow().replace(tzinfo=tzutc())
     table_data = [
         [
@@ -128,6 +441,152 @@ def ami():
     logging.info("Latest Ubuntu AMI is %s", ami)
 
 
+@cli.command("bake")
+@click.option(
+    "--setup",
+    "setup_path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Setup script to bake into the AMI, defaults to EC2_SETUP_SCRIPT.",
+)
+@click.option("--force", is_flag=True, help="Bake a new AMI even if one already exists.")
+@click.option("--keep", default=bake.DEFAULT_KEEP_AMIS, help="Number of old AMIs to keep.")
+def bake_ami(setup_path: str, force: bool, keep: int):
+    """
+    Build an AMI with a setup script already run on it, then delete old AMIs.
+    Jobs use the AMI baked from EC2_SETUP_SCRIPT automatically.
+    """
+    settings = get_settings()
+    setup_path = setup_path or settings.EC2_SETUP_SCRIPT
+    if not setup_path:
+        logger.error("No setup script given, use --setup or set EC2_SETUP_SCRIPT.")
+        sys.exit(-1)
+
+    client = get_ec2_client()
+    with Timer(f"Baking AMI from {setup_path}"):
+        ami_id = bake.bake(client, setup_path, force)
+
+    logger.info(f"Baked AMI {ami_id} from {setup_path}")
+    if setup_path != settings.EC2_SETUP_SCRIPT:
+        logger.info(f"Set EC2_SETUP_SCRIPT to {setup_path} to use this AMI for jobs.")
+
+    bake.collect_garbage(client, keep, keep_ami_id=ami_id)
+
+
+@cli.command("recommend")
+@click.argument("name")
+@click.option(
+    "--headroom",
+    default=recommend.DEFAULT_HEADROOM,
+    help="Spare capacity to leave above peak usage, eg. 1.2 for 20% extra.",
+)
+@click.option("--limit", default=10, help="Number of instance types to show.")
+def recommend_instance(name: str, headroom: float, limit: int):
+    """
+    Suggest cheaper instance types for a submitted job, based on the peak usage
+    of every job which ran the same script.
+    """
+    job_id = ec2.add_job_prefix(name)
+    try:
+        usages, recommendations = recommend.recommend_for_job(
+            get_ec2_client(), get_s3_client(), get_pricing_client(), job_id, headroom
+        )
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(-1)
+
+    peak_cpu = max(u.peak_cpu_percent for u in usages)
+    peak_memory_gib = max(u.peak_memory_bytes for u in usages) / 1024 ** 3
+    instance_types = ", ".join(sorted({u.instance_type for u in usages}))
+    logger.info(
+        f"Peak usage over {len(usages)} jobs on {instance_types} was {peak_cpu:.0f}% CPU"
+        f" and {peak_memory_gib:.1f} GiB memory"
+    )
+    if not recommendations:
+        click.echo("No instance types fit this job's usage.")
+        return
+
+    rows = [
+        [
+            r.instance_type,
+            r.vcpus,
+            f"{r.memory_mib / 1024:.1f} GiB",
+            f"${r.price_per_hour:.4f}",
+            f"{r.projected_runtime_seconds / 60:.1f} min",
+            f"${r.projected_cost:.4f}",
+            f"{r.cost_change_percent:+.0f}%",
+        ]
+        for r in recommendations[:limit]
+    ]
+    headers = ["Type", "vCPUs", "Memory", "Price/hour", "Runtime", "Cost/job", "Change"]
+    click.echo(tabulate(rows, headers=headers))
+
+
+@click.group()
+def dataset():
+    """
+    Manage datasets staged on EBS snapshots.
+    """
+
+
+@dataset.command("create")
+@click.argument("name")
+@click.argument("source")
+@click.option("--size", "size_gb", required=True, type=int, help="Volume size in GB.")
+@click.option(
+    "--fast-restore",
+    "zones",
+    multiple=True,
+    help="Availability zone to enable fast snapshot restore in, charged by the hour.",
+)
+@click.option("--force", is_flag=True, help="Copy the data again even if it's unchanged.")
+def dataset_create(name: str, source: str, size_gb: int, zones, force: bool):
+    """
+    Copy an S3 prefix, like s3://bucket/data/, to an EBS snapshot for jobs to mount.
+    """
+    with Timer(f"Creating dataset {name} from {source}"):
+        snapshot_id = datasets.create_dataset(get_ec2_client(), name, source, size_gb, zones, force)
+
+    logger.info(f"Dataset {name} is snapshot {snapshot_id}")
+
+
+@dataset.command("list")
+def dataset_list():
+    """
+    List datasets and their snapshots.
+    """
+    snapshots = datasets.get_datasets(get_ec2_client())
+    if not snapshots:
+        click.echo("No datasets found.")
+        return
+
+    rows = []
+    for s in snapshots:
+        tags = {t["Key"]: t["Value"] for t in s.get("Tags", [])}
+        rows.append(
+            [
+                tags.get(ec2.DATASET_TAG),
+                s["SnapshotId"],
+                f"{s['VolumeSize']} GB",
+                s["State"],
+                tags.get(ec2.DATASET_SOURCE_TAG),
+            ]
+        )
+
+    click.echo(tabulate(rows, headers=["Name", "Snapshot", "Size", "State", "Source"]))
+
+
+@dataset.command("delete")
+@click.argument("name")
+def dataset_delete(name: str):
+    """
+    Delete a dataset's snapshots.
+    """
+    datasets.delete_dataset(get_ec2_client(), name)
+
+
+cli.add_command(dataset)
+
+
 @click.group()
 def cleanup():
     """
@@ -135,6 +594,24 @@ def cleanup():
     """
 
 
+@cleanup.command("cache")
+def cleanup_cache():
+    """Delete expired cached job results"""
+    evicted = cache.evict_expired(get_s3_client())
+    logger.info(f"Deleted {len(evicted)} expired cached results.")
+
+
+cli.add_command(cleanup)
+
+
+@cleanup.command("amis")
+@click.option("--keep", default=bake.DEFAULT_KEEP_AMIS, help="Number of old AMIs to keep.")
+def cleanup_amis(keep: int):
+    """Delete old baked AMIs and their snapshots"""
+    deregistered = bake.collect_garbage(get_ec2_client(), keep)
+    logger.info(f"Deleted {len(deregistered)} old AMIs.")
+
+
 @cleanup.command("instances")
 def cleanup_instances():
     """"""
@@ -144,6 +621,5 @@ def cleanup_instances():
 
 @cleanup.command("volumes")
 def cleanup_volumes():
-    """"""
-    pass
-    # cleanup_volumes()
+    """Delete detached EBS volumes created by cjob"""
+    ec2.cleanup_volumes(get_ec2_client())
@@ -1,18 +1,29 @@
 import boto3
 
 from .config import get_settings, Settings
+from .throttle import wrap_client, CLIENT_CONFIG
+
+PRICING_REGION = "us-east-1"
 
 
 def get_ec2_client():
     settings = get_settings()
     session = _get_session(settings)
-    return session.client("ec2")
+    return wrap_client(session.client("ec2", config=CLIENT_CONFIG), "ec2")
 
 
 def get_s3_client():
     settings = get_settings()
     session = _get_session(settings)
-    return session.client("s3")
+    return wrap_client(session.client("s3", config=CLIENT_CONFIG), "s3")
+
+
+def get_pricing_client():
+    settings = get_settings()
+    session = _get_session(settings)
+    # The pricing API is only served from a few regions, but covers every region.
+    client = session.client("pricing", region_name=PRICING_REGION, config=CLIENT_CONFIG)
+    return wrap_client(client, "pricing")
 
 
 def _get_session(settings: Settings):
@@ -0,0 +1,113 @@
+"""
+Multi-node clusters for distributed jobs, like MPI or distributed training.
+
+Nodes are launched together in a cluster placement group (see ec2.create_cluster).
+Once they're all reachable, every node gets the same hostfile of private IPs,
+and its own environment file with its rank, the cluster size and the master's address.
+"""
+import shlex
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from . import ec2, ssh
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+HOSTFILE_PATH = "~/hostfile"
+CLUSTER_ENV_PATH = "~/cluster.env"
+# Port for the master node's rendezvous, as used by torch.distributed.
+DEFAULT_MASTER_PORT = 29500
+
+
+def launch_cluster(
+    client,
+    job_id: str,
+    count: int,
+    slots: int = 1,
+    ssh_key_path: Optional[str] = None,
+    **kwargs,
+) -> List["ec2.EC2Instance"]:
+    """
+    Launch a cluster, wait for every node to accept SSH connections, then copy the
+    hostfile and environment files to them. Returns the nodes, ordered by rank.
+    Extra keyword arguments are passed on to ec2.create_cluster.
+    The nodes are terminated if the cluster can't be set up.
+    """
+    instance_ids = ec2.create_cluster(client, job_id, count, **kwargs)
+    try:
+        nodes = wait_for_cluster(client, instance_ids, ssh_key_path)
+        write_cluster_files(nodes, slots, ssh_key_path)
+    except Exception:
+        logger.exception("Could not set up cluster %s, stopping its nodes", job_id)
+        ec2.stop_job(client, job_id)
+        raise
+
+    return nodes
+
+
+def wait_for_cluster(
+    client, instance_ids: List[str], ssh_key_path: Optional[str] = None
+) -> List["ec2.EC2Instance"]:
+    """
+    Wait for every node of a cluster to be running and to accept SSH connections.
+    """
+    nodes = ec2.wait_for_instances(client, instance_ids)
+    logger.info("Waiting for SSH on %s nodes...", len(nodes))
+    with ThreadPoolExecutor(max_workers=min(len(nodes), ssh.DEFAULT_MAX_WORKERS)) as pool:
+        is_ready = list(pool.map(lambda node: ssh.wait_for_ssh(node, ssh_key_path), nodes))
+
+    unreachable = [node.name for node, ready in zip(nodes, is_ready) if not ready]
+    if unreachable:
+        raise TimeoutError(f"Could not SSH into cluster nodes {unreachable}")
+
+    return nodes
+
+
+def build_hostfile(nodes: List["ec2.EC2Instance"], slots: int = 1) -> str:
+    """
+    Build an MPI hostfile of the nodes' private IPs, ordered by rank.
+    """
+    return "".join(f"{node.private_ip} slots={slots}\n" for node in nodes)
+
+
+def build_cluster_env(
+    nodes: List["ec2.EC2Instance"], rank: int, master_port: int = DEFAULT_MASTER_PORT
+) -> str:
+    """
+    Build a shell environment file for one node, telling it where it sits in the cluster.
+    """
+    env = {
+        "CJOB_RANK": rank,
+        "CJOB_WORLD_SIZE": len(nodes),
+        "CJOB_MASTER_ADDR": nodes[0].private_ip,
+        "CJOB_MASTER_PORT": master_port,
+        "CJOB_HOSTS": ",".join(node.private_ip for node in nodes),
+    }
+    return "".join(f"export {key}={shlex.quote(str(value))}\n" for key, value in env.items())
+
+
+def write_cluster_files(
+    nodes: List["ec2.EC2Instance"], slots: int = 1, ssh_key_path: Optional[str] = None
+):
+    """
+    Write the hostfile and each node's environment file to every node.
+    """
+    ssh_key_path = ssh_key_path or get_settings().EC2_KEY_FILE_PATH
+    hostfile = build_hostfile(nodes, slots)
+
+    def write_files(rank: int) -> Optional[int]:
+        cluster_env = build_cluster_env(nodes, rank)
+        cmd = (
+            f"printf %s {shlex.quote(hostfile)} > {HOSTFILE_PATH} && "
+            f"printf %s {shlex.quote(cluster_env)} > {CLUSTER_ENV_PATH}"
+        )
+        return ssh.run(nodes[rank], cmd, ssh_key_path)
+
+    with ThreadPoolExecutor(max_workers=min(len(nodes), ssh.DEFAULT_MAX_WORKERS)) as pool:
+        exit_codes = list(pool.map(write_files, range(len(nodes))))
+
+    failed = [node.name for node, code in zip(nodes, exit_codes) if code != 0]
+    if failed:
+        raise RuntimeError(f"Could not write cluster files to nodes {failed}")
@@ -25,11 +25,14 @@ class Settings(BaseModel):
     EC2_SPOT_MAX_PRICE: Optional[float]
     EC2_IAM_INSTANCE_PROFILE: Optional[str]
     EC2_AMI: Optional[str]
+    EC2_SETUP_SCRIPT: Optional[str]
     EC2_SECURITY_GROUP: Optional[str]
+    EC2_PLACEMENT_GROUP: Optional[str]
     EC2_MAX_HOURS: int = 8
     EC2_PROTECTED_INSTANCES: List[str] = []
     S3_BUCKET_NAME: Optional[str]
     EC2_SHUTDOWN_BEHAVIOUR: str = "terminate"
+    CACHE_TTL_HOURS: int = 168
 
     @root_validator(pre=True, allow_reuse=True)
     def root_validator(cls, values):
@@ -0,0 +1,213 @@
+"""
+Datasets staged on EBS snapshots, so that jobs find their data on disk at boot
+instead of downloading it from S3.
+
+A builder instance copies an S3 prefix onto a new EBS volume, which is then snapshotted
+and tagged with the dataset's name. Jobs launched with that dataset get a volume restored
+from the snapshot, mounted at /mnt/datasets/<name> (see create_job).
+"""
+import re
+import shlex
+import logging
+from typing import List
+
+from . import ec2, ssh
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the builder instance to copy the dataset.
+COPY_TIMEOUT = 6 * 60 * 60
+# Lines of the builder log to show when copying fails.
+FAILURE_LOG_LINES = 50
+BUILDER_DEVICE_NAME = "/dev/sdf"
+DATASET_NAME_PATTERN = re.compile(r"^[a-zA-Z0-9_-]+$")
+
+BUILDER_TEMPLATE = """#!/bin/bash
+# Generated by cjob: copies {source_comment} onto a new volume for dataset {name}.
+set -eu
+
+# The volume may not be called {device_name} on the instance, so look for an empty EBS disk,
+# skipping any instance storage.
+DEVICE=""
+for attempt in $(seq 60); do
+    for disk in {device_name} /dev/xvd{device_letter} $(lsblk -dpno NAME | grep nvme); do
+        if [ -b "$disk" ] && [ "$(lsblk -no NAME "$disk" | wc -l)" = "1" ] \\
+            && [ -z "$(lsblk -no FSTYPE "$disk" | tr -d '[:space:]')" ] \\
+            && ! lsblk -dno MODEL "$disk" | grep -q "Instance Storage"; then
+            DEVICE=$disk
+            break 2
+        fi
+    done
+    sleep 5
+done
+if [ -z "$DEVICE" ]; then
+    echo "Could not find the dataset volume" >&2
+    exit 1
+fi
+
+if ! command -v aws > /dev/null; then
+    apt-get update -q
+    apt-get install -y -q awscli
+fi
+
+mkfs.ext4 -q -L {label} "$DEVICE"
+mkdir -p /mnt/dataset
+mount "$DEVICE" /mnt/dataset
+aws s3 sync --quiet {source} /mnt/dataset
+chown -R ubuntu:ubuntu /mnt/dataset
+umount /mnt/dataset
+"""
+
+
+def create_dataset(
+    client,
+    name: str,
+    source_uri: str,
+    size_gb: int,
+    fast_restore_zones: List[str] = (),
+    force: bool = False,
+) -> str:
+    """
+    Copy an S3 prefix (eg. s3://bucket/data/) to an EBS snapshot for a dataset, returning
+    the snapshot ID. An existing snapshot of the same source is reused unless force is set.
+    Older snapshots of the dataset are deleted once the new one is ready.
+    Fast snapshot restore can be enabled in some availability zones, so that volumes
+    restored there are fully fast from the start; AWS charges for this by the hour.
+    """
+    if not DATASET_NAME_PATTERN.match(name):
+        raise ValueError(f"Dataset name {name} must only have letters, numbers, - and _.")
+
+    existing = ec2.find_dataset_snapshot(client, name)
+    if existing and _get_tag(existing, ec2.DATASET_SOURCE_TAG) == source_uri and not force:
+        logger.info("Dataset %s already has snapshot %s", name, existing["SnapshotId"])
+        if fast_restore_zones:
+            set_fast_restore(client, name, fast_restore_zones, enabled=True)
+
+        return existing["SnapshotId"]
+
+    user_data = build_user_data(name, source_uri)
+    mappings = [
+        {
+            "DeviceName": BUILDER_DEVICE_NAME,
+            "Ebs": {"VolumeSize": size_gb, "VolumeType": "gp3", "DeleteOnTermination": True},
+        }
+    ]
+    job_id = ec2.add_job_prefix(f"dataset-{name}")
+    instance_id = ec2.create_job(client, job_id, user_data, block_device_mappings=mappings)
+    try:
+        instance = ec2.wait_for_instance(client, instance_id)
+        if not ssh.wait_for_ssh(instance):
+            raise TimeoutError(f"Could not SSH into builder instance {instance.id}")
+
+        logger.info("Copying %s to dataset %s on %s...", source_uri, name, instance.id)
+        if not ssh.wait_for_user_data(instance, timeout=COPY_TIMEOUT):
+            ssh.run(instance, f"tail -n {FAILURE_LOG_LINES} /var/log/cloud-init-output.log")
+            raise RuntimeError(f"Copying dataset {name} failed on builder instance {instance.id}")
+
+        volume_id = _get_volume_id(client, instance_id, BUILDER_DEVICE_NAME)
+        snapshot_id = _create_snapshot(client, volume_id, name, source_uri)
+    finally:
+        ec2.stop_job(client, job_id)
+
+    if fast_restore_zones:
+        set_fast_restore(client, name, fast_restore_zones, enabled=True)
+
+    for snapshot in get_datasets(client):
+        is_old = snapshot["SnapshotId"] != snapshot_id
+        if is_old and _get_tag(snapshot, ec2.DATASET_TAG) == name:
+            _delete_snapshot(client, snapshot)
+
+    return snapshot_id
+
+
+def build_user_data(name: str, source_uri: str) -> str:
+    """
+    Build the script which copies a dataset's source onto the builder instance's volume.
+    """
+    return BUILDER_TEMPLATE.format(
+        name=name,
+        source=shlex.quote(source_uri),
+        source_comment=" ".join(source_uri.splitlines()),
+        label=ec2.get_dataset_label(name),
+        device_name=BUILDER_DEVICE_NAME,
+        device_letter=BUILDER_DEVICE_NAME[-1],
+    )
+
+
+def get_datasets(client) -> List[dict]:
+    """
+    Returns the EBS snapshots of every dataset.
+    """
+    response = client.describe_snapshots(
+        OwnerIds=["self"], Filters=[{"Name": "tag-key", "Values": [ec2.DATASET_TAG]}]
+    )
+    return response["Snapshots"]
+
+
+def delete_dataset(client, name: str):
+    """
+    Delete every snapshot of a dataset.
+    """
+    snapshots = [s for s in get_datasets(client) if _get_tag(s, ec2.DATASET_TAG) == name]
+    if not snapshots:
+        raise ValueError(f"Dataset {name} does not exist.")
+
+    for snapshot in snapshots:
+        _delete_snapshot(client, snapshot)
+
+
+def set_fast_restore(client, name: str, zones: List[str], enabled: bool):
+    """
+    Turn fast snapshot restore on or off for a dataset's snapshot in some availability zones.
+    """
+    snapshot = ec2.find_dataset_snapshot(client, name)
+    if not snapshot:
+        raise ValueError(f"Dataset {name} does not exist.")
+
+    kwargs = {"AvailabilityZones": zones, "SourceSnapshotIds": [snapshot["SnapshotId"]]}
+    if enabled:
+        logger.info("Enabling fast snapshot restore for dataset %s in %s", name, zones)
+        client.enable_fast_snapshot_restores(**kwargs)
+    else:
+        logger.info("Disabling fast snapshot restore for dataset %s in %s", name, zones)
+        client.disable_fast_snapshot_restores(**kwargs)
+
+
+def _get_volume_id(client, instance_id: str, device_name: str) -> str:
+    response = client.describe_instances(InstanceIds=[instance_id])
+    instance = response["Reservations"][0]["Instances"][0]
+    for mapping in instance["BlockDeviceMappings"]:
+        if mapping["DeviceName"] == device_name:
+            return mapping["Ebs"]["VolumeId"]
+
+    raise RuntimeError(f"Could not find volume {device_name} on instance {instance_id}")
+
+
+def _create_snapshot(client, volume_id: str, name: str, source_uri: str) -> str:
+    logger.info("Creating snapshot of volume %s for dataset %s...", volume_id, name)
+    response = client.create_snapshot(VolumeId=volume_id, Description=f"cjob dataset {name}")
+    snapshot_id = response["SnapshotId"]
+    client.create_tags(
+        Resources=[snapshot_id],
+        Tags=[
+            {"Key": "Name", "Value": f"cjob-dataset-{name}"},
+            {"Key": ec2.DATASET_TAG, "Value": name},
+            {"Key": ec2.DATASET_SOURCE_TAG, "Value": source_uri},
+        ],
+    )
+    waiter = client.get_waiter("snapshot_completed")
+    waiter.wait(SnapshotIds=[snapshot_id], WaiterConfig={"Delay": 15, "MaxAttempts": 480})
+    logger.info("Created snapshot %s for dataset %s", snapshot_id, name)
+    return snapshot_id
+
+
+def _delete_snapshot(client, snapshot: dict):
+    name = _get_tag(snapshot, ec2.DATASET_TAG)
+    logger.info("Deleting snapshot %s of dataset %s", snapshot["SnapshotId"], name)
+    client.delete_snapshot(SnapshotId=snapshot["SnapshotId"])
+
+
+def _get_tag(resource: dict, key: str):
+    for tag in resource.get("Tags", []):
+        if tag["Key"] == key:
+            return tag["Value"]
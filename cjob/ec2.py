@@ -1,18 +1,41 @@
 import os
 import sys
+import hashlib
 import logging
 from datetime import datetime
+from fnmatch import fnmatch
 from dateutil import parser
-from typing import Optional, List
-from time import time
+from typing import Optional, List, NamedTuple
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
 
+import yaml
 from pydantic import BaseModel
 
+from . import cache, ssh
 from .config import get_settings
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_SECURITY_GROUP = "cjob-security-group"
+DEFAULT_PLACEMENT_GROUP = "cjob-cluster"
+# Tag on the nodes of a cluster launched by create_cluster.
+CLUSTER_TAG = "cjob:cluster"
+# Tag on nodes launched by older versions of cjob. Nodes are now ranked by launch index.
+RANK_TAG = "cjob:rank"
+# Tags on AMIs built by "cjob bake".
+BAKE_HASH_TAG = "cjob:bake-hash"
+BASE_AMI_TAG = "cjob:base-ami"
+# Tags on EBS snapshots built by "cjob dataset create".
+DATASET_TAG = "cjob:dataset"
+DATASET_SOURCE_TAG = "cjob:dataset-source"
+# Tag on every EBS volume created for a cjob instance.
+MANAGED_TAG = "cjob:managed"
+# Tag on job queue pool instances, with the ID of the queue they belong to.
+QUEUE_TAG = "cjob:queue"
+# Datasets are mounted at /mnt/datasets/<name> on job instances.
+DATASET_MOUNT_DIR = "/mnt/datasets"
+DATASET_DEVICE_NAMES = [f"/dev/sd{c}" for c in "fghijklmnop"]
 
 
 class EC2InstanceState:
@@ -29,25 +52,60 @@ class EC2Instance(BaseModel):
     id: str  # AWS Instance ID
     name: Optional[str]  # Instance name, from "Name" tag on instance.
     ip: Optional[str]  # Public IP maybe?
+    private_ip: Optional[str]  # IP address within the VPC.
     type: str  # AWS Instance type (eg. "t3.small")
     launched_at: datetime
     state: str
+    cluster: Optional[str]  # Job ID of the cluster this instance is a node of.
+    rank: Optional[int]  # Index of this node within its cluster.
 
     def is_running(self):
         return self.state == EC2InstanceState.running
 
 
-def run_job(client, job_id: str, job_func, *args, **kwargs):
+class InstanceRecord(NamedTuple):
     """
-    Run a job on a remote server
+    A compact, unvalidated view of an instance, for scanning the whole inventory.
+    Use to_model to hand an instance to code outside this module.
     """
-    create_job(client, job_id)
-    logger.info("Waiting 60s for EC2 instance to boot... ")
-    time.sleep(60)
-    logger.info("Server is hopefully ready.")
-    instance = find_instance(job_id)
+
+    id: str
+    name: str
+    ip: Optional[str]
+    private_ip: Optional[str]
+    type: str
+    launched_at: datetime  # Already parsed by botocore.
+    state: str
+    cluster: Optional[str]
+    rank: Optional[int]
+
+    def is_running(self):
+        return self.state == EC2InstanceState.running
+
+    def to_model(self) -> EC2Instance:
+        return EC2Instance(**self._asdict())
+
+
+def run_job(
+    client, job_id: str, job_func, *args, cache_key: Optional[str] = None, s3_client=None, **kwargs
+):
+    """
+    Run a job on a remote server.
+    If a cache key and S3 client are given, a cached result for that key is returned
+    without launching an instance, and a successful result is saved to the cache.
+    """
+    # A job's cached result can be None, so check for the entry rather than the result.
+    if cache_key and cache.is_cached(s3_client, cache_key):
+        logger.info("Found cached result for job %s, not running it.", job_id)
+        return cache.get_cached_object(s3_client, cache_key)
+
+    instance_id = create_job(client, job_id)
     output = None
     try:
+        instance = wait_for_instance(client, instance_id)
+        if not ssh.wait_for_ssh(instance):
+            raise TimeoutError(f"Could not SSH into instance {instance.id}")
+
         logger.info("Attempting to run job %s on instance %s", job_id, instance.id)
         output = job_func(*args, **kwargs)
         logging.info("Job %s succeeded.", job_id)
@@ -59,43 +117,126 @@ def run_job(client, job_id: str, job_func, *args, **kwargs):
         # Always stop the job to prevent dangling jobs.
         stop_job(client, job_id)
 
+    if cache_key:
+        cache.put_cached_object(s3_client, cache_key, output)
+
     return output
 
 
-def create_job(client, job_id: str):
+def create_job(
+    client,
+    job_id: str,
+    user_data: Optional[str] = None,
+    ami_id: Optional[str] = None,
+    datasets: List[str] = (),
+    block_device_mappings: List[dict] = (),
+    tags: List[dict] = (),
+) -> str:
+    """
+    Launch an EC2 instance for a job, returning the instance ID.
+    An optional user data script is run by the instance when it boots.
+    The instance uses the given AMI, or else the one chosen by get_ami_id.
+    Each named dataset is attached as a volume restored from its EBS snapshot,
+    and mounted at /mnt/datasets/<name> before the user data script runs.
+    Any extra tags are added to the instance when it's launched.
+    """
     settings = get_settings()
     logger.info(f"Creating EC2 instance {settings.EC2_INSTANCE_TYPE} for job {job_id}... ")
+    instance_ids = _launch_instances(
+        client, job_id, 1, user_data, ami_id, datasets, block_device_mappings, tags=tags
+    )
+    return instance_ids[0]
+
+
+def create_cluster(
+    client,
+    job_id: str,
+    count: int,
+    user_data: Optional[str] = None,
+    ami_id: Optional[str] = None,
+    datasets: List[str] = (),
+) -> List[str]:
+    """
+    Launch the nodes of a cluster together in a cluster placement group, for low latency,
+    high throughput networking between them. Returns the instance IDs, ordered by rank.
+    Either all of the nodes are launched or none of them are.
+    Nodes can reach each other on every port.
+
+    Every node is tagged with the cluster's job ID when it's launched. A node's rank is its
+    launch index, and it's named <job id>-<rank> (see read_instance_record).
+    """
+    settings = get_settings()
+    logger.info(f"Creating {count} EC2 instances {settings.EC2_INSTANCE_TYPE} for {job_id}... ")
+    placement_group = _setup_placement_group(client)
+    tags = [{"Key": CLUSTER_TAG, "Value": job_id}]
+    return _launch_instances(
+        client,
+        job_id,
+        count,
+        user_data,
+        ami_id,
+        datasets,
+        placement_group=placement_group,
+        tags=tags,
+    )
+
+
+def _launch_instances(
+    client,
+    job_id: str,
+    count: int,
+    user_data: Optional[str] = None,
+    ami_id: Optional[str] = None,
+    datasets: List[str] = (),
+    block_device_mappings: List[dict] = (),
+    placement_group: Optional[str] = None,
+    tags: List[dict] = (),
+) -> List[str]:
+    launch_kwargs = get_launch_kwargs(
+        client, ami_id, datasets, block_device_mappings, placement_group
+    )
+    kwargs = build_run_kwargs(launch_kwargs, job_id, count, user_data, datasets, tags)
+    response = client.run_instances(**kwargs)
+    logger.info("Start request sent.")
+    instances = sorted(response["Instances"], key=lambda i: i["AmiLaunchIndex"])
+    return [i["InstanceId"] for i in instances]
+
+
+def get_launch_kwargs(
+    client,
+    ami_id: Optional[str] = None,
+    datasets: List[str] = (),
+    block_device_mappings: List[dict] = (),
+    placement_group: Optional[str] = None,
+) -> dict:
+    """
+    Set up the security group, key pair and AMI needed to launch instances, and return
+    the run_instances arguments shared by every job launched with them (see build_run_kwargs).
+    """
+    settings = get_settings()
 
     security_group_id = settings.EC2_SECURITY_GROUP
     if not security_group_id:
         security_group_id = _setup_default_security_group(client)
 
-    ami_id = settings.EC2_AMI
-    if not ami_id:
-        logger.info("No Amazon Machine Image provided, using latest Ubuntu image.")
-        ami_id = get_latest_ubuntu_ami_id(client)
-        logger.info(f"Found Ubuntu AMU {ami_id}")
-
+    ami_id = ami_id or get_ami_id(client)
+    used_device_names = [m["DeviceName"] for m in block_device_mappings]
+    block_device_mappings = [
+        *block_device_mappings,
+        *get_dataset_mappings(client, datasets, used_device_names),
+    ]
     key_name = _setup_private_key(client)
 
     kwargs = {
-        "MaxCount": 1,
-        "MinCount": 1,
         "ImageId": ami_id,
         "InstanceType": settings.EC2_INSTANCE_TYPE,
         "SecurityGroupIds": [security_group_id],
         "KeyName": key_name,
         "InstanceInitiatedShutdownBehavior": settings.EC2_SHUTDOWN_BEHAVIOUR,
-        "TagSpecifications": [
-            {
-                "ResourceType": "instance",
-                "Tags": [{"Key": "Name", "Value": job_id}],
-            }
-        ],
     }
 
     if settings.EC2_IAM_INSTANCE_PROFILE:
-        kwargs["IamInstanceProfile"] = ({"Name": settings.EC2_IAM_INSTANCE_PROFILE},)
+        kwargs["IamInstanceProfile"] = {"Name": settings.EC2_IAM_INSTANCE_PROFILE}
 
     if settings.EC2_USE_SPOT:
         logger.info(f"Using a spot EC2 instance. ")
@@ -109,13 +250,57 @@ def create_job(client, job_id: str):
     else:
         logger.info(f"Not using a spot EC2 instance.")
 
-    client.run_instances(**kwargs)
-    logger.info("Start request sent.")
+    if block_device_mappings:
+        kwargs["BlockDeviceMappings"] = block_device_mappings
+
+    if placement_group:
+        kwargs["Placement"] = {"GroupName": placement_group}
+
+    return kwargs
+
+
+def build_run_kwargs(
+    launch_kwargs: dict,
+    job_id: str,
+    count: int,
+    user_data: Optional[str] = None,
+    datasets: List[str] = (),
+    tags: List[dict] = (),
+) -> dict:
+    """
+    Build the run_instances arguments for one job, from those returned by get_launch_kwargs.
+    The datasets must be the same ones given to get_launch_kwargs.
+    Any extra tags are added to the instances.
+    """
+    kwargs = {
+        **launch_kwargs,
+        "MaxCount": count,
+        "MinCount": count,
+        "TagSpecifications": [
+            {
+                "ResourceType": "instance",
+                "Tags": [{"Key": "Name", "Value": job_id}, *tags],
+            },
+            {
+                # So that cleanup_volumes knows they're safe to delete.
+                "ResourceType": "volume",
+                "Tags": [{"Key": "Name", "Value": job_id}, {"Key": MANAGED_TAG, "Value": "true"}],
+            },
+        ],
+    }
+
+    if datasets:
+        user_data = add_dataset_mounts(user_data, datasets)
+
+    if user_data:
+        kwargs["UserData"] = user_data
+
+    return kwargs
 
 
 def start_job(client, job_id: str):
     logger.info(f"Stopping EC2 instances running job {job_id}... ")
-    instance_ids = [i.id for i in get_instances(client) if i.name == job_id]
+    instance_ids = [i.id for i in get_instance_records(client) if i.name == job_id]
     logger.info(f"Starting EC2 instances {instance_ids}")
     response = client.start_instances(InstanceIds=[instance_ids])
     logger.info(response)
@@ -123,61 +308,116 @@ def start_job(client, job_id: str):
 
 def stop_job(client, job_id: str):
     logger.info(f"Stopping EC2 instances running job {job_id}... ")
-    instance_ids = [i.id for i in get_instances(client) if i.name == job_id]
+    instances = [i for i in get_instance_records(client) if job_id in (i.name, i.cluster)]
+    instance_ids = [i.id for i in instances]
     logger.info(f"Found these EC2 instances to stop: {instance_ids}")
     client.terminate_instances(InstanceIds=instance_ids)
     logger.info("Stop request sent.")
+    for instance in instances:
+        # Don't leave multiplexed SSH connections to a dead host lying around.
+        ssh.close_connection(instance)
 
 
 def get_instances(client) -> List[EC2Instance]:
-    response = client.describe_instances()
-    aws_instances = []
-    for reservation in response["Reservations"]:
-        for aws_instance in reservation["Instances"]:
-            aws_instances.append(aws_instance)
-
-    instances = []
-    for aws_instance in aws_instances:
-        if aws_instance["State"]["Name"] == EC2InstanceState.terminated:
-            continue
+    return [record.to_model() for record in get_instance_records(client)]
 
-        name = ""
-        for tag in aws_instance.get("Tags", []):
-            if tag["Key"] == "Name":
-                name = tag["Value"]
 
-        if not has_job_prefix(name):
-            # Only get cjob created instances
-            continue
+def get_instance_records(client, filters: List[dict] = ()) -> List[InstanceRecord]:
+    """
+    Returns every cjob instance which hasn't been terminated, as compact records.
+    Cheaper than get_instances when scanning a large inventory.
+    Extra describe_instances filters narrow down the instances returned.
+    """
+    paginator = client.get_paginator("describe_instances")
+    pages = paginator.paginate(Filters=[*INSTANCE_FILTERS, *filters])
+    records = []
+    for page in pages:
+        for reservation in page["Reservations"]:
+            for aws_instance in reservation["Instances"]:
+                record = read_instance_record(aws_instance)
+                if record:
+                    records.append(record)
 
-        # Read IP address
-        ip = None
-        instance_id = aws_instance["InstanceId"]
-        try:
-            network_interface = aws_instance["NetworkInterfaces"][0]
-            ip = network_interface["Association"]["PublicIp"]
-        except (KeyError, IndexError):
-            logger.warn("Could not find IP address for instance %s", instance_id)
-            pass
-
-        instance = EC2Instance(
-            id=instance_id,
-            name=name,
-            ip=ip,
-            type=aws_instance["InstanceType"],
-            launched_at=aws_instance["LaunchTime"],
-            state=aws_instance["State"]["Name"],
-        )
-        instances.append(instance)
+    return records
+
+
+def read_instance_record(aws_instance: dict) -> Optional[InstanceRecord]:
+    """
+    Read an instance from a describe_instances response, or None if it's not a live cjob instance.
+    """
+    if aws_instance["State"]["Name"] == EC2InstanceState.terminated:
+        return None
+
+    tags = {tag["Key"]: tag["Value"] for tag in aws_instance.get("Tags", [])}
+    name = tags.get("Name", "")
+    if not has_job_prefix(name):
+        # Only get cjob created instances
+        return None
+
+    # Read IP address
+    ip = None
+    instance_id = aws_instance["InstanceId"]
+    try:
+        network_interface = aws_instance["NetworkInterfaces"][0]
+        ip = network_interface["Association"]["PublicIp"]
+    except (KeyError, IndexError):
+        logger.debug("Could not find IP address for instance %s", instance_id)
+
+    cluster = tags.get(CLUSTER_TAG)
+    rank = tags.get(RANK_TAG)
+    if cluster and rank is None:
+        # Cluster nodes are launched together, so their launch indexes are their ranks.
+        rank = aws_instance.get("AmiLaunchIndex")
+        if name == cluster and rank is not None:
+            name = f"{cluster}-{rank}"
+
+    return InstanceRecord(
+        id=instance_id,
+        name=name,
+        ip=ip,
+        private_ip=aws_instance.get("PrivateIpAddress"),
+        type=aws_instance["InstanceType"],
+        launched_at=aws_instance["LaunchTime"],
+        state=aws_instance["State"]["Name"],
+        cluster=cluster,
+        rank=int(rank) if rank is not None else None,
+    )
+
+
+def find_instance(client, name: str) -> Optional[EC2Instance]:
+    for record in get_instance_records(client):
+        if record.name == name:
+            return record.to_model()
+
+
+def wait_for_instance(client, instance_id: str) -> EC2Instance:
+    """
+    Wait for an instance to be running, then return it.
+    """
+    return wait_for_instances(client, [instance_id])[0]
 
-    return instances
 
+def wait_for_instances(client, instance_ids: List[str]) -> List[EC2Instance]:
+    """
+    Wait for some instances to be running, then return them in the same order.
+    """
+    logger.info("Waiting for EC2 instances %s to start...", instance_ids)
+    waiter = client.get_waiter("instance_running")
+    waiter.wait(InstanceIds=instance_ids)
+    records = {r.id: r for r in get_instance_records(client)}
+    return [records[instance_id].to_model() for instance_id in instance_ids]
 
-def find_instance(client, name: str) -> EC2Instance:
-    instances = get_instances(client)
-    for instance in instances:
-        if instance.name == name:
-            return instance
+
+def match_instances(client, pattern: str) -> List[EC2Instance]:
+    """
+    Find running cjob instances by job name (without the "cjob-" prefix).
+    The name can be a glob pattern like "sweep-*", or "all" to match every instance.
+    """
+    records = [r for r in get_instance_records(client) if r.is_running()]
+    if pattern != "all":
+        records = [r for r in records if fnmatch(strip_job_prefix(r.name), pattern)]
+
+    return [r.to_model() for r in records]
 
 
 def cleanup_instances(client):
@@ -185,7 +425,7 @@ def cleanup_instances(client):
     Delete old EC2 instances so we don't pay for them
     """
     settings = get_settings()
-    instances = get_instances(client)
+    instances = get_instance_records(client)
     stop_instance_ids = []
     for i in instances:
         has_protected_name = any([i.name == i_name for i_name in settings.EC2_PROTECTED_INSTANCES])
@@ -205,16 +445,24 @@ def cleanup_instances(client):
     if stop_instance_ids:
         logger.info("Stopping instance ids %s", stop_instance_ids)
         client.terminate_instances(InstanceIds=stop_instance_ids)
+        for i in instances:
+            if i.id in stop_instance_ids:
+                ssh.close_connection(i)
     else:
         logger.info("No instances to stop.")
 
 
 def cleanup_volumes(client):
     """
-    Delete orphaned EC2 volumes so we don't pay for them
+    Delete orphaned EC2 volumes created by cjob so we don't pay for them
     """
-    volumes = client.describe_volumes()
-    volume_ids = [v["VolumeId"] for v in volumes["Volumes"] if v["State"] == "available"]
+    volumes = client.describe_volumes(
+        Filters=[
+            {"Name": f"tag:{MANAGED_TAG}", "Values": ["true"]},
+            {"Name": "status", "Values": ["available"]},
+        ]
+    )
+    volume_ids = [v["VolumeId"] for v in volumes["Volumes"]]
     for v_id in volume_ids:
         logger.info(f"Deleting orphaned volume {v_id}")
         client.delete_volume(VolumeId=v_id)
@@ -238,6 +486,135 @@ def get_latest_ubuntu_ami_id(client) -> str:
     return latest["ImageId"]
 
 
+def get_base_ami_id(client) -> str:
+    """
+    Returns EC2_AMI, or the latest Ubuntu AMI if it isn't set.
+    """
+    settings = get_settings()
+    if settings.EC2_AMI:
+        return settings.EC2_AMI
+
+    logger.info("No Amazon Machine Image provided, using latest Ubuntu image.")
+    ami_id = get_latest_ubuntu_ami_id(client)
+    logger.info(f"Found Ubuntu AMI {ami_id}")
+    return ami_id
+
+
+def get_ami_id(client) -> str:
+    """
+    Returns the AMI to launch job instances from: the AMI baked from EC2_SETUP_SCRIPT
+    if there is one, otherwise the base AMI.
+    """
+    settings = get_settings()
+    base_ami_id = get_base_ami_id(client)
+    if not settings.EC2_SETUP_SCRIPT:
+        return base_ami_id
+
+    bake_hash = get_bake_hash(settings.EC2_SETUP_SCRIPT, base_ami_id)
+    ami_id = find_baked_ami(client, bake_hash)
+    if ami_id:
+        logger.info(f"Using AMI {ami_id} baked from {settings.EC2_SETUP_SCRIPT}")
+        return ami_id
+
+    logger.warning(
+        "No AMI has been baked from %s yet, using base AMI %s. Run 'cjob bake' to build one.",
+        settings.EC2_SETUP_SCRIPT,
+        base_ami_id,
+    )
+    return base_ami_id
+
+
+def get_bake_hash(setup_path: str, base_ami_id: str) -> str:
+    """
+    Identifies an AMI baked from a setup script on top of a base AMI.
+    """
+    text = f"{cache.hash_path(setup_path)}:{base_ami_id}"
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def find_baked_ami(client, bake_hash: str) -> Optional[str]:
+    """
+    Returns the ID of the newest available AMI baked with the given hash, if there is one.
+    """
+    response = client.describe_images(
+        Owners=["self"],
+        Filters=[
+            {"Name": f"tag:{BAKE_HASH_TAG}", "Values": [bake_hash]},
+            {"Name": "state", "Values": ["available"]},
+        ],
+    )
+    images = sorted(response["Images"], key=lambda i: parser.parse(i["CreationDate"]))
+    return images[-1]["ImageId"] if images else None
+
+
+def find_dataset_snapshot(client, name: str) -> Optional[dict]:
+    """
+    Returns the newest completed EBS snapshot of a dataset, if there is one.
+    """
+    response = client.describe_snapshots(
+        OwnerIds=["self"],
+        Filters=[
+            {"Name": f"tag:{DATASET_TAG}", "Values": [name]},
+            {"Name": "status", "Values": ["completed"]},
+        ],
+    )
+    snapshots = sorted(response["Snapshots"], key=lambda s: s["StartTime"])
+    return snapshots[-1] if snapshots else None
+
+
+def get_dataset_label(name: str) -> str:
+    """
+    The filesystem label of a dataset's volume, which is used to mount it, because
+    device names on the instance don't always match the ones given to EC2.
+    """
+    # ext4 labels can be at most 16 characters long.
+    return "cjob-" + hashlib.sha256(name.encode()).hexdigest()[:11]
+
+
+def get_dataset_mappings(
+    client, datasets: List[str], used_device_names: List[str] = ()
+) -> List[dict]:
+    """
+    Build block device mappings which attach a volume restored from each dataset's snapshot.
+    """
+    device_names = [d for d in DATASET_DEVICE_NAMES if d not in used_device_names]
+    if len(datasets) > len(device_names):
+        raise ValueError(f"Cannot attach more than {len(device_names)} datasets.")
+
+    mappings = []
+    for name, device_name in zip(datasets, device_names):
+        snapshot = find_dataset_snapshot(client, name)
+        if not snapshot:
+            raise ValueError(f"Dataset {name} does not exist, use 'cjob dataset create' first.")
+
+        snapshot_id = snapshot["SnapshotId"]
+        logger.info(f"Attaching dataset {name} from snapshot {snapshot_id}")
+        ebs = {"SnapshotId": snapshot_id, "VolumeType": "gp3", "DeleteOnTermination": True}
+        mappings.append({"DeviceName": device_name, "Ebs": ebs})
+
+    return mappings
+
+
+def add_dataset_mounts(user_data: Optional[str], datasets: List[str]) -> str:
+    """
+    Add a cloud-config part to user data which mounts each dataset's volume by its label.
+    cloud-init mounts them before it runs the user data script.
+    """
+    mounts = []
+    for name in datasets:
+        label = get_dataset_label(name)
+        mounts.append([f"LABEL={label}", f"{DATASET_MOUNT_DIR}/{name}", "ext4", "defaults,nofail"])
+
+    cloud_config = "#cloud-config\n" + yaml.safe_dump({"mounts": mounts})
+    message = MIMEMultipart()
+    message.attach(MIMEText(cloud_config, "cloud-config"))
+    if user_data:
+        subtype = "cloud-config" if user_data.startswith("#cloud-config") else "x-shellscript"
+        message.attach(MIMEText(user_data, subtype))
+
+    return message.as_string()
+
+
 UBUNTU_OWNER_ID = "099720109477"
 DEFAULT_AMI_FILTERS = [
     {"Name": "name", "Values": ["ubuntu/images/*ubuntu-bionic-18.04-amd64-server-*"]},
@@ -248,6 +625,21 @@ DEFAULT_AMI_FILTERS = [
 ]
 
 JOB_PREFIX = "cjob-"
+# Let EC2 drop terminated and non-cjob instances, rather than paging through them.
+INSTANCE_FILTERS = [
+    {"Name": "tag:Name", "Values": [f"{JOB_PREFIX}*"]},
+    {
+        "Name": "instance-state-name",
+        "Values": [
+            EC2InstanceState.pending,
+            EC2InstanceState.running,
+            EC2InstanceState.stopping,
+            EC2InstanceState.stopped,
+            EC2InstanceState.shutting_down,
+            EC2InstanceState.rebooting,
+        ],
+    },
+]
 
 
 def add_job_prefix(s: str):
@@ -273,7 +665,7 @@ def _setup_private_key(client):
     just uses filenames and hope for the best.
     """
     settings = get_settings()
-    key_path = settings["EC2_KEY_FILE_PATH"]
+    key_path = settings.EC2_KEY_FILE_PATH
     key_name = [p for p in os.path.basename(key_path).split(".")][0]
 
     response = client.describe_key_pairs()
@@ -288,7 +680,7 @@ def _setup_private_key(client):
         logger.error(msg, key_name, key_path)
         sys.exit(-1)
     elif key_path_already_exists:
-        msg = "Found private key named %s in locally but it does not exist in AWS, use a different name or upload the key to AWS."
+        msg = "Found private key named %s locally at %s but it does not exist in AWS, use a different name or upload the key to AWS."
         logger.error(msg, key_name, key_path)
         sys.exit(-1)
     else:
@@ -301,6 +693,25 @@ def _setup_private_key(client):
     return key_name
 
 
+def _setup_placement_group(client) -> str:
+    """
+    Idempotently sets up a cluster placement group, which packs instances close together
+    within an availability zone.
+    """
+    settings = get_settings()
+    group_name = settings.EC2_PLACEMENT_GROUP or DEFAULT_PLACEMENT_GROUP
+    response = client.describe_placement_groups(
+        Filters=[{"Name": "group-name", "Values": [group_name]}]
+    )
+    if response["PlacementGroups"]:
+        logger.info(f"Found placement group {group_name}")
+    else:
+        logger.info(f"Creating cluster placement group {group_name}")
+        client.create_placement_group(GroupName=group_name, Strategy="cluster")
+
+    return group_name
+
+
 def _setup_default_security_group(client) -> str:
     """
     Idempotently sets up default security group
@@ -323,13 +734,15 @@ def _setup_default_security_group(client) -> str:
         logging.info(f"Found default security group {DEFAULT_SECURITY_GROUP}")
     else:
         logging.info(f"Creating default security group '{DEFAULT_SECURITY_GROUP}'")
-        security_group = client.create_security_group(
+        response = client.create_security_group(
             Description="Auto-generated security group for cjob tool.",
             GroupName=DEFAULT_SECURITY_GROUP,
             VpcId=vpc_id,
         )
+        response = client.describe_security_groups(GroupIds=[response["GroupId"]])
+        security_group = response["SecurityGroups"][0]
 
-    if not any([p["FromPort"] == 22 for p in security_group["IpPermissions"]]):
+    if not any([p.get("FromPort") == 22 for p in security_group["IpPermissions"]]):
         logger.info("Creating ingress rule for port 22 so we can SSH into the server.")
         client.authorize_security_group_ingress(
             GroupName=DEFAULT_SECURITY_GROUP,
@@ -343,6 +756,23 @@ def _setup_default_security_group(client) -> str:
             ],
         )
 
+    group_id = security_group["GroupId"]
+    ingress_rules = security_group["IpPermissions"]
+    group_pairs = [g for p in ingress_rules for g in p.get("UserIdGroupPairs", [])]
+    if not any([g["GroupId"] == group_id for g in group_pairs]):
+        logger.info("Creating ingress rule for all ports between instances in the group.")
+        client.authorize_security_group_ingress(
+            GroupId=group_id,
+            IpPermissions=[
+                {
+                    "IpProtocol": "-1",
+                    "UserIdGroupPairs": [
+                        {"GroupId": group_id, "Description": "Cluster traffic between nodes"}
+                    ],
+                },
+            ],
+        )
+
     if not any([p["IpProtocol"] == "-1" for p in security_group["IpPermissionsEgress"]]):
         logger.info("Creating egress rule for all ports so the server can talk to the internet.")
         client.authorize_security_group_egress(
@@ -0,0 +1,87 @@
+"""
+Cached Python environments, so that dependencies are only installed once per lockfile.
+
+On the instance, a virtualenv is built at ENV_DIR from a lockfile, packed into a tarball
+and stored in S3_BUCKET_NAME as envs/<hash>.tar.gz, where the hash covers the lockfile,
+the instance's Python version and its CPU architecture. Later instances download and
+unpack that tarball instead of installing anything. A new environment is only built
+when one of those things changes.
+"""
+import os
+from typing import List
+
+from .config import get_settings
+
+ENVS_KEY_PREFIX = "envs"
+# Environments are always restored to the same path, because virtualenvs can't be moved.
+ENV_DIR = "/opt/cjob/env"
+# Parallel S3 requests used to download an environment.
+DOWNLOAD_CONCURRENCY = 32
+
+ENV_TEMPLATE = """
+ENV_DIR={env_dir}
+LOCKFILE="{lockfile_path}"
+ENV_HASH=$( (sha256sum < "$LOCKFILE"; python3 --version; uname -m) | sha256sum | cut -d " " -f 1)
+ENV_URI=s3://{bucket}/{envs_prefix}/$ENV_HASH.tar.gz
+ENV_TARBALL=/tmp/cjob-env.tar.gz
+if command -v pigz > /dev/null; then GZIP_CMD=pigz; else GZIP_CMD=gzip; fi
+aws configure set default.s3.max_concurrent_requests {concurrency}
+if aws s3 cp --quiet "$ENV_URI" "$ENV_TARBALL"; then
+    echo "Restoring Python environment $ENV_HASH"
+    mkdir -p "$ENV_DIR"
+    $GZIP_CMD -dc "$ENV_TARBALL" | tar -x -C "$ENV_DIR"
+else
+    echo "Building Python environment $ENV_HASH"
+    apt-get update -q
+    apt-get install -y -q python3-venv
+    python3 -m venv "$ENV_DIR"
+    "$ENV_DIR/bin/pip" install -q --upgrade pip
+    {install}
+    tar -c -C "$ENV_DIR" . | $GZIP_CMD > "$ENV_TARBALL"
+    aws s3 cp --quiet "$ENV_TARBALL" "$ENV_URI"
+fi
+rm -f "$ENV_TARBALL"
+export PATH="$ENV_DIR/bin:$PATH"
+"""
+
+PIP_INSTALL = '"$ENV_DIR/bin/pip" install -q -r "$LOCKFILE"'
+# Poetry is installed in its own virtualenv, so that it doesn't end up in the job's one.
+POETRY_INSTALL = """python3 -m venv /tmp/cjob-poetry
+    /tmp/cjob-poetry/bin/pip install -q poetry
+    POETRY_CMD="/tmp/cjob-poetry/bin/poetry install --no-root --no-interaction"
+    (cd "$(dirname "$LOCKFILE")" && VIRTUAL_ENV="$ENV_DIR" $POETRY_CMD)"""
+
+
+def get_env_files(lockfile_path: str) -> List[str]:
+    """
+    Returns the files needed to build an environment from a lockfile.
+    A poetry.lock needs the pyproject.toml next to it, anything else is treated as
+    a pip requirements file.
+    """
+    if os.path.basename(lockfile_path) != "poetry.lock":
+        return [lockfile_path]
+
+    pyproject_path = os.path.join(os.path.dirname(lockfile_path), "pyproject.toml")
+    if not os.path.exists(pyproject_path):
+        raise ValueError(f"Could not find pyproject.toml next to {lockfile_path}")
+
+    return [lockfile_path, pyproject_path]
+
+
+def build_env_script(lockfile_path: str) -> str:
+    """
+    Build shell commands which restore or build the environment for a lockfile on an
+    instance, then put it on the PATH. The lockfile path is on the instance, and is
+    double quoted so it may use shell variables.
+    The instance needs the AWS CLI and read/write access to S3_BUCKET_NAME.
+    """
+    settings = get_settings()
+    is_poetry = os.path.basename(lockfile_path) == "poetry.lock"
+    return ENV_TEMPLATE.format(
+        env_dir=ENV_DIR,
+        lockfile_path=lockfile_path,
+        bucket=settings.S3_BUCKET_NAME,
+        envs_prefix=ENVS_KEY_PREFIX,
+        concurrency=DOWNLOAD_CONCURRENCY,
+        install=POETRY_INSTALL if is_poetry else PIP_INSTALL,
+    )
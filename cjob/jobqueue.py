@@ -0,0 +1,426 @@
+"""
+A queue of small jobs which are packed onto a capped fleet of EC2 instances.
+
+Jobs are stored in a local SQLite database. The scheduler launches at most
+max_instances instances of EC2_INSTANCE_TYPE, runs as many jobs on each one as fit
+its vCPUs and memory, reuses instances as jobs finish, and terminates instances
+which have been idle for a grace period.
+
+Instances are tagged with the queue's ID, so that a scheduler restarted on the same
+database reuses the instances its predecessor launched, and only those.
+"""
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from typing import List, Dict, Tuple, Optional
+
+from pydantic import BaseModel
+
+from . import ec2, ssh
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_PATH = os.path.join(".cjob", "queue.db")
+DEFAULT_IDLE_GRACE_SECONDS = 300
+DEFAULT_POLL_SECONDS = 10
+REPORT_INTERVAL_SECONDS = 60
+# Pool instances are named cjob-<prefix>-<number>.
+POOL_NAME_PREFIX = "pool"
+# Memory left for the operating system and SSH sessions on each instance.
+MIN_RESERVED_MEMORY_MB = 512
+RESERVED_MEMORY_FRACTION = 0.1
+# Stop launching instances after this many failed launches in a row.
+MAX_BOOT_ATTEMPTS = 3
+MAX_BOOT_BACKOFF_SECONDS = 300
+
+
+class JobState:
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+class QueuedJob(BaseModel):
+    id: int
+    command: str
+    cpus: float
+    memory_mb: int
+    state: str
+    instance: Optional[str]  # Name of the instance running the job.
+    exit_code: Optional[int]
+    created_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+
+
+class JobQueue:
+    """
+    Stores queued jobs in a local SQLite database.
+    """
+
+    def __init__(self, path: str = DEFAULT_QUEUE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    command TEXT NOT NULL,
+                    cpus REAL NOT NULL,
+                    memory_mb INTEGER NOT NULL,
+                    state TEXT NOT NULL,
+                    instance TEXT,
+                    exit_code INTEGER,
+                    created_at TIMESTAMP NOT NULL,
+                    started_at TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+                """
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            self._db.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('queue_id', ?)",
+                (uuid.uuid4().hex,),
+            )
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'queue_id'").fetchone()
+            self.queue_id = row["value"]
+
+    def add(self, command: str, cpus: float = 1, memory_mb: int = 1024) -> int:
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO jobs (command, cpus, memory_mb, state, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (command, cpus, memory_mb, JobState.queued, datetime.utcnow()),
+            )
+            return cursor.lastrowid
+
+    def get_jobs(self, state: Optional[str] = None) -> List[QueuedJob]:
+        with self._lock:
+            if state:
+                rows = self._db.execute("SELECT * FROM jobs WHERE state = ? ORDER BY id", (state,))
+            else:
+                rows = self._db.execute("SELECT * FROM jobs ORDER BY id")
+
+            return [QueuedJob(**dict(row)) for row in rows.fetchall()]
+
+    def mark_running(self, job_id: int, instance_name: str):
+        self._update(
+            job_id, state=JobState.running, instance=instance_name, started_at=datetime.utcnow()
+        )
+
+    def mark_finished(self, job_id: int, exit_code: Optional[int]):
+        state = JobState.succeeded if exit_code == 0 else JobState.failed
+        self._update(job_id, state=state, exit_code=exit_code, finished_at=datetime.utcnow())
+
+    def requeue(self, job_id: int):
+        self._update(job_id, state=JobState.queued, instance=None, started_at=None)
+
+    def _update(self, job_id: int, **fields):
+        columns = ", ".join(f"{k} = ?" for k in fields)
+        with self._lock, self._db:
+            self._db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+
+def get_instance_capacity(client, instance_type: str) -> Tuple[float, int]:
+    """
+    Returns the (vCPUs, memory in MB) of an EC2 instance type which jobs can use,
+    leaving some memory for the operating system.
+    """
+    response = client.describe_instance_types(InstanceTypes=[instance_type])
+    info = response["InstanceTypes"][0]
+    memory_mb = info["MemoryInfo"]["SizeInMiB"]
+    reserved_mb = max(MIN_RESERVED_MEMORY_MB, int(memory_mb * RESERVED_MEMORY_FRACTION))
+    return info["VCpuInfo"]["DefaultVCpus"], memory_mb - reserved_mb
+
+
+def pack_jobs(
+    jobs: List[QueuedJob], free: Dict[str, Tuple[float, int]]
+) -> Tuple[Dict[int, str], List[QueuedJob]]:
+    """
+    Assign jobs to instances using first-fit decreasing bin packing.
+    Takes the free (vCPUs, memory MB) of each instance, by name.
+    Returns a mapping of job ID to instance name, and the jobs which didn't fit.
+    """
+    free = {name: list(capacity) for name, capacity in free.items()}
+    assignments = {}
+    unplaced = []
+    for job in sorted(jobs, key=lambda j: (j.cpus, j.memory_mb), reverse=True):
+        for name, (cpus, memory_mb) in free.items():
+            if job.cpus <= cpus and job.memory_mb <= memory_mb:
+                assignments[job.id] = name
+                free[name][0] -= job.cpus
+                free[name][1] -= job.memory_mb
+                break
+        else:
+            unplaced.append(job)
+
+    return assignments, unplaced
+
+
+class PoolInstance:
+    """An instance owned by the scheduler"""
+
+    def __init__(self, name: str, capacity: Tuple[float, int]):
+        self.name = name
+        self.capacity = capacity
+        self.instance = None  # Set once the instance accepts SSH connections.
+        self.jobs = {}  # Running jobs, by ID.
+        self.idle_since = time.time()
+
+    def is_ready(self):
+        return self.instance is not None
+
+    def free(self) -> Tuple[float, int]:
+        cpus = self.capacity[0] - sum(j.cpus for j in self.jobs.values())
+        memory_mb = self.capacity[1] - sum(j.memory_mb for j in self.jobs.values())
+        return cpus, memory_mb
+
+
+class Scheduler:
+    """
+    Runs queued jobs on a capped pool of EC2 instances.
+    """
+
+    def __init__(
+        self,
+        client,
+        queue: JobQueue,
+        max_instances: int,
+        idle_grace_seconds: float = DEFAULT_IDLE_GRACE_SECONDS,
+        poll_seconds: float = DEFAULT_POLL_SECONDS,
+        name_prefix: str = POOL_NAME_PREFIX,
+    ):
+        settings = get_settings()
+        self.client = client
+        self.queue = queue
+        self.max_instances = max_instances
+        self.idle_grace_seconds = idle_grace_seconds
+        self.poll_seconds = poll_seconds
+        self.name_prefix = name_prefix
+        self.capacity = get_instance_capacity(client, settings.EC2_INSTANCE_TYPE)
+        self.pool = {}  # PoolInstances, by name.
+        self.started_at = time.time()
+        self.finished_count = 0
+        self._instance_count = 0
+        self._boot_failures = 0  # Failed launches in a row.
+        self._launch_after = 0  # Don't launch again before this time, after a failed launch.
+        self._boot_threads = []
+        self._lock = threading.Lock()
+
+    def run(self):
+        """
+        Run until every queued job has finished, then tear down the pool.
+        """
+        # Jobs left running by a scheduler which died can't be tracked any more.
+        for job in self.queue.get_jobs(JobState.running):
+            logger.info("Requeuing job %s which was left running", job.id)
+            self.queue.requeue(job.id)
+
+        self._adopt_instances()
+        last_report = time.time()
+        try:
+            while True:
+                self.step()
+                if time.time() - last_report > REPORT_INTERVAL_SECONDS:
+                    logger.info(self.report())
+                    last_report = time.time()
+
+                with self._lock:
+                    is_busy = any(p.jobs for p in self.pool.values())
+
+                if not is_busy and not self.queue.get_jobs(JobState.queued):
+                    break
+
+                time.sleep(self.poll_seconds)
+        finally:
+            # Let launches finish, so that no new instances are left behind.
+            for thread in self._boot_threads:
+                thread.join()
+
+            with self._lock:
+                names = list(self.pool.keys())
+
+            for name in names:
+                self._teardown(name)
+
+        logger.info(self.report())
+
+    def step(self):
+        """
+        Start queued jobs on free instances, launch more instances if needed,
+        and tear down instances which have been idle for too long.
+        """
+        queued = self.queue.get_jobs(JobState.queued)
+        too_big = [j for j in queued if j.cpus > self.capacity[0] or j.memory_mb > self.capacity[1]]
+        for job in too_big:
+            logger.error("Job %s does not fit on a %s instance", job.id, self._instance_type())
+            self.queue.mark_finished(job.id, None)
+
+        too_big_ids = {j.id for j in too_big}
+        queued = [j for j in queued if j.id not in too_big_ids]
+        with self._lock:
+            free = {p.name: p.free() for p in self.pool.values() if p.is_ready()}
+            assignments, unplaced = pack_jobs(queued, free)
+            jobs_by_id = {j.id: j for j in queued}
+            for job_id, name in assignments.items():
+                self._start_job(jobs_by_id[job_id], self.pool[name])
+
+            # Jobs which will run on instances that are still booting don't need new instances.
+            booting = {p.name: p.capacity for p in self.pool.values() if not p.is_ready()}
+            _, unplaced = pack_jobs(unplaced, booting)
+            if self._boot_failures >= MAX_BOOT_ATTEMPTS:
+                if not self.pool:
+                    # No instance will ever run these jobs.
+                    for job in unplaced:
+                        logger.error("Job %s failed, instances could not be launched", job.id)
+                        self.queue.mark_finished(job.id, None)
+            elif time.time() >= self._launch_after:
+                num_new = self._count_new_instances(unplaced)
+                num_new = min(num_new, self.max_instances - len(self.pool))
+                for _ in range(num_new):
+                    self._launch()
+
+            now = time.time()
+            idle = [
+                p.name
+                for p in self.pool.values()
+                if p.is_ready() and not p.jobs and now - p.idle_since > self.idle_grace_seconds
+            ]
+
+        for name in idle:
+            logger.info("Instance %s has been idle for too long", name)
+            self._teardown(name)
+
+    def report(self) -> str:
+        """Summarise queue depth, fleet utilization and throughput"""
+        queued = len(self.queue.get_jobs(JobState.queued))
+        with self._lock:
+            ready = [p for p in self.pool.values() if p.is_ready()]
+            running = sum(len(p.jobs) for p in ready)
+            total_cpus = sum(p.capacity[0] for p in ready)
+            used_cpus = sum(p.capacity[0] - p.free()[0] for p in ready)
+            finished = self.finished_count
+
+        utilization = 100 * used_cpus / total_cpus if total_cpus else 0
+        hours = (time.time() - self.started_at) / 3600
+        throughput = finished / hours if hours else 0
+        return (
+            f"Queued: {queued}, running: {running}, instances: {len(self.pool)}, "
+            f"CPU utilization: {utilization:.0f}%, throughput: {throughput:.1f} jobs/hour"
+        )
+
+    def _count_new_instances(self, jobs: List[QueuedJob]) -> int:
+        """How many new instances are needed to fit these jobs"""
+        num_instances = 0
+        while jobs:
+            num_instances += 1
+            _, jobs = pack_jobs(jobs, {"new": self.capacity})
+
+        return num_instances
+
+    def _start_job(self, job: QueuedJob, pool_instance: PoolInstance):
+        pool_instance.jobs[job.id] = job
+        self.queue.mark_running(job.id, pool_instance.name)
+        threading.Thread(target=self._run_job, args=(job, pool_instance), daemon=True).start()
+
+    def _run_job(self, job: QueuedJob, pool_instance: PoolInstance):
+        logger.info("Running job %s on %s: %s", job.id, pool_instance.name, job.command)
+        prefix = f"[{pool_instance.name} job {job.id}]"
+        try:
+            exit_code = ssh.run(
+                pool_instance.instance,
+                job.command,
+                stdout=lambda line: print(prefix, line, flush=True),
+                stderr=lambda line: print(prefix, line, flush=True),
+            )
+        except Exception:
+            logger.exception("Could not run job %s", job.id)
+            exit_code = None
+
+        self.queue.mark_finished(job.id, exit_code)
+        logger.info("Job %s finished with exit code %s", job.id, exit_code)
+        with self._lock:
+            del pool_instance.jobs[job.id]
+            self.finished_count += 1
+            if not pool_instance.jobs:
+                pool_instance.idle_since = time.time()
+
+    def _adopt_instances(self):
+        """Reuse pool instances left running by a previous scheduler of this queue"""
+        queue_filter = {"Name": f"tag:{ec2.QUEUE_TAG}", "Values": [self.queue.queue_id]}
+        for record in ec2.get_instance_records(self.client, [queue_filter]):
+            if not record.is_running():
+                continue
+
+            instance = record.to_model()
+            suffix = instance.name.split("-")[-1]
+            if suffix.isdigit():
+                self._instance_count = max(self._instance_count, int(suffix))
+
+            logger.info("Reusing instance %s", instance.name)
+            pool_instance = PoolInstance(instance.name, self.capacity)
+            pool_instance.instance = instance
+            self.pool[instance.name] = pool_instance
+
+    def _launch(self):
+        self._instance_count += 1
+        name = f"{self.name_prefix}-{self._instance_count}"
+        job_id = ec2.add_job_prefix(name)
+        pool_instance = PoolInstance(job_id, self.capacity)
+        self.pool[job_id] = pool_instance
+        thread = threading.Thread(target=self._boot, args=(pool_instance,), daemon=True)
+        self._boot_threads.append(thread)
+        thread.start()
+
+    def _boot(self, pool_instance: PoolInstance):
+        try:
+            tags = [{"Key": ec2.QUEUE_TAG, "Value": self.queue.queue_id}]
+            instance_id = ec2.create_job(self.client, pool_instance.name, tags=tags)
+            instance = ec2.wait_for_instance(self.client, instance_id)
+            if not ssh.wait_for_ssh(instance):
+                raise TimeoutError(f"Could not SSH into {pool_instance.name}")
+        except Exception:
+            logger.exception("Could not launch instance %s", pool_instance.name)
+            with self._lock:
+                del self.pool[pool_instance.name]
+                self._boot_failures += 1
+                backoff = self.poll_seconds * 2 ** self._boot_failures
+                self._launch_after = time.time() + min(backoff, MAX_BOOT_BACKOFF_SECONDS)
+
+            ec2.stop_job(self.client, pool_instance.name)
+            return
+
+        with self._lock:
+            is_wanted = self.pool.get(pool_instance.name) is pool_instance
+            self._boot_failures = 0
+            if is_wanted:
+                pool_instance.instance = instance
+                pool_instance.idle_since = time.time()
+
+        if is_wanted:
+            logger.info("Instance %s is ready", pool_instance.name)
+        else:
+            # The pool was torn down while this instance was booting.
+            ec2.stop_job(self.client, pool_instance.name)
+
+    def _teardown(self, name: str):
+        with self._lock:
+            self.pool.pop(name, None)
+
+        ec2.stop_job(self.client, name)
+
+    def _instance_type(self):
+        return get_settings().EC2_INSTANCE_TYPE
@@ -0,0 +1,185 @@
+import gzip
+import shlex
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Iterator, Optional, TYPE_CHECKING
+
+from . import ssh
+from .s3 import list_s3_keys
+from .config import get_settings
+
+if TYPE_CHECKING:
+    from .ec2 import EC2Instance
+
+logger = logging.getLogger(__name__)
+
+LOGS_KEY_PREFIX = "logs"
+# The whole log, uploaded by a submitted job's bootstrap script when it finishes.
+COMPLETE_LOG_NAME = "complete.log.gz"
+# The log written by the instance's user-data bootstrap script.
+DEFAULT_LOG_PATH = "/var/log/cloud-init-output.log"
+
+# Log chunks are uploaded once they reach this size or age, whichever comes first.
+CHUNK_MAX_BYTES = 1024 * 1024
+CHUNK_MAX_SECONDS = 30
+
+
+class LogArchiver:
+    """
+    Buffers log lines and uploads them to S3 as numbered, gzipped chunks,
+    bounded by size and by age.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        key_prefix: str,
+        max_bytes: int = CHUNK_MAX_BYTES,
+        max_seconds: float = CHUNK_MAX_SECONDS,
+    ):
+        self.s3_client = s3_client
+        self.key_prefix = key_prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self._lines = []
+        self._size = 0
+        self._started_at = None
+        self._chunk_idx = 0
+        self._lock = threading.Lock()
+
+    def write(self, line: str):
+        with self._lock:
+            if not self._lines:
+                self._started_at = datetime.utcnow()
+
+            self._lines.append(line + "\n")
+            self._size += len(line) + 1
+            is_full = self._size >= self.max_bytes
+
+        if is_full:
+            self.flush()
+
+    def is_stale(self) -> bool:
+        with self._lock:
+            if not self._lines:
+                return False
+
+            age = (datetime.utcnow() - self._started_at).total_seconds()
+            return age >= self.max_seconds
+
+    def flush(self):
+        """Upload whatever has been written so far"""
+        with self._lock:
+            if not self._lines:
+                return
+
+            text = "".join(self._lines)
+            self._lines = []
+            self._size = 0
+            self._chunk_idx += 1
+            key = f"{self.key_prefix}/{self._chunk_idx:06d}.log.gz"
+
+        settings = get_settings()
+        try:
+            self.s3_client.put_object(
+                Bucket=settings.S3_BUCKET_NAME,
+                Key=key,
+                Body=gzip.compress(text.encode()),
+                ContentType="application/gzip",
+            )
+        except Exception:
+            # Don't interrupt the live log stream if archiving fails.
+            logger.exception("Could not upload log chunk %s", key)
+
+
+class _Flusher:
+    """
+    A single background thread which uploads every archiver's stale chunks,
+    so that quiet logs still get archived.
+    """
+
+    def __init__(self, archivers: List[LogArchiver], interval: float):
+        self.archivers = archivers
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        for archiver in self.archivers:
+            archiver.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for archiver in self.archivers:
+                if archiver.is_stale():
+                    archiver.flush()
+
+
+def stream_logs(
+    s3_client,
+    instances: List["EC2Instance"],
+    log_path: str = DEFAULT_LOG_PATH,
+    ssh_key_path: Optional[str] = None,
+    max_bytes: int = CHUNK_MAX_BYTES,
+    max_seconds: float = CHUNK_MAX_SECONDS,
+):
+    """
+    Follow a log file on each instance, printing new lines as they arrive and
+    archiving them to S3, under logs/<job name>/<start time>/.
+    Each run archives the whole log from its first line.
+    Runs until the instances go away or the user interrupts.
+    """
+    ssh_key_path = ssh_key_path or get_settings().EC2_KEY_FILE_PATH
+    started_at = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    archivers = [
+        LogArchiver(s3_client, f"{LOGS_KEY_PREFIX}/{i.name}/{started_at}", max_bytes, max_seconds)
+        for i in instances
+    ]
+    print_lock = threading.Lock()
+
+    def follow(instance, archiver):
+        def on_line(line: str):
+            archiver.write(line)
+            with print_lock:
+                print(f"[{instance.name}] {line}", flush=True)
+
+        cmd = f"tail -n +1 -F {shlex.quote(log_path)}"
+        return ssh.run(instance, cmd, ssh_key_path, stdout=on_line, stderr=on_line)
+
+    with _Flusher(archivers, interval=min(max_seconds, 5)):
+        with ThreadPoolExecutor(max_workers=max(1, len(instances))) as pool:
+            list(pool.map(follow, instances, archivers))
+
+
+def get_complete_log_key(job_id: str) -> str:
+    return f"{LOGS_KEY_PREFIX}/{job_id}/{COMPLETE_LOG_NAME}"
+
+
+def read_logs(s3_client, job_id: str) -> Iterator[str]:
+    """
+    Yield the archived log lines for a job, oldest first.
+    Reads the complete log uploaded when the job finished if there is one,
+    or else the latest streamed run, since every run starts from the top of the log.
+    """
+    settings = get_settings()
+    keys = list_s3_keys(s3_client, f"{LOGS_KEY_PREFIX}/{job_id}/", ".log.gz")
+    complete_key = get_complete_log_key(job_id)
+    if complete_key in keys:
+        keys = [complete_key]
+    elif keys:
+        # Keys look like logs/<job name>/<start time>/<chunk>.log.gz
+        latest_run = max(key.split("/")[-2] for key in keys)
+        keys = [key for key in keys if key.split("/")[-2] == latest_run]
+
+    for key in sorted(keys):
+        response = s3_client.get_object(Bucket=settings.S3_BUCKET_NAME, Key=key)
+        text = gzip.decompress(response["Body"].read()).decode()
+        yield from text.splitlines()
@@ -0,0 +1,223 @@
+"""
+Resource utilization of submitted jobs, for right-sizing their instances (see recommend).
+
+While a submitted job's script runs, a small sampler on the instance reads /proc every
+SAMPLE_SECONDS and appends CPU, memory, disk and network usage to a CSV file.
+It's saved next to the job's other files in S3_BUCKET_NAME:
+
+    jobs/<job id>/record.json   The instance type and script hash, written on submit
+    jobs/<job id>/metrics.csv   Utilization samples, written when the job finishes
+"""
+import io
+import csv
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel
+from botocore.exceptions import ClientError
+
+from .s3 import list_s3_keys
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_SECONDS = 10
+METRICS_PATH = "/var/log/cjob-metrics.csv"
+METRICS_COLUMNS = [
+    "time",
+    "cpu_percent",
+    "memory_bytes",
+    "disk_used_bytes",
+    "disk_read_bytes_per_second",
+    "disk_write_bytes_per_second",
+    "net_rx_bytes_per_second",
+    "net_tx_bytes_per_second",
+]
+
+# Runs on the instance with only the standard library, reading from /proc,
+# so that sampling costs next to nothing.
+SAMPLER_SCRIPT = """
+import os
+import sys
+import time
+
+
+def read_cpu():
+    with open("/proc/stat") as f:
+        values = [int(v) for v in f.readline().split()[1:]]
+
+    # Time spent idle or waiting for IO.
+    return sum(values), values[3] + values[4]
+
+
+def read_memory():
+    info = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            info[key] = int(value.split()[0]) * 1024
+
+    return info["MemTotal"] - info["MemAvailable"]
+
+
+def read_disk_used():
+    stat = os.statvfs("/")
+    return (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+
+def read_disk_io():
+    read_bytes = write_bytes = 0
+    with open("/proc/diskstats") as f:
+        for line in f:
+            fields = line.split()
+            name = fields[2]
+            # Only count whole disks, since partitions are included in their disk's stats.
+            if os.path.exists(f"/sys/block/{name}") and not name.startswith(("loop", "ram")):
+                read_bytes += int(fields[5]) * 512
+                write_bytes += int(fields[9]) * 512
+
+    return read_bytes, write_bytes
+
+
+def read_net_io():
+    rx_bytes = tx_bytes = 0
+    with open("/proc/net/dev") as f:
+        for line in f.readlines()[2:]:
+            name, data = line.split(":", 1)
+            if name.strip() != "lo":
+                fields = data.split()
+                rx_bytes += int(fields[0])
+                tx_bytes += int(fields[8])
+
+    return rx_bytes, tx_bytes
+
+
+def rate(now, before, seconds):
+    return [round((n - b) / seconds) for n, b in zip(now, before)]
+
+
+path, interval = sys.argv[1], float(sys.argv[2])
+with open(path, "w") as f:
+    f.write(sys.argv[3] + "\\n")
+
+last_time, last_cpu, last_disk, last_net = time.time(), read_cpu(), read_disk_io(), read_net_io()
+while True:
+    time.sleep(interval)
+    now, cpu, disk, net = time.time(), read_cpu(), read_disk_io(), read_net_io()
+    total, idle = cpu[0] - last_cpu[0], cpu[1] - last_cpu[1]
+    cpu_percent = round(100 * (total - idle) / total, 1) if total else 0
+    seconds = now - last_time
+    row = [round(now), cpu_percent, read_memory(), read_disk_used()]
+    row += rate(disk, last_disk, seconds) + rate(net, last_net, seconds)
+    with open(path, "a") as f:
+        f.write(",".join(str(v) for v in row) + "\\n")
+
+    last_time, last_cpu, last_disk, last_net = now, cpu, disk, net
+"""
+
+START_SAMPLER_TEMPLATE = """
+cat > /tmp/cjob-sampler.py << 'CJOB_SAMPLER_EOF'
+{script}
+CJOB_SAMPLER_EOF
+nohup python3 /tmp/cjob-sampler.py {path} {interval} {header} > /dev/null 2>&1 &
+"""
+
+
+class JobRecord(BaseModel):
+    job_id: str
+    instance_type: str
+    script_hash: str  # Jobs running the same script are treated as similar.
+    submitted_at: datetime
+
+
+class JobUsage(BaseModel):
+    job_id: str
+    instance_type: str
+    runtime_seconds: float
+    peak_cpu_percent: float
+    mean_cpu_percent: float
+    peak_memory_bytes: int
+    peak_disk_used_bytes: int
+    peak_disk_bytes_per_second: int
+    peak_net_bytes_per_second: int
+
+
+def build_sampler_script(path: str = METRICS_PATH, interval: float = SAMPLE_SECONDS) -> str:
+    """
+    Build shell commands which start sampling utilization in the background on an instance.
+    """
+    return START_SAMPLER_TEMPLATE.format(
+        script=SAMPLER_SCRIPT.strip(),
+        path=path,
+        interval=interval,
+        header=",".join(METRICS_COLUMNS),
+    )
+
+
+def write_job_record(s3_client, job_key: str, record: JobRecord):
+    settings = get_settings()
+    s3_client.put_object(
+        Bucket=settings.S3_BUCKET_NAME,
+        Key=f"{job_key}/record.json",
+        Body=record.json().encode(),
+        ContentType="application/json",
+    )
+
+
+def get_job_records(s3_client, jobs_key_prefix: str) -> List[JobRecord]:
+    """
+    Returns the records of every submitted job, oldest first.
+    """
+    settings = get_settings()
+    records = []
+    for key in list_s3_keys(s3_client, f"{jobs_key_prefix}/", "/record.json"):
+        response = s3_client.get_object(Bucket=settings.S3_BUCKET_NAME, Key=key)
+        records.append(JobRecord.parse_raw(response["Body"].read()))
+
+    return sorted(records, key=lambda r: r.submitted_at)
+
+
+def read_metrics(s3_client, job_key: str) -> List[dict]:
+    """
+    Returns a finished job's utilization samples, or an empty list if it has none.
+    """
+    settings = get_settings()
+    try:
+        response = s3_client.get_object(
+            Bucket=settings.S3_BUCKET_NAME, Key=f"{job_key}/metrics.csv"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return []
+
+        raise
+
+    reader = csv.DictReader(io.StringIO(response["Body"].read().decode()))
+    return [{key: float(value) for key, value in row.items()} for row in reader]
+
+
+def summarize_usage(record: JobRecord, samples: List[dict]) -> Optional[JobUsage]:
+    """
+    Summarize a job's peak and mean utilization, or None if it has no samples.
+    """
+    if not samples:
+        return None
+
+    # The first sample covers the time since the sampler started.
+    runtime_seconds = samples[-1]["time"] - samples[0]["time"] + SAMPLE_SECONDS
+    return JobUsage(
+        job_id=record.job_id,
+        instance_type=record.instance_type,
+        runtime_seconds=runtime_seconds,
+        peak_cpu_percent=max(s["cpu_percent"] for s in samples),
+        mean_cpu_percent=sum(s["cpu_percent"] for s in samples) / len(samples),
+        peak_memory_bytes=max(s["memory_bytes"] for s in samples),
+        peak_disk_used_bytes=max(s["disk_used_bytes"] for s in samples),
+        peak_disk_bytes_per_second=max(
+            s["disk_read_bytes_per_second"] + s["disk_write_bytes_per_second"] for s in samples
+        ),
+        peak_net_bytes_per_second=max(
+            s["net_rx_bytes_per_second"] + s["net_tx_bytes_per_second"] for s in samples
+        ),
+    )
@@ -0,0 +1,263 @@
+"""
+Right-sizing: suggest the cheapest instance type which would have fit the peak
+utilization of similar past jobs (see the metrics module).
+
+Peak disk usage isn't used, since the root volume's size is set separately
+from the instance type.
+"""
+import re
+import json
+import math
+import logging
+from datetime import datetime
+from typing import List, Dict, Optional, Tuple
+
+from pydantic import BaseModel
+
+from . import metrics, submit
+from .config import get_settings
+from .metrics import JobUsage
+
+logger = logging.getLogger(__name__)
+
+# Spare capacity to leave above the peak utilization.
+DEFAULT_HEADROOM = 1.2
+# Only the smallest candidates that fit are priced, to limit pricing API calls.
+MAX_PRICED_CANDIDATES = 30
+# Matches network performance descriptions like "10 Gigabit" or "Up to 12.5 Gigabit".
+NETWORK_PERFORMANCE_PATTERN = re.compile(r"([0-9.]+) Gigabit")
+
+
+class InstanceTypeInfo(BaseModel):
+    name: str
+    vcpus: int
+    memory_mib: int
+    architectures: List[str]
+    is_burstable: bool
+    is_current_generation: bool = True
+    network_gbps: Optional[float]  # Baseline network bandwidth, if known.
+    ebs_mbps: Optional[float]  # Baseline EBS bandwidth, if known.
+
+
+class Recommendation(BaseModel):
+    instance_type: str
+    vcpus: int
+    memory_mib: int
+    price_per_hour: float
+    projected_runtime_seconds: float
+    projected_cost: float
+    cost_change_percent: float  # Compared to the current instance type.
+
+
+def get_instance_types(client) -> Dict[str, InstanceTypeInfo]:
+    """
+    Returns every instance type in the region, including previous generation types,
+    which past jobs may have run on.
+    """
+    instance_types = {}
+    paginator = client.get_paginator("describe_instance_types")
+    for page in paginator.paginate():
+        for info in page["InstanceTypes"]:
+            name = info["InstanceType"]
+            ebs_info = info.get("EbsInfo", {}).get("EbsOptimizedInfo", {})
+            instance_types[name] = InstanceTypeInfo(
+                name=name,
+                vcpus=info["VCpuInfo"]["DefaultVCpus"],
+                memory_mib=info["MemoryInfo"]["SizeInMiB"],
+                architectures=info["ProcessorInfo"]["SupportedArchitectures"],
+                is_burstable=info.get("BurstablePerformanceSupported", False),
+                is_current_generation=info.get("CurrentGeneration", True),
+                network_gbps=_get_network_gbps(info.get("NetworkInfo", {})),
+                ebs_mbps=ebs_info.get("BaselineBandwidthInMbps"),
+            )
+
+    return instance_types
+
+
+def get_prices(ec2_client, pricing_client, instance_types: List[str]) -> Dict[str, float]:
+    """
+    Returns the hourly price of some instance types in USD, for Linux instances.
+    Uses the current spot price if EC2_USE_SPOT is set, or else the on-demand price.
+    Instance types without a price are left out.
+    """
+    settings = get_settings()
+    if settings.EC2_USE_SPOT:
+        return _get_spot_prices(ec2_client, instance_types)
+
+    prices = {}
+    for instance_type in instance_types:
+        price = _get_on_demand_price(pricing_client, settings.AWS_REGION, instance_type)
+        if price is not None:
+            prices[instance_type] = price
+
+    return prices
+
+
+def find_candidates(
+    usages: List[JobUsage],
+    instance_types: Dict[str, InstanceTypeInfo],
+    current_type: str,
+    headroom: float = DEFAULT_HEADROOM,
+) -> List[InstanceTypeInfo]:
+    """
+    Find the current generation instance types which would have fit the peak CPU, memory,
+    disk throughput and network throughput of every job, with some headroom, smallest first.
+    Only types with the same CPU architecture are considered, since AMIs are built
+    for one architecture. Burstable types are left out, because they can't sustain
+    their full CPU capacity. Types with unknown bandwidth aren't ruled out by it.
+    """
+    current = _get_instance_type(instance_types, current_type)
+    peak_cores = max(u.peak_cpu_percent / 100 * _get_vcpus(u, instance_types) for u in usages)
+    peak_memory_mib = max(u.peak_memory_bytes for u in usages) / 1024 ** 2
+    peak_ebs_mbps = max(u.peak_disk_bytes_per_second for u in usages) * 8 / 1000 ** 2
+    peak_network_gbps = max(u.peak_net_bytes_per_second for u in usages) * 8 / 1000 ** 3
+    min_vcpus = max(1, math.ceil(peak_cores * headroom))
+    min_memory_mib = peak_memory_mib * headroom
+    candidates = [
+        t
+        for t in instance_types.values()
+        if t.vcpus >= min_vcpus
+        and t.memory_mib >= min_memory_mib
+        and (t.ebs_mbps is None or t.ebs_mbps >= peak_ebs_mbps * headroom)
+        and (t.network_gbps is None or t.network_gbps >= peak_network_gbps * headroom)
+        and t.is_current_generation
+        and not t.is_burstable
+        and set(t.architectures) & set(current.architectures)
+    ]
+    return sorted(candidates, key=lambda t: (t.vcpus, t.memory_mib, t.name))
+
+
+def recommend(
+    usages: List[JobUsage],
+    instance_types: Dict[str, InstanceTypeInfo],
+    prices: Dict[str, float],
+    current_type: str,
+    headroom: float = DEFAULT_HEADROOM,
+) -> List[Recommendation]:
+    """
+    Rank the instance types which fit past jobs by their projected cost per job, cheapest first.
+    Runtime is assumed to scale with the number of vCPUs for CPU bound jobs,
+    using the jobs' mean CPU usage, and otherwise to stay the same.
+    """
+    current = _get_instance_type(instance_types, current_type)
+    runtime_seconds = sum(u.runtime_seconds for u in usages) / len(usages)
+    mean_cores = sum(u.mean_cpu_percent / 100 * _get_vcpus(u, instance_types) for u in usages)
+    mean_cores /= len(usages)
+    current_cost = prices[current_type] * runtime_seconds / 3600
+
+    recommendations = []
+    for t in find_candidates(usages, instance_types, current_type, headroom):
+        if t.name not in prices:
+            continue
+
+        slowdown = max(1, mean_cores / t.vcpus) / max(1, mean_cores / current.vcpus)
+        projected_runtime_seconds = runtime_seconds * slowdown
+        projected_cost = prices[t.name] * projected_runtime_seconds / 3600
+        recommendations.append(
+            Recommendation(
+                instance_type=t.name,
+                vcpus=t.vcpus,
+                memory_mib=t.memory_mib,
+                price_per_hour=prices[t.name],
+                projected_runtime_seconds=projected_runtime_seconds,
+                projected_cost=projected_cost,
+                cost_change_percent=100 * (projected_cost - current_cost) / current_cost,
+            )
+        )
+
+    return sorted(recommendations, key=lambda r: r.projected_cost)
+
+
+def recommend_for_job(
+    ec2_client, s3_client, pricing_client, job_id: str, headroom: float = DEFAULT_HEADROOM
+) -> Tuple[List[JobUsage], List[Recommendation]]:
+    """
+    Recommend instance types for a job, based on the usage of every past job which
+    ran the same script. Returns the usage of those jobs, and the recommendations.
+    """
+    records = metrics.get_job_records(s3_client, submit.JOBS_KEY_PREFIX)
+    record = next((r for r in records if r.job_id == job_id), None)
+    if not record:
+        raise ValueError(f"Could not find a submitted job named {job_id}.")
+
+    usages = []
+    for r in records:
+        if r.script_hash == record.script_hash:
+            samples = metrics.read_metrics(s3_client, submit.get_job_key(r.job_id))
+            usage = metrics.summarize_usage(r, samples)
+            if usage:
+                usages.append(usage)
+
+    if not usages:
+        raise ValueError(f"No utilization has been recorded for jobs like {job_id} yet.")
+
+    instance_types = get_instance_types(ec2_client)
+    candidates = find_candidates(usages, instance_types, record.instance_type, headroom)
+    names = [record.instance_type] + [t.name for t in candidates[:MAX_PRICED_CANDIDATES]]
+    prices = get_prices(ec2_client, pricing_client, names)
+    if record.instance_type not in prices:
+        raise ValueError(f"Could not find the price of {record.instance_type}.")
+
+    return usages, recommend(usages, instance_types, prices, record.instance_type, headroom)
+
+
+def _get_vcpus(usage: JobUsage, instance_types: Dict[str, InstanceTypeInfo]) -> int:
+    return _get_instance_type(instance_types, usage.instance_type).vcpus
+
+
+def _get_instance_type(instance_types: Dict[str, InstanceTypeInfo], name: str) -> InstanceTypeInfo:
+    try:
+        return instance_types[name]
+    except KeyError:
+        raise ValueError(f"Instance type {name} is not available in this region.")
+
+
+def _get_network_gbps(network_info: dict) -> Optional[float]:
+    cards = network_info.get("NetworkCards", [])
+    if cards and all("BaselineBandwidthInGbps" in c for c in cards):
+        return sum(c["BaselineBandwidthInGbps"] for c in cards)
+
+    # Older descriptions only say "10 Gigabit", or "Up to 10 Gigabit" for burstable networking.
+    match = NETWORK_PERFORMANCE_PATTERN.search(network_info.get("NetworkPerformance", ""))
+    return float(match.group(1)) if match else None
+
+
+def _get_spot_prices(client, instance_types: List[str]) -> Dict[str, float]:
+    prices = {}
+    paginator = client.get_paginator("describe_spot_price_history")
+    pages = paginator.paginate(
+        InstanceTypes=instance_types,
+        ProductDescriptions=["Linux/UNIX"],
+        StartTime=datetime.utcnow(),
+    )
+    for page in pages:
+        for spot_price in page["SpotPriceHistory"]:
+            # Use the cheapest availability zone.
+            instance_type = spot_price["InstanceType"]
+            price = float(spot_price["SpotPrice"])
+            prices[instance_type] = min(price, prices.get(instance_type, price))
+
+    return prices
+
+
+def _get_on_demand_price(client, region: str, instance_type: str) -> Optional[float]:
+    filters = {
+        "regionCode": region,
+        "instanceType": instance_type,
+        "operatingSystem": "Linux",
+        "tenancy": "Shared",
+        "preInstalledSw": "NA",
+        "capacitystatus": "Used",
+    }
+    response = client.get_products(
+        ServiceCode="AmazonEC2",
+        Filters=[{"Type": "TERM_MATCH", "Field": k, "Value": v} for k, v in filters.items()],
+        MaxResults=1,
+    )
+    for product in response["PriceList"]:
+        for term in json.loads(product)["terms"]["OnDemand"].values():
+            for dimension in term["priceDimensions"].values():
+                return float(dimension["pricePerUnit"]["USD"])
+
+    logger.warning("Could not find an on-demand price for %s in %s", instance_type, region)
+    return None
@@ -0,0 +1,177 @@
+import os
+import shlex
+import logging
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, TYPE_CHECKING
+
+from .config import get_settings
+from .ssh import build_ssh_args, SSH_USER, DEFAULT_MAX_WORKERS
+
+if TYPE_CHECKING:
+    from .ec2 import EC2Instance
+
+logger = logging.getLogger(__name__)
+
+# rsync only sends the changed blocks of changed files, compressed.
+RSYNC_ARGS = ["rsync", "--archive", "--compress", "--partial"]
+
+# Remote paths are quoted for the remote shell by _remote, so stop rsync 3.2.4+ from
+# escaping them again. Older versions ignore this.
+RSYNC_ENV = {"RSYNC_OLD_ARGS": "1"}
+
+# Number of rsync processes to split a large folder push across.
+DEFAULT_STREAMS = 4
+# Folders smaller than this are sent in a single stream.
+MIN_PARALLEL_BYTES = 64 * 1024 * 1024
+
+
+def push(
+    instance: "EC2Instance",
+    local_path: str,
+    remote_path: str,
+    ssh_key_path: Optional[str] = None,
+    streams: int = DEFAULT_STREAMS,
+) -> int:
+    """
+    Copy a local file or folder to an instance, sending only what has changed.
+    The contents of a local folder are copied into the remote folder.
+    Large folders are split across several rsync streams, each with its own SSH connection.
+    Returns rsync's exit code.
+    """
+    ssh_key_path = ssh_key_path or get_settings().EC2_KEY_FILE_PATH
+    if not os.path.isdir(local_path):
+        return _rsync(instance, ssh_key_path, [local_path, _remote(instance, remote_path)])
+
+    src = os.path.join(local_path, "")
+    dest = _remote(instance, os.path.join(remote_path, ""))
+    files = _list_files(local_path)
+    total_bytes = sum(size for _, size in files)
+    if streams <= 1 or total_bytes < MIN_PARALLEL_BYTES:
+        return _rsync(instance, ssh_key_path, [src, dest])
+
+    groups = split_files(files, streams)
+    logger.info(
+        "Pushing %s files and folders (%.1f MB) to %s in %s streams",
+        len(files),
+        total_bytes / 1e6,
+        instance.name,
+        len(groups),
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rsync_args = []
+        for idx, group in enumerate(groups):
+            files_from = os.path.join(tmp_dir, f"files-{idx}.txt")
+            with open(files_from, "w") as f:
+                f.write("\n".join(group) + "\n")
+
+            rsync_args.append([f"--files-from={files_from}", src, dest])
+
+        # Parallel streams are bandwidth bound, so they each get their own TCP connection,
+        # rather than sharing the multiplexed one.
+        ssh_opts = {"ControlMaster": "no", "ControlPath": "none"}
+        with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            exit_codes = list(
+                pool.map(lambda args: _rsync(instance, ssh_key_path, args, **ssh_opts), rsync_args)
+            )
+
+    return next((code for code in exit_codes if code != 0), 0)
+
+
+def pull(
+    instance: "EC2Instance", remote_path: str, local_path: str, ssh_key_path: Optional[str] = None
+) -> int:
+    """
+    Copy a file or folder from an instance, sending only what has changed.
+    Returns rsync's exit code.
+    """
+    ssh_key_path = ssh_key_path or get_settings().EC2_KEY_FILE_PATH
+    return _rsync(instance, ssh_key_path, [_remote(instance, remote_path), local_path])
+
+
+def push_many(
+    instances: List["EC2Instance"],
+    local_path: str,
+    remote_path: str,
+    ssh_key_path: Optional[str] = None,
+    streams: int = DEFAULT_STREAMS,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+) -> Dict[str, int]:
+    """
+    Push the same files to many instances at once.
+    Returns a mapping of instance name to rsync exit code.
+    """
+    ssh_key_path = ssh_key_path or get_settings().EC2_KEY_FILE_PATH
+
+    def push_one(instance):
+        return push(instance, local_path, remote_path, ssh_key_path, streams)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(instances) or 1))) as pool:
+        exit_codes = pool.map(push_one, instances)
+        return {i.name: code for i, code in zip(instances, exit_codes)}
+
+
+def split_files(files: List[tuple], n: int) -> List[List[str]]:
+    """
+    Split (path, size) pairs into at most n groups of roughly equal total size.
+    Folders can be included with a size of 0.
+    """
+    groups = [[] for _ in range(min(n, len(files)))]
+    sizes = [0] * len(groups)
+    for path, size in sorted(files, key=lambda f: f[1], reverse=True):
+        idx = sizes.index(min(sizes))
+        groups[idx].append(path)
+        sizes[idx] += size
+
+    return groups
+
+
+def build_rsync_args(instance: "EC2Instance", ssh_key_path: str, args: List[str], **options):
+    ssh_args = build_ssh_args(instance.ip, ssh_key_path, **options)
+    # The destination is passed to rsync rather than ssh.
+    ssh_cmd = " ".join(shlex.quote(a) for a in ssh_args[:-1])
+    return [*RSYNC_ARGS, "-e", ssh_cmd, *args]
+
+
+def _rsync(instance: "EC2Instance", ssh_key_path: str, args: List[str], **options) -> int:
+    cmd = build_rsync_args(instance, ssh_key_path, args, **options)
+    logger.debug("Running %s", cmd)
+    exit_code = subprocess.call(cmd, env={**os.environ, **RSYNC_ENV})
+    if exit_code != 0:
+        logger.error("rsync to %s failed with exit code %s", instance.name, exit_code)
+
+    return exit_code
+
+
+def _remote(instance: "EC2Instance", path: str) -> str:
+    return f"{SSH_USER}@{instance.ip}:{_quote_remote_path(path)}"
+
+
+def _quote_remote_path(path: str) -> str:
+    # Leave a leading ~ unquoted, so that the remote shell still expands it.
+    if path == "~":
+        return path
+
+    if path.startswith("~/"):
+        rest = path[2:]
+        return "~/" + (shlex.quote(rest) if rest else "")
+
+    return shlex.quote(path)
+
+
+def _list_files(folder: str) -> List[tuple]:
+    """
+    Returns the (path, size) of every file and folder inside a folder.
+    Folders are listed so that empty ones are copied by --files-from too.
+    """
+    files = []
+    for root, dirnames, filenames in os.walk(folder):
+        for dirname in dirnames:
+            files.append((os.path.relpath(os.path.join(root, dirname), folder), 0))
+
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            files.append((os.path.relpath(path, folder), os.lstat(path).st_size))
+
+    return files
@@ -1,10 +1,12 @@
 import os
 import glob
+import math
 import logging
 
 from boto3.s3.transfer import TransferConfig
 
 from .config import get_settings
+from .throttle import with_backoff, is_transient_error
 
 logger = logging.getLogger(__name__)
 
@@ -18,20 +20,30 @@ S3_DOWNLOAD_CONFIG = TransferConfig(
     max_concurrency=2,
     num_download_attempts=3,
 )
+# Multipart uploads, for clients which don't have boto3's managed transfers (see the aio module).
+# Files bigger than the threshold are uploaded in parts. S3 allows at most 10,000 parts.
+MULTIPART_THRESHOLD = 8 * 1024 ** 2
+MIN_PART_SIZE = 8 * 1024 ** 2
+MAX_PARTS = 10000
+
+
+def get_part_size(size: int) -> int:
+    """Returns the part size for a multipart upload of a file, so that it fits in S3's part limit"""
+    return max(MIN_PART_SIZE, math.ceil(size / MAX_PARTS))
 
 
 def list_s3_keys(s3_client, key_prefix: str, key_suffix: str):
     """Returns the item keys in a path in AWS S3"""
     settings = get_settings()
     response = s3_client.list_objects_v2(Bucket=settings.S3_BUCKET_NAME, Prefix=key_prefix)
-    objs = response["Contents"]
+    objs = response.get("Contents", [])
     is_truncated = response["IsTruncated"]
     while is_truncated:
         token = response["NextContinuationToken"]
         response = s3_client.list_objects_v2(
             Bucket=settings.S3_BUCKET_NAME, Prefix=key_prefix, ContinuationToken=token
         )
-        objs += response["Contents"]
+        objs += response.get("Contents", [])
         is_truncated = response["IsTruncated"]
 
     return [o["Key"] for o in objs if o["Key"].endswith(key_suffix)]
@@ -41,23 +53,15 @@ def download_s3(s3_client, src_key: str, dest_path: str, quiet: bool, retries: i
     if quiet:
         logging.disable(logging.INFO)
 
-    retry_count = 0
-    while True:
-        try:
-            _download_s3(s3_client, src_key, dest_path)
-            break
-        except Exception:
-            retry_count += 1
-            if retry_count < retries:
-                logger.exception(f"Download to {dest_path} failed, trying again.")
-            else:
-                logger.error(
-                    f"Download to {dest_path} failed, tried {retries} times, still failing."
-                )
-                raise
-
-    if quiet:
-        logging.disable(logging.NOTSET)
+    download = with_backoff(_download_s3, max_attempts=retries, should_retry=is_transient_error)
+    try:
+        download(s3_client, src_key, dest_path)
+    except Exception:
+        logger.error(f"Download to {dest_path} failed.")
+        raise
+    finally:
+        if quiet:
+            logging.disable(logging.NOTSET)
 
 
 def _download_s3(s3_client, src_key: str, dest_path: str):
@@ -67,17 +71,17 @@ def _download_s3(s3_client, src_key: str, dest_path: str):
     s3_client.download_file(settings.S3_BUCKET_NAME, src_key, dest_path, Config=S3_DOWNLOAD_CONFIG)
 
 
-def upload_s3(s3_client, src_path: str, dest_key: str):
+def upload_s3(s3_client, src_path: str, dest_key: str, extra_args=S3_UPLOAD_EXTRA_ARGS):
     """Upload a file or folder to AWS S3"""
     if os.path.isfile(src_path):
-        upload_file_s3(s3_client, src_path, dest_key)
+        upload_file_s3(s3_client, src_path, dest_key, extra_args)
     elif os.path.isdir(src_path):
-        upload_folder_s3(s3_client, src_path, dest_key)
+        upload_folder_s3(s3_client, src_path, dest_key, extra_args)
     else:
         raise ValueError(f"Path is not a file or folder: {src_path}")
 
 
-def upload_folder_s3(s3_client, folder_path, dest_folder_key):
+def upload_folder_s3(s3_client, folder_path, dest_folder_key, extra_args=S3_UPLOAD_EXTRA_ARGS):
     """Upload a folder to S3"""
     nodes = glob.glob(os.path.join(folder_path, "**", "*"), recursive=True)
     files = [f for f in nodes if os.path.isfile(f)]
@@ -85,10 +89,10 @@ def upload_folder_s3(s3_client, folder_path, dest_folder_key):
     for rel_filepath in rel_files:
         src_path = os.path.join(folder_path, rel_filepath)
         dest_key = os.path.join(dest_folder_key, rel_filepath)
-        upload_file_s3(s3_client, src_path, dest_key)
+        upload_file_s3(s3_client, src_path, dest_key, extra_args)
 
 
-def upload_file_s3(s3_client, src_path: str, dest_key: str):
+def upload_file_s3(s3_client, src_path: str, dest_key: str, extra_args=S3_UPLOAD_EXTRA_ARGS):
     """Upload a file to S3"""
     settings = get_settings()
     logger.info("Uploading from %s to %s", src_path, dest_key)
@@ -96,6 +100,15 @@ def upload_file_s3(s3_client, src_path: str, dest_key: str):
         src_path,
         settings.S3_BUCKET_NAME,
         dest_key,
-        ExtraArgs=S3_UPLOAD_EXTRA_ARGS,
+        ExtraArgs=extra_args,
         Config=S3_UPLOAD_CONFIG,
     )
+
+
+def delete_s3_keys(s3_client, key_prefix: str):
+    """Delete every item in a path in AWS S3"""
+    settings = get_settings()
+    keys = list_s3_keys(s3_client, key_prefix, "")
+    for i in range(0, len(keys), 1000):
+        objects = [{"Key": k} for k in keys[i : i + 1000]]
+        s3_client.delete_objects(Bucket=settings.S3_BUCKET_NAME, Delete={"Objects": objects})
@@ -1,22 +1,262 @@
 import os
-import subprocess
+import sys
+import shlex
+import stat
+import time
 import logging
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Callable, TYPE_CHECKING
+
+from .config import get_settings
 
-from .ec2 import EC2Instance
+if TYPE_CHECKING:
+    from .ec2 import EC2Instance
 
 logger = logging.getLogger(__name__)
 
+SSH_USER = "ubuntu"
 SSH_OPTIONS = {
     "StrictHostKeyChecking": "no",
     "TCPKeepAlive": "yes",
     "ServerAliveInterval": "30",
 }
 
+# Share one TCP connection and key exchange between all sessions to a host.
+# The master connection lingers for a while after the last session closes.
+# The control sockets give access to open sessions, so they live in a private per-user folder.
+CONTROL_DIR = os.path.join(tempfile.gettempdir(), f"cjob-ssh-{os.getuid()}")
+MULTIPLEX_OPTIONS = {
+    "ControlMaster": "auto",
+    "ControlPath": os.path.join(CONTROL_DIR, "%C"),
+    "ControlPersist": "10m",
+}
+
+# How long to wait for remaining output once the ssh process has exited.
+READER_JOIN_TIMEOUT = 5
+
+# How many instances to run commands on at once.
+DEFAULT_MAX_WORKERS = 32
 
-def ssh_interactive(instance: EC2Instance, ssh_key_path: str, **options):
+
+def ssh_interactive(instance: "EC2Instance", ssh_key_path: str, **options):
     logger.info(f"Starting SSH session with instance {instance.name}.")
-    opts = {**SSH_OPTIONS, **options}
-    opt_str = " ".join([f"-o {k}={v}" for k, v in opts.items()])
-    cmd_str = f"ssh {opt_str} -i {ssh_key_path} ubuntu@{instance.ip}"
+    args = build_ssh_args(instance.ip, ssh_key_path, **options)
+    cmd_str = shlex.join(args)
     logger.info("Entering ssh session with: %s", cmd_str)
-    subprocess.call(cmd_str, shell=True)
+    subprocess.call(args)
+
+
+def run(
+    instance: "EC2Instance",
+    cmd: str,
+    ssh_key_path: Optional[str] = None,
+    stdout: Optional[Callable[[str], None]] = None,
+    stderr: Optional[Callable[[str], None]] = None,
+    timeout: Optional[float] = None,
+    user: str = SSH_USER,
+    port: int = 22,
+    **options,
+) -> Optional[int]:
+    """
+    Run a command on an instance over a multiplexed SSH connection.
+    Each line of output is passed to the stdout and stderr callbacks as it arrives,
+    by default they are written to this process's stdout and stderr.
+    Returns the command's exit code, or None if it timed out.
+    """
+    if not ssh_key_path:
+        ssh_key_path = get_settings().EC2_KEY_FILE_PATH
+
+    stdout = stdout or _write_to(sys.stdout)
+    stderr = stderr or _write_to(sys.stderr)
+    args = build_ssh_args(instance.ip, ssh_key_path, user=user, port=port, **options)
+    logger.debug("Running on %s: %s", instance.name, cmd)
+    proc = subprocess.Popen(
+        [*args, cmd],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        bufsize=1,
+    )
+    readers = [
+        threading.Thread(target=_pipe_lines, args=(proc.stdout, stdout), daemon=True),
+        threading.Thread(target=_pipe_lines, args=(proc.stderr, stderr), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    try:
+        exit_code = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logger.error("Command on %s timed out after %ss: %s", instance.name, timeout, cmd)
+        proc.kill()
+        proc.wait()
+        exit_code = None
+
+    # Don't hang if some other process (eg. a backgrounded SSH master) inherited the pipes.
+    for reader in readers:
+        reader.join(timeout=READER_JOIN_TIMEOUT)
+
+    return exit_code
+
+
+def wait_for_ssh(
+    instance: "EC2Instance",
+    ssh_key_path: Optional[str] = None,
+    timeout: float = 300,
+    interval: float = 5,
+    **kwargs,
+) -> bool:
+    """
+    Wait until an instance accepts SSH connections.
+    Returns whether it became reachable before the timeout.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        code = run(
+            instance,
+            "true",
+            ssh_key_path,
+            stdout=lambda line: None,
+            stderr=lambda line: None,
+            timeout=interval * 2,
+            ConnectTimeout=int(interval),
+            **kwargs,
+        )
+        if code == 0:
+            return True
+
+        time.sleep(interval)
+
+    return False
+
+
+def wait_for_user_data(
+    instance: "EC2Instance", ssh_key_path: Optional[str] = None, timeout: Optional[float] = None
+) -> bool:
+    """
+    Wait for cloud-init to finish running an instance's user data script.
+    Returns whether the script succeeded, and raises TimeoutError if it doesn't finish in time.
+    """
+    output = []
+    exit_code = run(
+        instance, "cloud-init status --wait", ssh_key_path, stdout=output.append, timeout=timeout
+    )
+    if exit_code is None:
+        raise TimeoutError(f"User data on {instance.id} did not finish within {timeout} seconds.")
+
+    return exit_code == 0 and not any("status: error" in line for line in output)
+
+
+def run_many(
+    instances: List["EC2Instance"],
+    cmd: str,
+    ssh_key_path: Optional[str] = None,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    timeout: Optional[float] = None,
+    **kwargs,
+) -> Dict[str, Optional[int]]:
+    """
+    Run the same command on many instances at once.
+    Output is streamed as it arrives, with each line prefixed by the instance name.
+    Returns a mapping of instance name to exit code (None if it timed out).
+    """
+    if not ssh_key_path:
+        ssh_key_path = get_settings().EC2_KEY_FILE_PATH
+
+    write_lock = threading.Lock()
+
+    def prefixed(stream, name):
+        def write(line: str):
+            with write_lock:
+                stream.write(f"[{name}] {line}\n")
+                stream.flush()
+
+        return write
+
+    def run_one(instance):
+        return run(
+            instance,
+            cmd,
+            ssh_key_path,
+            stdout=prefixed(sys.stdout, instance.name),
+            stderr=prefixed(sys.stderr, instance.name),
+            timeout=timeout,
+            **kwargs,
+        )
+
+    logger.info("Running command on %s instances: %s", len(instances), cmd)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(instances) or 1))) as pool:
+        exit_codes = pool.map(run_one, instances)
+        return {i.name: code for i, code in zip(instances, exit_codes)}
+
+
+def close_connection(
+    instance: "EC2Instance",
+    ssh_key_path: Optional[str] = None,
+    user: str = SSH_USER,
+    port: int = 22,
+    **options,
+):
+    """
+    Shut down the multiplexed master connection to an instance, if there is one.
+    """
+    if not instance.ip:
+        return
+
+    if not ssh_key_path:
+        ssh_key_path = get_settings().EC2_KEY_FILE_PATH
+
+    args = build_ssh_args(instance.ip, ssh_key_path, user=user, port=port, **options)
+    # Insert the control command before the destination.
+    args = [*args[:-1], "-O", "exit", args[-1]]
+    try:
+        subprocess.call(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        # No ssh client installed, so there can't be any connections to close.
+        logger.debug("Could not close SSH connection to %s", instance.name, exc_info=True)
+
+
+def build_ssh_args(
+    ip: str, ssh_key_path: str, user: str = SSH_USER, port: int = 22, **options
+) -> List[str]:
+    _setup_control_dir()
+    opts = {**SSH_OPTIONS, **MULTIPLEX_OPTIONS, **options}
+    args = ["ssh"]
+    for k, v in opts.items():
+        args += ["-o", f"{k}={v}"]
+
+    args += ["-i", os.path.expanduser(ssh_key_path), "-p", str(port), f"{user}@{ip}"]
+    return args
+
+
+def _setup_control_dir():
+    """
+    Create the folder for SSH control sockets,
+    making sure that nobody else owns it or can get into it.
+    """
+    os.makedirs(CONTROL_DIR, mode=0o700, exist_ok=True)
+    info = os.lstat(CONTROL_DIR)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise PermissionError(f"SSH control folder {CONTROL_DIR} is not owned by this user.")
+
+    if stat.S_IMODE(info.st_mode) != 0o700:
+        os.chmod(CONTROL_DIR, 0o700)
+
+
+def _pipe_lines(pipe, callback):
+    for line in pipe:
+        callback(line.rstrip("\n"))
+
+    pipe.close()
+
+
+def _write_to(stream):
+    def write(line: str):
+        stream.write(line + "\n")
+        stream.flush()
+
+    return write
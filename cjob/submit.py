@@ -0,0 +1,260 @@
+"""
+Fire-and-forget jobs: the instance runs a script from a user data bootstrap,
+writes its outputs and exit status to S3 and then shuts itself down,
+so no SSH session needs to stay open while the job runs.
+
+Each job uses these keys in S3_BUCKET_NAME:
+
+    jobs/<job id>/script.sh     The script to run
+    jobs/<job id>/inputs/...    Input files, downloaded to ~/job/inputs
+    jobs/<job id>/outputs/...   Anything the script writes to ~/job/outputs
+    jobs/<job id>/status        The script's exit code, written when it finishes
+    jobs/<job id>/record.json   Details of the job, for right-sizing (see the metrics module)
+    jobs/<job id>/metrics.csv   Resource utilization while the script ran
+
+    logs/<job id>/complete.log.gz   The instance's whole log, uploaded when the script finishes
+
+    jobs/<job id>/env/...       A lockfile to build the job's Python environment from
+
+A job can also be given a code bundle (see the bundle module), extracted to ~/job/code.
+Python environments are cached between jobs (see the env module).
+
+Jobs can be given a cache key (see the cache module). A job whose result is already
+cached is not launched, its cached outputs are copied into its job folder instead.
+"""
+import os
+import time
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+from botocore.exceptions import ClientError
+
+from . import bundle, cache, ec2, env, logs, metrics, s3
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+JOBS_KEY_PREFIX = "jobs"
+DEFAULT_POLL_SECONDS = 30
+
+# Job files are private, unlike the s3 module's default uploads.
+JOB_UPLOAD_EXTRA_ARGS = {}
+
+USER_DATA_TEMPLATE = """#!/bin/bash
+# Generated by cjob: runs job {job_id}, saves its results to S3 then shuts down.
+set -eu
+export AWS_DEFAULT_REGION={region}
+JOB_URI=s3://{bucket}/{job_key}
+LOG_URI=s3://{bucket}/{log_key}
+WORK_DIR=/home/ubuntu/job
+
+CACHE_URI={cache_uri}
+
+finish() {{
+    EXIT_CODE=$?
+    set +e
+    aws s3 cp --recursive --quiet "$WORK_DIR/outputs" "$JOB_URI/outputs"
+    if [ -f {metrics_path} ]; then
+        aws s3 cp --quiet {metrics_path} "$JOB_URI/metrics.csv"
+    fi
+    # Archive the whole log, whether or not anyone is streaming it.
+    gzip -c {log_path} | aws s3 cp --quiet - "$LOG_URI"
+    echo "$EXIT_CODE" | aws s3 cp - "$JOB_URI/status"
+    if [ "$EXIT_CODE" = "0" ] && [ -n "$CACHE_URI" ]; then
+        aws s3 cp --recursive --quiet "$WORK_DIR/outputs" "$CACHE_URI/outputs"
+        echo "$EXIT_CODE" | aws s3 cp - "$CACHE_URI/status"
+    fi
+    shutdown -h now
+}}
+trap finish EXIT
+
+if ! command -v aws > /dev/null; then
+    apt-get update -q
+    apt-get install -y -q awscli
+fi
+
+mkdir -p "$WORK_DIR/inputs" "$WORK_DIR/outputs"
+cd "$WORK_DIR"
+aws s3 cp --quiet "$JOB_URI/script.sh" script.sh
+aws s3 cp --recursive --quiet "$JOB_URI/inputs" inputs
+aws s3 cp --recursive --quiet "$JOB_URI/env" env
+{setup}
+chown -R ubuntu:ubuntu "$WORK_DIR"
+{sampler}
+# sudo resets the PATH, which setup may have changed.
+sudo -u ubuntu -H env PATH="$PATH" bash script.sh
+"""
+
+
+def get_job_key(job_id: str) -> str:
+    return f"{JOBS_KEY_PREFIX}/{job_id}"
+
+
+def build_user_data(job_id: str, setup: str = "", cache_key: Optional[str] = None) -> str:
+    """
+    Build the bootstrap script which runs a submitted job when the instance boots.
+    Extra shell commands in setup run as root, just before the job script.
+    Successful results are saved to the cache if a cache key is given.
+    """
+    settings = get_settings()
+    return USER_DATA_TEMPLATE.format(
+        job_id=job_id,
+        region=settings.AWS_REGION,
+        bucket=settings.S3_BUCKET_NAME,
+        job_key=get_job_key(job_id),
+        log_key=logs.get_complete_log_key(job_id),
+        log_path=logs.DEFAULT_LOG_PATH,
+        cache_uri=cache.get_cache_uri(cache_key) if cache_key else "",
+        setup=setup,
+        metrics_path=metrics.METRICS_PATH,
+        sampler=metrics.build_sampler_script(),
+    )
+
+
+def submit_job(
+    ec2_client,
+    s3_client,
+    job_id: str,
+    script_path: str,
+    input_paths: List[str] = (),
+    cache_key: Optional[str] = None,
+    bundle_hash: Optional[str] = None,
+    lockfile_path: Optional[str] = None,
+    datasets: List[str] = (),
+) -> Optional[str]:
+    """
+    Upload a job script and its inputs, then launch an instance to run it.
+    If the hash of an uploaded code bundle is given, the bundle is fetched before the script runs.
+    If a lockfile is given, the script runs with a Python environment built from it.
+    Named datasets are mounted at /mnt/datasets/<name> (see the datasets module).
+    Returns the instance ID, or None if the job's result was already cached.
+    """
+    settings = get_settings()
+    if not settings.S3_BUCKET_NAME:
+        raise ValueError("S3_BUCKET_NAME must be set to submit jobs.")
+
+    if not settings.EC2_IAM_INSTANCE_PROFILE:
+        raise ValueError(
+            "EC2_IAM_INSTANCE_PROFILE must be set, to let the job instance read and write S3."
+        )
+
+    if settings.EC2_SHUTDOWN_BEHAVIOUR != "terminate":
+        logger.warning(
+            "EC2_SHUTDOWN_BEHAVIOUR is %s, so the instance for job %s will not be terminated.",
+            settings.EC2_SHUTDOWN_BEHAVIOUR,
+            job_id,
+        )
+
+    if cache_key and cache.is_cached(s3_client, cache_key):
+        logger.info("Found cached result for job %s, not launching an instance.", job_id)
+        s3.delete_s3_keys(s3_client, f"{get_job_key(job_id)}/")
+        cache.copy_cached_result(s3_client, cache_key, get_job_key(job_id))
+        return None
+
+    upload_job_files(s3_client, job_id, script_path, input_paths, lockfile_path)
+    record = metrics.JobRecord(
+        job_id=job_id,
+        instance_type=settings.EC2_INSTANCE_TYPE,
+        script_hash=cache.hash_path(script_path),
+        submitted_at=datetime.utcnow(),
+    )
+    metrics.write_job_record(s3_client, get_job_key(job_id), record)
+    setup = ""
+    if lockfile_path:
+        lockfile_name = os.path.basename(lockfile_path)
+        setup += env.build_env_script(f"$WORK_DIR/env/{lockfile_name}")
+
+    if bundle_hash:
+        setup += bundle.build_fetch_script(bundle_hash, "$WORK_DIR/code")
+
+    user_data = build_user_data(job_id, setup, cache_key)
+    return ec2.create_job(ec2_client, job_id, user_data=user_data, datasets=datasets)
+
+
+def upload_job_files(
+    s3_client,
+    job_id: str,
+    script_path: str,
+    input_paths: List[str] = (),
+    lockfile_path: Optional[str] = None,
+):
+    """
+    Upload a job script, its inputs and its lockfile, removing any results from previous runs.
+    """
+    job_key = get_job_key(job_id)
+    logger.info("Uploading files for job %s", job_id)
+    s3.delete_s3_keys(s3_client, f"{job_key}/")
+    s3.upload_file_s3(s3_client, script_path, f"{job_key}/script.sh", JOB_UPLOAD_EXTRA_ARGS)
+    for input_path in input_paths:
+        dest_key = f"{job_key}/inputs/{os.path.basename(os.path.normpath(input_path))}"
+        s3.upload_s3(s3_client, input_path, dest_key, JOB_UPLOAD_EXTRA_ARGS)
+
+    if lockfile_path:
+        for env_path in env.get_env_files(lockfile_path):
+            dest_key = f"{job_key}/env/{os.path.basename(env_path)}"
+            s3.upload_file_s3(s3_client, env_path, dest_key, JOB_UPLOAD_EXTRA_ARGS)
+
+
+def get_job_status(s3_client, job_id: str) -> Optional[int]:
+    """
+    Returns the job's exit code, or None if it hasn't finished.
+    """
+    settings = get_settings()
+    key = f"{get_job_key(job_id)}/status"
+    try:
+        response = s3_client.get_object(Bucket=settings.S3_BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+
+        raise
+
+    return int(response["Body"].read().decode().strip())
+
+
+def wait_job(
+    s3_client,
+    job_id: str,
+    ec2_client=None,
+    poll_seconds: float = DEFAULT_POLL_SECONDS,
+    timeout: Optional[float] = None,
+) -> int:
+    """
+    Wait for a submitted job to finish, returning its exit code.
+    Each poll is a single S3 request. If an EC2 client is provided,
+    also give up when the job's instance disappears without reporting a status.
+    """
+    start = time.time()
+    while True:
+        status = get_job_status(s3_client, job_id)
+        if status is not None:
+            return status
+
+        if ec2_client and not ec2.find_instance(ec2_client, job_id):
+            # The status may have been written just before the instance went away.
+            status = get_job_status(s3_client, job_id)
+            if status is not None:
+                return status
+
+            raise RuntimeError(f"Instance for job {job_id} is gone but the job has no status.")
+
+        if timeout is not None and time.time() - start > timeout:
+            raise TimeoutError(f"Job {job_id} did not finish within {timeout} seconds.")
+
+        time.sleep(poll_seconds)
+
+
+def download_result(s3_client, job_id: str, dest_path: str) -> List[str]:
+    """
+    Download a finished job's outputs to a local folder, returning the file paths.
+    """
+    outputs_key = f"{get_job_key(job_id)}/outputs/"
+    paths = []
+    for key in s3.list_s3_keys(s3_client, outputs_key, ""):
+        path = os.path.join(dest_path, key[len(outputs_key) :])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        s3.download_s3(s3_client, key, path, quiet=False)
+        paths.append(path)
+
+    return paths
@@ -0,0 +1,269 @@
+"""
+Client-side rate limiting and retries for AWS API calls.
+
+Every AWS client in the process shares one token bucket per API family, so many threads
+launching, describing or transferring at once stay under the account's request limits
+instead of all hammering AWS and then all retrying at the same moment.
+The bucket's refill rate adapts: it is halved whenever AWS throttles us and creeps back
+up as calls succeed. Async clients (see the aio module) share the same buckets.
+
+EC2 is split into the "non-mutating" (Describe/Get/List) and "mutating" action categories
+that AWS throttles separately. Per-action resource limits (eg. instances launched per second)
+are not modelled, those are left to the adaptive rate.
+"""
+import random
+import asyncio
+import logging
+import threading
+from functools import wraps
+from time import monotonic, sleep
+
+from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+
+logger = logging.getLogger(__name__)
+
+# (requests per second, burst size) for each API family.
+# EC2 refills non-mutating calls at 20/s and mutating calls at 5/s,
+# S3 allows thousands of requests/s per prefix.
+RATE_LIMITS = {
+    "ec2": (20.0, 100),
+    "ec2-mutating": (5.0, 200),
+    "s3": (200.0, 500),
+    "pricing": (10.0, 20),
+}
+EC2_NON_MUTATING_PREFIXES = ("Describe", "Get", "List")
+MIN_RATE = 1.0
+RATE_INCREASE = 0.5
+
+# Retry settings, using "decorrelated jitter" backoff.
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+THROTTLING_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "SlowDown",
+    "EC2ThrottledException",
+}
+TRANSIENT_ERROR_CODES = {
+    "ServiceUnavailable",
+    "InternalError",
+    "RequestTimeout",
+}
+
+# Botocore keeps retrying connection errors, timeouts and 5xx responses itself.
+# Its retries re-send the same request, with the same idempotency token, so a retried
+# RunInstances can't launch a second instance. We only add slower retries on top of this,
+# for requests which AWS throttled and so never acted on.
+CLIENT_CONFIG = Config(retries={"mode": "standard"})
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket which blocks callers until a token is available.
+    Async callers use acquire_async, which suspends the task rather than the thread.
+    """
+
+    def __init__(self, rate: float, capacity: int, clock=monotonic, sleeper=sleep):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self._clock = clock
+        self._sleep = sleeper
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        wait = self._take()
+        if wait:
+            self._sleep(wait)
+
+    async def acquire_async(self):
+        wait = self._take()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def penalize(self):
+        """Halve the refill rate after being throttled by AWS"""
+        with self._lock:
+            self._refill()
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            logger.debug("Throttled by AWS, reduced request rate to %.1f/s", self.rate)
+
+    def reward(self):
+        """Slowly restore the refill rate after a successful call"""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+    def _take(self) -> float:
+        # Take the token now, going into debt if needed, and return how long to wait
+        # until the debt is paid. This keeps waiting callers in order without them
+        # polling the bucket.
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(family: str) -> TokenBucket:
+    """Returns the token bucket shared by every client of an API family"""
+    with _limiters_lock:
+        if family not in _limiters:
+            rate, capacity = RATE_LIMITS[family]
+            _limiters[family] = TokenBucket(rate, capacity)
+
+        return _limiters[family]
+
+
+def get_family(service: str, operation: str) -> str:
+    """Returns the API family which an AWS operation is rate limited under"""
+    if service == "ec2" and not operation.startswith(EC2_NON_MUTATING_PREFIXES):
+        return "ec2-mutating"
+
+    return service
+
+
+def is_throttling_error(e: Exception) -> bool:
+    """
+    Whether AWS rejected a request for being over its rate limit.
+    These requests were never acted on, so it's always safe to send them again.
+    """
+    if isinstance(e, ClientError):
+        return e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+
+    return False
+
+
+def is_transient_error(e: Exception) -> bool:
+    """
+    Whether a request failed for a reason that might go away by itself.
+    Only retry idempotent operations (eg. downloads) on these errors.
+    """
+    if isinstance(e, ClientError):
+        code = e.response.get("Error", {}).get("Code")
+        return code in THROTTLING_ERROR_CODES or code in TRANSIENT_ERROR_CODES
+
+    return isinstance(e, (BotoConnectionError, HTTPClientError))
+
+
+def backoff_delays(base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP):
+    """
+    Yields sleep times using decorrelated jitter, so that clients which were throttled
+    together don't retry together.
+    """
+    delay = base
+    while True:
+        delay = min(cap, random.uniform(base, delay * 3))
+        yield delay
+
+
+def with_backoff(func, max_attempts: int = MAX_ATTEMPTS, should_retry=is_throttling_error):
+    """
+    Wraps a function so that it is retried with backoff when should_retry(error) is true.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        delays = backoff_delays()
+        attempt = 1
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= max_attempts or not should_retry(e):
+                    raise
+
+                delay = next(delays)
+                logger.info(
+                    "Call to %s failed (%s), retrying in %.1fs (attempt %s of %s).",
+                    func.__name__,
+                    e,
+                    delay,
+                    attempt + 1,
+                    max_attempts,
+                )
+                sleep(delay)
+                attempt += 1
+
+    return wrapper
+
+
+class ThrottledClient:
+    """
+    Wraps a boto3 client so that its API calls are retried with backoff when throttled.
+    Rate limiting itself is done by event hooks on the wrapped client (see wrap_client),
+    so calls made inside boto3's managed transfers are limited as well.
+    Managed transfers still rely on botocore's own retries.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._operations = set(client.meta.method_to_api_mapping)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name in self._operations:
+            return with_backoff(attr)
+
+        return attr
+
+
+def wrap_client(client, family: str) -> ThrottledClient:
+    """
+    Attach the shared rate limiter for an API family to a boto3 client.
+    """
+    register_limiter(client, family)
+    return ThrottledClient(client)
+
+
+def register_limiter(client, family: str, is_async: bool = False):
+    """
+    Register event hooks which rate limit a client's requests with an API family's limiters.
+    Set is_async for aiobotocore clients, so that waiting for a token doesn't block the event loop.
+    """
+
+    def limiter_for(event_name: str) -> TokenBucket:
+        # Event names look like "before-send.ec2.RunInstances"
+        operation = event_name.split(".")[-1]
+        return get_limiter(get_family(family, operation))
+
+    def before_send(event_name, **kwargs):
+        # Sent before every HTTP request, including botocore's own retries.
+        # A response returned from here would be used instead of sending the request,
+        # so this must return None, or a coroutine returning None which aiobotocore awaits.
+        limiter = limiter_for(event_name)
+        return limiter.acquire_async() if is_async else limiter.acquire()
+
+    def after_call(event_name, parsed=None, **kwargs):
+        if parsed is not None and "Error" not in parsed:
+            limiter_for(event_name).reward()
+
+    def needs_retry(event_name, response=None, **kwargs):
+        if response:
+            code = response[1].get("Error", {}).get("Code")
+            if code in THROTTLING_ERROR_CODES:
+                limiter_for(event_name).penalize()
+
+    events = client.meta.events
+    events.register("before-send", before_send)
+    events.register("after-call", after_call)
+    events.register("needs-retry", needs_retry)
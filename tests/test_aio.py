@@ -0,0 +1,157 @@
+"""
+Tests for the asyncio API, against moto running as a server.
+"""
+import os
+import sys
+import time
+import shutil
+import socket
+import asyncio
+import subprocess
+import urllib.request
+from datetime import datetime
+
+import boto3
+import pytest
+
+pytest.importorskip("aiobotocore")
+pytest.importorskip("flask", reason="moto's server mode needs flask")
+
+from cjob import aio, ec2, s3, ssh
+from tests.utils import settings_factory
+
+
+@pytest.fixture(scope="module")
+def moto_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "moto.server", "-H", "127.0.0.1", "-p", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while True:
+        try:
+            urllib.request.urlopen(f"{url}/moto-api/")
+            break
+        except OSError:
+            if time.time() > deadline:
+                proc.kill()
+                raise
+
+            time.sleep(0.1)
+
+    yield url
+    proc.terminate()
+    proc.wait()
+
+
+@pytest.fixture
+def test_settings(monkeypatch, tmpdir, moto_url):
+    urllib.request.urlopen(urllib.request.Request(f"{moto_url}/moto-api/reset", method="POST"))
+    get_test_settings = settings_factory(
+        AWS_PROFILE=None,
+        AWS_ACCESS_KEY_ID="testing",
+        AWS_SECRET_ACCESS_KEY="testing",
+        S3_BUCKET_NAME="test-bucket",
+        EC2_AMI="ami-076a5bf4a712000ed",
+        EC2_KEY_FILE_PATH=os.path.join(tmpdir, "testkey.pem"),
+    )
+    for module in (aio, ec2, s3, ssh):
+        monkeypatch.setattr(module, "get_settings", get_test_settings)
+
+    return get_test_settings()
+
+
+def create_blocking_client(service: str, moto_url: str):
+    return boto3.client(
+        service,
+        region_name="ap-southeast-2",
+        endpoint_url=moto_url,
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+    )
+
+
+def test_instance_lifecycle(test_settings, moto_url, monkeypatch):
+    closed = []
+    monkeypatch.setattr(ssh, "close_connection", lambda instance: closed.append(instance.id))
+    blocking_client = create_blocking_client("ec2", moto_url)
+
+    async def run():
+        async with aio.get_ec2_client(endpoint_url=moto_url) as client:
+            launch_kwargs = await aio.prepare_launch(blocking_client)
+            job_ids = [ec2.add_job_prefix(f"sweep-{i}") for i in range(50)]
+            instance_ids = await asyncio.gather(
+                *[aio.create_job(client, job_id, launch_kwargs, "echo hi") for job_id in job_ids]
+            )
+            instances = await aio.wait_for_instances(client, instance_ids)
+            assert [i.name for i in instances] == job_ids
+            assert all(i.is_running() for i in instances)
+
+            await aio.stop_job(client, job_ids[0])
+            records = await aio.get_instance_records(client)
+            assert sorted(r.id for r in records) == sorted(instance_ids[1:])
+            return instance_ids
+
+    instance_ids = asyncio.run(run())
+    assert closed == [instance_ids[0]]
+
+
+def test_s3_transfers(test_settings, moto_url, monkeypatch, tmpdir):
+    # Upload the big file in 3 parts, S3's smallest part size is 5 MiB.
+    monkeypatch.setattr(s3, "MULTIPART_THRESHOLD", 1024 ** 2)
+    monkeypatch.setattr(s3, "MIN_PART_SIZE", 5 * 1024 ** 2)
+    # Write downloads in several batches.
+    monkeypatch.setattr(aio, "DOWNLOAD_WRITE_SIZE", 4 * 1024 ** 2)
+    blocking_client = create_blocking_client("s3", moto_url)
+    blocking_client.create_bucket(
+        Bucket="test-bucket",
+        CreateBucketConfiguration={"LocationConstraint": "ap-southeast-2"},
+    )
+    src_dir = tmpdir.mkdir("src")
+    files = {f"small-{i}.txt": f"hello {i}".encode() for i in range(20)}
+    files["nested/big.bin"] = os.urandom(11 * 1024 ** 2)
+    for name, data in files.items():
+        src_dir.join(name).write_binary(data, ensure=True)
+
+    async def run():
+        async with aio.get_s3_client(endpoint_url=moto_url) as client:
+            await aio.upload_s3(client, str(src_dir), "data", extra_args={})
+            keys = await aio.list_s3_keys(client, "data/", "")
+            assert sorted(keys) == sorted(f"data/{name}" for name in files)
+
+            downloads = [
+                aio.download_s3(client, f"data/{name}", str(tmpdir.join(name.replace("/", "-"))))
+                for name in files
+            ]
+            await asyncio.gather(*downloads)
+            await aio.delete_s3_keys(client, "data/")
+            assert await aio.list_s3_keys(client, "data/", "") == []
+
+    asyncio.run(run())
+    for name, data in files.items():
+        assert tmpdir.join(name.replace("/", "-")).read_binary() == data
+
+
+@pytest.mark.skipif(not shutil.which("ssh"), reason="ssh is not installed")
+def test_wait_for_ssh__unreachable(tmpdir):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    instance = ec2.EC2Instance(
+        id="i-123",
+        name="cjob-foo",
+        ip="127.0.0.1",
+        type="r5.2xlarge",
+        launched_at=datetime.utcnow(),
+        state="running",
+    )
+    key_path = str(tmpdir.join("testkey.pem"))
+    is_ready = asyncio.run(aio.wait_for_ssh(instance, key_path, timeout=0.5, interval=1, port=port))
+    assert not is_ready
@@ -0,0 +1,82 @@
+"""
+Tests for baking job AMIs.
+"""
+import os
+
+import boto3
+import pytest
+from moto import mock_ec2
+
+from cjob import bake, ec2, ssh
+from tests.utils import settings_factory
+
+
+@pytest.fixture
+def test_settings(monkeypatch, tmpdir):
+    setup_path = tmpdir.join("setup.sh")
+    setup_path.write("apt-get install -y htop")
+    get_test_settings = settings_factory(
+        EC2_AMI="ami-076a5bf4a712000ed",
+        EC2_SETUP_SCRIPT=str(setup_path),
+        EC2_KEY_FILE_PATH=os.path.join(tmpdir, "testkey.pem"),
+    )
+    for module in (bake, ec2, ssh):
+        monkeypatch.setattr(module, "get_settings", get_test_settings)
+
+    # Pretend the builder instance ran the setup script.
+    monkeypatch.setattr(ssh, "wait_for_ssh", lambda instance: True)
+    monkeypatch.setattr(ssh, "wait_for_user_data", lambda instance, **kwargs: True)
+    monkeypatch.setattr(ssh, "close_connection", lambda instance: None)
+    return get_test_settings()
+
+
+@mock_ec2
+def test_bake(test_settings):
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    assert ec2.get_ami_id(client) == "ami-076a5bf4a712000ed"
+
+    ami_id = bake.bake(client, test_settings.EC2_SETUP_SCRIPT)
+    assert ami_id != "ami-076a5bf4a712000ed"
+    assert ec2.get_ami_id(client) == ami_id
+    # The builder instance is cleaned up.
+    assert not [i for i in ec2.get_instances(client) if i.is_running()]
+
+    # Baking again reuses the AMI.
+    assert bake.bake(client, test_settings.EC2_SETUP_SCRIPT) == ami_id
+
+    # Changing the setup script means a new AMI is needed.
+    with open(test_settings.EC2_SETUP_SCRIPT, "a") as f:
+        f.write("\napt-get install -y tmux")
+
+    assert ec2.get_ami_id(client) == "ami-076a5bf4a712000ed"
+
+
+@mock_ec2
+def test_collect_garbage(test_settings, monkeypatch):
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    old_ami_ids = [bake.bake(client, test_settings.EC2_SETUP_SCRIPT, force=True) for _ in range(4)]
+    # A new version of the setup script starts a new lineage of AMIs.
+    with open(test_settings.EC2_SETUP_SCRIPT, "a") as f:
+        f.write("\napt-get install -y tmux")
+
+    new_ami_ids = [bake.bake(client, test_settings.EC2_SETUP_SCRIPT, force=True) for _ in range(3)]
+    ami_ids = old_ami_ids + new_ami_ids
+
+    # Newest first, since moto may give them all the same creation time.
+    images = client.describe_images(ImageIds=ami_ids)["Images"]
+    images.sort(key=lambda i: ami_ids.index(i["ImageId"]), reverse=True)
+    monkeypatch.setattr(bake, "get_baked_amis", lambda client: images)
+    current_ami_id = ec2.get_ami_id(client)
+    assert current_ami_id in new_ami_ids
+    deregistered = bake.collect_garbage(client, keep=1)
+    # The current AMI and the newest other AMI of each lineage are kept.
+    assert len(deregistered) == 4
+    assert set(old_ami_ids[:3]) < set(deregistered)
+    assert current_ami_id not in deregistered
+    assert len(set(new_ami_ids) - set(deregistered)) == 2
+
+    # Their snapshots are deleted too.
+    snapshot_ids = [i["BlockDeviceMappings"][0]["Ebs"]["SnapshotId"] for i in images]
+    response = client.describe_snapshots(OwnerIds=["self"])
+    remaining_ids = {s["SnapshotId"] for s in response["Snapshots"]}
+    assert len(set(snapshot_ids) - remaining_ids) == len(deregistered)
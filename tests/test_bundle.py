@@ -0,0 +1,76 @@
+"""
+Tests for content-addressed code bundles.
+"""
+import os
+import shutil
+import tarfile
+import subprocess
+
+import pytest
+from moto import mock_s3
+
+from cjob import bundle, s3
+from tests.utils import settings_factory, create_test_s3_client
+
+
+@pytest.fixture
+def test_settings(monkeypatch):
+    get_test_settings = settings_factory(S3_BUCKET_NAME="test-bucket")
+    for module in (bundle, s3):
+        monkeypatch.setattr(module, "get_settings", get_test_settings)
+
+    return get_test_settings()
+
+
+@pytest.fixture
+def project(tmpdir):
+    project_dir = tmpdir.mkdir("project")
+    project_dir.join("main.py").write("print('hello')")
+    project_dir.mkdir("lib").join("util.py").write("X = 1")
+    return project_dir
+
+
+def test_build_bundle__deterministic(project, tmpdir):
+    bundle_hash = bundle.build_bundle(str(project), str(tmpdir.join("a.tar.gz")))
+
+    # Timestamps don't matter.
+    os.utime(str(project.join("main.py")), (0, 0))
+    assert bundle.build_bundle(str(project), str(tmpdir.join("b.tar.gz"))) == bundle_hash
+
+    # Contents do.
+    project.join("main.py").write("print('goodbye')")
+    assert bundle.build_bundle(str(project), str(tmpdir.join("c.tar.gz"))) != bundle_hash
+
+    with tarfile.open(str(tmpdir.join("c.tar.gz"))) as tar:
+        assert tar.getnames() == ["lib/util.py", "main.py"]
+        assert all(m.mtime == 0 and m.uid == 0 for m in tar.getmembers())
+
+
+@pytest.mark.skipif(not shutil.which("git"), reason="git is not installed")
+def test_list_bundle_files__gitignore(project):
+    subprocess.check_call(["git", "init", "-q"], cwd=str(project))
+    project.join(".gitignore").write("*.log\nbuild/\n")
+    project.join("debug.log").write("noise")
+    project.mkdir("build").join("out.bin").write("noise")
+    assert bundle.list_bundle_files(str(project)) == [".gitignore", "lib/util.py", "main.py"]
+
+
+@mock_s3
+def test_upload_bundle__dedup(test_settings, project, monkeypatch):
+    s3_client = create_test_s3_client()
+    uploads = []
+    upload_file_s3 = s3.upload_file_s3
+    monkeypatch.setattr(
+        s3, "upload_file_s3", lambda *args: uploads.append(args[2]) or upload_file_s3(*args)
+    )
+    bundle_hash = bundle.upload_bundle(s3_client, str(project))
+    assert bundle.upload_bundle(s3_client, str(project)) == bundle_hash
+    assert uploads == [f"bundles/{bundle_hash}.tar.gz"]
+    assert bundle.bundle_exists(s3_client, bundle_hash)
+
+
+def test_build_fetch_script(test_settings):
+    script = bundle.build_fetch_script("abc123", "$WORK_DIR/code")
+    assert "s3://test-bucket/bundles/abc123.tar.gz" in script
+    assert "BUNDLE_PATH=/var/cache/cjob/bundles/abc123.tar.gz" in script
+    assert 'tar -xzf "$BUNDLE_PATH" -C "$WORK_DIR/code"' in script
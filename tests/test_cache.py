@@ -0,0 +1,111 @@
+"""
+Tests for content-addressed job results.
+"""
+import os
+from datetime import datetime, timedelta
+
+import boto3
+import pytest
+from moto import mock_ec2, mock_s3
+
+from cjob import cache, ec2, metrics, s3, submit
+from tests.utils import settings_factory, create_test_s3_client
+
+
+@pytest.fixture
+def test_settings(monkeypatch, tmpdir):
+    get_test_settings = settings_factory(
+        S3_BUCKET_NAME="test-bucket",
+        EC2_AMI="ami-076a5bf4a712000ed",
+        EC2_IAM_INSTANCE_PROFILE="worker-profile",
+        EC2_KEY_FILE_PATH=os.path.join(tmpdir, "testkey.pem"),
+        CACHE_TTL_HOURS=1,
+    )
+    for module in (cache, ec2, metrics, s3, submit):
+        monkeypatch.setattr(module, "get_settings", get_test_settings)
+
+    return get_test_settings()
+
+
+def test_compute_cache_key(tmpdir):
+    script_path = tmpdir.join("run.sh")
+    script_path.write("echo hello")
+    input_dir = tmpdir.mkdir("data")
+    input_dir.join("a.csv").write("1,2,3")
+    key = cache.compute_cache_key([str(script_path)], [str(input_dir)], {"n": 1})
+    assert key == cache.compute_cache_key([str(script_path)], [str(input_dir)], {"n": 1})
+    assert key != cache.compute_cache_key([str(script_path)], [str(input_dir)], {"n": 2})
+
+    input_dir.join("a.csv").write("1,2,4")
+    assert key != cache.compute_cache_key([str(script_path)], [str(input_dir)], {"n": 1})
+
+
+@mock_s3
+def test_cached_object(test_settings):
+    s3_client = create_test_s3_client()
+    assert cache.get_cached_object(s3_client, "abc") is None
+    cache.put_cached_object(s3_client, "abc", {"answer": 42})
+    assert cache.is_cached(s3_client, "abc")
+    assert cache.get_cached_object(s3_client, "abc") == {"answer": 42}
+
+
+@mock_s3
+def test_run_job__cached_none(test_settings, monkeypatch):
+    s3_client = create_test_s3_client()
+    cache.put_cached_object(s3_client, "abc", None)
+
+    def create_job(*args, **kwargs):
+        raise AssertionError("A cached job should not launch an instance")
+
+    monkeypatch.setattr(ec2, "create_job", create_job)
+    result = ec2.run_job(None, "cjob-foo", lambda: 1, cache_key="abc", s3_client=s3_client)
+    assert result is None
+
+
+@mock_s3
+def test_evict_expired(test_settings, monkeypatch):
+    s3_client = create_test_s3_client()
+    cache.put_cached_object(s3_client, "old", 1)
+    # An incomplete entry, left behind by a failed job.
+    s3_client.put_object(Bucket="test-bucket", Key="cache/broken/outputs/a.txt", Body=b"a")
+    assert cache.evict_expired(s3_client) == []
+
+    # Move the clock forward past the TTL.
+    later = datetime.utcnow() + timedelta(hours=2)
+    monkeypatch.setattr(cache, "datetime", type("FakeDatetime", (), {"utcnow": lambda: later}))
+    assert not cache.is_cached(s3_client, "old")
+    assert sorted(cache.evict_expired(s3_client)) == ["broken", "old"]
+    assert s3.list_s3_keys(s3_client, "cache/", "") == []
+
+
+@mock_ec2
+@mock_s3
+def test_submit_job__cached(test_settings, tmpdir):
+    ec2_client = boto3.client("ec2", region_name="ap-southeast-2")
+    s3_client = create_test_s3_client()
+    script_path = tmpdir.join("run.sh")
+    script_path.write("echo hello > outputs/hello.txt")
+    cache_key = cache.compute_cache_key([str(script_path)])
+
+    # The first run is launched, and told where to cache its result.
+    instance_id = submit.submit_job(
+        ec2_client, s3_client, "cjob-foo", str(script_path), cache_key=cache_key
+    )
+    assert instance_id
+    user_data = submit.build_user_data("cjob-foo", cache_key=cache_key)
+    assert f"CACHE_URI=s3://test-bucket/cache/{cache_key}" in user_data
+
+    # Pretend the instance finished the job and cached its result.
+    entry_key = f"cache/{cache_key}"
+    s3_client.put_object(Bucket="test-bucket", Key=f"{entry_key}/outputs/hello.txt", Body=b"hi")
+    s3_client.put_object(Bucket="test-bucket", Key=f"{entry_key}/status", Body=b"0\n")
+
+    # The second run reuses the cached result, without launching an instance.
+    instance_id = submit.submit_job(
+        ec2_client, s3_client, "cjob-bar", str(script_path), cache_key=cache_key
+    )
+    assert instance_id is None
+    assert len(ec2.get_instances(ec2_client)) == 1
+    assert submit.get_job_status(s3_client, "cjob-bar") == 0
+    paths = submit.download_result(s3_client, "cjob-bar", str(tmpdir.join("results")))
+    assert paths == [str(tmpdir.join("results", "hello.txt"))]
@@ -0,0 +1,110 @@
+"""
+Tests for multi-node clusters.
+"""
+import os
+
+import boto3
+import pytest
+from moto import mock_ec2
+from botocore.stub import Stubber
+
+from cjob import cluster, ec2, ssh
+from tests.utils import settings_factory
+
+
+@pytest.fixture
+def test_settings(monkeypatch, tmpdir):
+    get_test_settings = settings_factory(
+        EC2_AMI="ami-076a5bf4a712000ed",
+        EC2_KEY_FILE_PATH=os.path.join(tmpdir, "testkey.pem"),
+    )
+    for module in (cluster, ec2, ssh):
+        monkeypatch.setattr(module, "get_settings", get_test_settings)
+
+    monkeypatch.setattr(ssh, "wait_for_ssh", lambda instance, ssh_key_path=None: True)
+    monkeypatch.setattr(ssh, "close_connection", lambda instance: None)
+    return get_test_settings()
+
+
+@mock_ec2
+def test_launch_cluster(test_settings, monkeypatch, tmpdir):
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    # Write the cluster files locally, rather than over SSH.
+    monkeypatch.setattr(ssh, "build_ssh_args", lambda *args, **kwargs: ["sh", "-c"])
+    monkeypatch.setattr(cluster, "HOSTFILE_PATH", str(tmpdir.join("hostfile")))
+    monkeypatch.setattr(cluster, "CLUSTER_ENV_PATH", str(tmpdir.join("cluster.env")))
+    # moto doesn't support placement groups.
+    monkeypatch.setattr(ec2, "_setup_placement_group", lambda client: "cjob-cluster")
+    launches = []
+    run_instances = client.run_instances
+    monkeypatch.setattr(
+        client, "run_instances", lambda **kwargs: launches.append(kwargs) or run_instances(**kwargs)
+    )
+    nodes = cluster.launch_cluster(client, "cjob-train", 3, slots=8)
+    assert [n.name for n in nodes] == ["cjob-train-0", "cjob-train-1", "cjob-train-2"]
+    assert [n.rank for n in nodes] == [0, 1, 2]
+    assert all(n.cluster == "cjob-train" and n.private_ip for n in nodes)
+
+    # The nodes are launched together in the placement group.
+    assert len(launches) == 1
+    assert launches[0]["MinCount"] == launches[0]["MaxCount"] == 3
+    assert launches[0]["Placement"] == {"GroupName": "cjob-cluster"}
+    # They're tagged as they're launched, rather than afterwards.
+    instance_tags = launches[0]["TagSpecifications"][0]["Tags"]
+    assert {"Key": ec2.CLUSTER_TAG, "Value": "cjob-train"} in instance_tags
+
+    # Each node gets the same hostfile and its own rank.
+    hostfile = tmpdir.join("hostfile").read()
+    assert hostfile == "".join(f"{n.private_ip} slots=8\n" for n in nodes)
+    cluster_env = cluster.build_cluster_env(nodes, 2)
+    assert "export CJOB_RANK=2\n" in cluster_env
+    assert "export CJOB_WORLD_SIZE=3\n" in cluster_env
+    assert f"export CJOB_MASTER_ADDR={nodes[0].private_ip}\n" in cluster_env
+    # The nodes all write to the same local file here.
+    cluster_envs = [cluster.build_cluster_env(nodes, rank) for rank in range(3)]
+    assert tmpdir.join("cluster.env").read() in cluster_envs
+
+    # Stopping the job stops every node.
+    ec2.stop_job(client, "cjob-train")
+    assert not [i for i in ec2.get_instances(client) if i.is_running()]
+
+
+def test_setup_placement_group(test_settings):
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    filters = [{"Name": "group-name", "Values": ["cjob-cluster"]}]
+    with Stubber(client) as stubber:
+        response = {"PlacementGroups": []}
+        stubber.add_response("describe_placement_groups", response, {"Filters": filters})
+        stubber.add_response(
+            "create_placement_group", {}, {"GroupName": "cjob-cluster", "Strategy": "cluster"}
+        )
+        assert ec2._setup_placement_group(client) == "cjob-cluster"
+
+        # An existing group is reused.
+        response = {"PlacementGroups": [{"GroupName": "cjob-cluster", "Strategy": "cluster"}]}
+        stubber.add_response("describe_placement_groups", response, {"Filters": filters})
+        assert ec2._setup_placement_group(client) == "cjob-cluster"
+        stubber.assert_no_pending_responses()
+
+
+@mock_ec2
+def test_security_group__allows_cluster_traffic(test_settings):
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    group_id = ec2._setup_default_security_group(client)
+    # Setting up again doesn't add duplicate rules.
+    assert ec2._setup_default_security_group(client) == group_id
+    response = client.describe_security_groups(GroupIds=[group_id])
+    rules = response["SecurityGroups"][0]["IpPermissions"]
+    group_pairs = [g for r in rules for g in r.get("UserIdGroupPairs", [])]
+    assert [g["GroupId"] for g in group_pairs] == [group_id]
+
+
+@mock_ec2
+def test_launch_cluster__stops_nodes_on_failure(test_settings, monkeypatch):
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    monkeypatch.setattr(ec2, "_setup_placement_group", lambda client: "cjob-cluster")
+    monkeypatch.setattr(ssh, "wait_for_ssh", lambda instance, ssh_key_path=None: False)
+    with pytest.raises(TimeoutError):
+        cluster.launch_cluster(client, "cjob-train", 2)
+
+    assert not [i for i in ec2.get_instances(client) if i.is_running()]
@@ -0,0 +1,114 @@
+"""
+Tests for datasets staged on EBS snapshots.
+"""
+import os
+import shlex
+import base64
+from email import message_from_string
+
+import yaml
+import boto3
+import pytest
+from moto import mock_ec2
+
+from cjob import datasets, ec2, ssh
+from tests.utils import settings_factory
+
+
+@pytest.fixture
+def test_settings(monkeypatch, tmpdir):
+    get_test_settings = settings_factory(
+        EC2_AMI="ami-076a5bf4a712000ed",
+        EC2_KEY_FILE_PATH=os.path.join(tmpdir, "testkey.pem"),
+    )
+    for module in (ec2, ssh):
+        monkeypatch.setattr(module, "get_settings", get_test_settings)
+
+    # Pretend the builder instance copied the data.
+    monkeypatch.setattr(ssh, "wait_for_ssh", lambda instance: True)
+    monkeypatch.setattr(ssh, "wait_for_user_data", lambda instance, **kwargs: True)
+    monkeypatch.setattr(ssh, "close_connection", lambda instance: None)
+    return get_test_settings()
+
+
+@mock_ec2
+def test_create_dataset(test_settings):
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    snapshot_id = datasets.create_dataset(client, "train", "s3://data/train/", 300)
+    assert ec2.find_dataset_snapshot(client, "train")["SnapshotId"] == snapshot_id
+    # The builder instance is cleaned up.
+    assert not [i for i in ec2.get_instances(client) if i.is_running()]
+
+    # The same source reuses the snapshot.
+    assert datasets.create_dataset(client, "train", "s3://data/train/", 300) == snapshot_id
+
+    # A new source replaces the snapshot.
+    new_snapshot_id = datasets.create_dataset(client, "train", "s3://data/train-v2/", 300)
+    assert new_snapshot_id != snapshot_id
+    assert [s["SnapshotId"] for s in datasets.get_datasets(client)] == [new_snapshot_id]
+
+    datasets.delete_dataset(client, "train")
+    assert ec2.find_dataset_snapshot(client, "train") is None
+
+
+@mock_ec2
+def test_create_dataset__fast_restore_existing(test_settings, monkeypatch):
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    snapshot_id = datasets.create_dataset(client, "train", "s3://data/train/", 300)
+    enabled = []
+    monkeypatch.setattr(
+        datasets, "set_fast_restore", lambda client, *args, **kwargs: enabled.append(args)
+    )
+    zones = ["ap-southeast-2a"]
+    assert datasets.create_dataset(client, "train", "s3://data/train/", 300, zones) == snapshot_id
+    assert enabled == [("train", zones)]
+
+
+def test_build_user_data__quotes_source():
+    source_uri = "s3://data/my train/\nrm -rf /"
+    user_data = datasets.build_user_data("train", source_uri)
+    assert "aws s3 sync --quiet 's3://data/my train/\nrm -rf /' /mnt/dataset" in user_data
+    assert "# Generated by cjob: copies s3://data/my train/ rm -rf / onto" in user_data
+    assert "\nrm -rf" not in user_data.replace(shlex.quote(source_uri), "")
+
+
+def test_create_dataset__bad_name():
+    with pytest.raises(ValueError):
+        datasets.create_dataset(None, "../train", "s3://data/train/", 300)
+
+
+@mock_ec2
+def test_create_job__datasets(test_settings):
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    with pytest.raises(ValueError):
+        ec2.create_job(client, "cjob-foo", datasets=["train"])
+
+    snapshot_id = datasets.create_dataset(client, "train", "s3://data/train/", 300)
+    instance_id = ec2.create_job(client, "cjob-foo", "#!/bin/bash\necho hi", datasets=["train"])
+
+    response = client.describe_instances(InstanceIds=[instance_id])
+    mappings = response["Reservations"][0]["Instances"][0]["BlockDeviceMappings"]
+    mapping = next(m for m in mappings if m["DeviceName"] == "/dev/sdf")
+    volume = client.describe_volumes(VolumeIds=[mapping["Ebs"]["VolumeId"]])["Volumes"][0]
+    assert volume["SnapshotId"] == snapshot_id
+
+    response = client.describe_instance_attribute(InstanceId=instance_id, Attribute="userData")
+    message = message_from_string(base64.b64decode(response["UserData"]["Value"]).decode())
+    cloud_config, script = [part.get_payload() for part in message.get_payload()]
+    mounts = yaml.safe_load(cloud_config)["mounts"]
+    label = ec2.get_dataset_label("train")
+    assert mounts == [[f"LABEL={label}", "/mnt/datasets/train", "ext4", "defaults,nofail"]]
+    assert script == "#!/bin/bash\necho hi"
+
+
+@mock_ec2
+def test_cleanup_volumes(test_settings):
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    tags = [{"ResourceType": "volume", "Tags": [{"Key": ec2.MANAGED_TAG, "Value": "true"}]}]
+    zone = "ap-southeast-2a"
+    managed = client.create_volume(Size=10, AvailabilityZone=zone, TagSpecifications=tags)
+    other = client.create_volume(Size=10, AvailabilityZone=zone)
+    ec2.cleanup_volumes(client)
+    volume_ids = [v["VolumeId"] for v in client.describe_volumes()["Volumes"]]
+    assert managed["VolumeId"] not in volume_ids
+    assert other["VolumeId"] in volume_ids
@@ -87,3 +87,44 @@ def test_find_instance__with_mixed_instances__when_exists():
     assert instance.id == instance_id
     assert instance.name == name
     assert instance.state == "running"
+
+
+@mock_ec2
+def test_match_instances():
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    create_test_instance(client, "sweep-1")
+    id_a = create_test_instance(client, ec2.add_job_prefix("sweep-1"))
+    id_b = create_test_instance(client, ec2.add_job_prefix("sweep-2"))
+    id_c = create_test_instance(client, ec2.add_job_prefix("other"))
+    client.stop_instances(InstanceIds=[id_b])
+
+    instances = ec2.match_instances(client, "sweep-*")
+    assert [i.id for i in instances] == [id_a]
+
+    instances = ec2.match_instances(client, "other")
+    assert [i.id for i in instances] == [id_c]
+
+    instances = ec2.match_instances(client, "all")
+    assert sorted(i.id for i in instances) == sorted([id_a, id_c])
+
+
+@mock_ec2
+def test_get_instance_records():
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    create_test_instance(client, "foo")
+    tags = [
+        {"Key": "Name", "Value": ec2.add_job_prefix("mpi-1")},
+        {"Key": ec2.CLUSTER_TAG, "Value": ec2.add_job_prefix("mpi")},
+        {"Key": ec2.RANK_TAG, "Value": "1"},
+    ]
+    instance_id = create_test_instance(
+        client, "", TagSpecifications=[{"ResourceType": "instance", "Tags": tags}]
+    )
+    records = ec2.get_instance_records(client)
+    assert [r.id for r in records] == [instance_id]
+    record = records[0]
+    assert record.cluster == ec2.add_job_prefix("mpi")
+    assert record.rank == 1
+    assert record.is_running()
+    # Records convert to the same models that get_instances returns.
+    assert record.to_model() == ec2.get_instances(client)[0]
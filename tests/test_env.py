@@ -0,0 +1,77 @@
+"""
+Tests for cached Python environments.
+"""
+import os
+import shutil
+import subprocess
+
+import boto3
+import pytest
+from moto import mock_ec2, mock_s3
+
+from cjob import bundle, cache, ec2, env, metrics, s3, submit
+from tests.utils import settings_factory, create_test_s3_client
+
+
+@pytest.fixture
+def test_settings(monkeypatch, tmpdir):
+    get_test_settings = settings_factory(
+        S3_BUCKET_NAME="test-bucket",
+        EC2_AMI="ami-076a5bf4a712000ed",
+        EC2_IAM_INSTANCE_PROFILE="worker-profile",
+        EC2_KEY_FILE_PATH=os.path.join(tmpdir, "testkey.pem"),
+    )
+    for module in (bundle, cache, ec2, env, metrics, s3, submit):
+        monkeypatch.setattr(module, "get_settings", get_test_settings)
+
+    return get_test_settings()
+
+
+def test_get_env_files(tmpdir):
+    requirements_path = str(tmpdir.join("requirements.txt"))
+    assert env.get_env_files(requirements_path) == [requirements_path]
+
+    lockfile_path = str(tmpdir.join("poetry.lock"))
+    with pytest.raises(ValueError):
+        env.get_env_files(lockfile_path)
+
+    tmpdir.join("pyproject.toml").write("")
+    assert env.get_env_files(lockfile_path) == [lockfile_path, str(tmpdir.join("pyproject.toml"))]
+
+
+def test_build_env_script(test_settings):
+    script = env.build_env_script("$WORK_DIR/env/requirements.txt")
+    assert 'LOCKFILE="$WORK_DIR/env/requirements.txt"' in script
+    assert "ENV_URI=s3://test-bucket/envs/$ENV_HASH.tar.gz" in script
+    assert '"$ENV_DIR/bin/pip" install -q -r "$LOCKFILE"' in script
+    assert 'export PATH="$ENV_DIR/bin:$PATH"' in script
+    assert "poetry install" in env.build_env_script("$WORK_DIR/env/poetry.lock")
+
+
+@mock_ec2
+@mock_s3
+def test_submit_job__lockfile(test_settings, tmpdir):
+    ec2_client = boto3.client("ec2", region_name="ap-southeast-2")
+    s3_client = create_test_s3_client()
+    script_path = tmpdir.join("run.sh")
+    script_path.write("python -c 'import numpy'")
+    tmpdir.join("poetry.lock").write("")
+    tmpdir.join("pyproject.toml").write("")
+    submit.submit_job(
+        ec2_client,
+        s3_client,
+        "cjob-foo",
+        str(script_path),
+        lockfile_path=str(tmpdir.join("poetry.lock")),
+        bundle_hash="abc123",
+    )
+    keys = s3.list_s3_keys(s3_client, "jobs/cjob-foo/env/", "")
+    assert sorted(keys) == ["jobs/cjob-foo/env/poetry.lock", "jobs/cjob-foo/env/pyproject.toml"]
+
+
+@pytest.mark.skipif(not shutil.which("bash"), reason="bash is not installed")
+def test_user_data__syntax(test_settings):
+    setup = env.build_env_script("$WORK_DIR/env/poetry.lock")
+    setup += bundle.build_fetch_script("abc123", "$WORK_DIR/code")
+    user_data = submit.build_user_data("cjob-foo", setup, cache_key="def456")
+    subprocess.run(["bash", "-n"], input=user_data.encode(), check=True)
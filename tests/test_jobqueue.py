@@ -0,0 +1,151 @@
+"""
+Tests for the job queue and scheduler.
+"""
+import os
+from datetime import datetime
+
+import boto3
+from moto import mock_ec2
+
+from cjob import ec2, jobqueue
+from cjob.jobqueue import JobQueue, JobState, QueuedJob, Scheduler
+from tests.utils import settings_factory, create_test_instance
+
+
+def _job(job_id, cpus, memory_mb):
+    return QueuedJob(
+        id=job_id,
+        command="true",
+        cpus=cpus,
+        memory_mb=memory_mb,
+        state=JobState.queued,
+        created_at=datetime.utcnow(),
+    )
+
+
+def test_pack_jobs__first_fit_decreasing():
+    jobs = [_job(1, 1, 1000), _job(2, 3, 1000), _job(3, 2, 1000), _job(4, 2, 6000)]
+    free = {"a": (4, 8000), "b": (2, 2000)}
+    assignments, unplaced = jobqueue.pack_jobs(jobs, free)
+    # Biggest jobs first: 2 -> a, 3 -> b, 4 doesn't fit (a has 1 CPU left), 1 -> a.
+    assert assignments == {2: "a", 3: "b", 1: "a"}
+    assert [j.id for j in unplaced] == [4]
+
+
+def test_job_queue(tmpdir):
+    queue = JobQueue(os.path.join(tmpdir, "queue.db"))
+    id_a = queue.add("echo a", cpus=2, memory_mb=512)
+    id_b = queue.add("echo b")
+    assert [j.id for j in queue.get_jobs(JobState.queued)] == [id_a, id_b]
+
+    queue.mark_running(id_a, "cjob-pool-1")
+    queue.mark_running(id_b, "cjob-pool-1")
+    queue.mark_finished(id_a, 0)
+    queue.mark_finished(id_b, 1)
+    jobs = queue.get_jobs()
+    assert [j.state for j in jobs] == [JobState.succeeded, JobState.failed]
+    assert jobs[0].cpus == 2
+    assert jobs[0].instance == "cjob-pool-1"
+    assert jobs[0].finished_at >= jobs[0].started_at
+
+    queue.requeue(id_b)
+    assert [j.id for j in queue.get_jobs(JobState.queued)] == [id_b]
+
+
+@mock_ec2
+def test_scheduler__packs_jobs_and_launches_instances(monkeypatch, tmpdir):
+    monkeypatch.setattr(jobqueue, "get_settings", settings_factory(EC2_INSTANCE_TYPE="m5.large"))
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    queue = JobQueue(os.path.join(tmpdir, "queue.db"))
+    for _ in range(5):
+        queue.add("sleep 1", cpus=1, memory_mb=1024)
+
+    queue.add("huge", cpus=64, memory_mb=1024)
+    scheduler = Scheduler(client, queue, max_instances=2)
+    # m5.large has 2 vCPUs and 8 GB of memory, 10% of which is left for the OS.
+    assert scheduler.capacity == (2, 7373)
+
+    launched = []
+    monkeypatch.setattr(Scheduler, "_launch", lambda self: launched.append(1))
+    scheduler.step()
+    # 5 one-CPU jobs need 3 instances, but the pool is capped at 2.
+    assert len(launched) == 2
+    assert queue.get_jobs(JobState.failed)[0].command == "huge"
+
+    # Once an instance is ready, two jobs start on it.
+    started = []
+    monkeypatch.setattr(Scheduler, "_start_job", lambda self, j, p: started.append((j.id, p.name)))
+    create_test_instance(client, ec2.add_job_prefix("pool-1"))
+    pool_instance = jobqueue.PoolInstance("cjob-pool-1", scheduler.capacity)
+    pool_instance.instance = ec2.get_instances(client)[0]
+    scheduler.pool["cjob-pool-1"] = pool_instance
+    launched.clear()
+    scheduler.step()
+    assert len(started) == 2
+    assert all(name == "cjob-pool-1" for _, name in started)
+    assert len(launched) == 1
+    assert "Queued: 5" in scheduler.report()
+
+
+@mock_ec2
+def test_scheduler__adopts_only_its_own_instances(monkeypatch, tmpdir):
+    monkeypatch.setattr(jobqueue, "get_settings", settings_factory(EC2_INSTANCE_TYPE="m5.large"))
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    queue = JobQueue(os.path.join(tmpdir, "queue.db"))
+    # The queue keeps its ID when it's reopened.
+    assert JobQueue(os.path.join(tmpdir, "queue.db")).queue_id == queue.queue_id
+    other_queue = JobQueue(os.path.join(tmpdir, "other.db"))
+    assert other_queue.queue_id != queue.queue_id
+    for name, queue_id in [("pool-3", queue.queue_id), ("pool-7", other_queue.queue_id)]:
+        instance_id = create_test_instance(client, ec2.add_job_prefix(name))
+        client.create_tags(
+            Resources=[instance_id], Tags=[{"Key": ec2.QUEUE_TAG, "Value": queue_id}]
+        )
+
+    create_test_instance(client, ec2.add_job_prefix("pool-9"))
+    scheduler = Scheduler(client, queue, max_instances=2)
+    scheduler._adopt_instances()
+    assert list(scheduler.pool.keys()) == ["cjob-pool-3"]
+    assert scheduler._instance_count == 3
+
+
+@mock_ec2
+def test_scheduler__gives_up_after_failed_launches(monkeypatch, tmpdir):
+    monkeypatch.setattr(jobqueue, "get_settings", settings_factory(EC2_INSTANCE_TYPE="m5.large"))
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    queue = JobQueue(os.path.join(tmpdir, "queue.db"))
+    job_id = queue.add("true")
+    scheduler = Scheduler(client, queue, max_instances=2)
+
+    def create_job(*args, **kwargs):
+        raise RuntimeError("Insufficient capacity")
+
+    monkeypatch.setattr(ec2, "create_job", create_job)
+    monkeypatch.setattr(ec2, "stop_job", lambda client, job_id: None)
+    launched = []
+
+    def launch(self):
+        pool_instance = jobqueue.PoolInstance(f"cjob-pool-{len(launched)}", self.capacity)
+        self.pool[pool_instance.name] = pool_instance
+        launched.append(pool_instance)
+
+    monkeypatch.setattr(Scheduler, "_launch", launch)
+    scheduler.step()
+    scheduler._boot(launched[-1])
+    assert scheduler._boot_failures == 1
+    # The next launch waits for a backoff.
+    scheduler.step()
+    assert len(launched) == 1
+
+    for _ in range(jobqueue.MAX_BOOT_ATTEMPTS - 1):
+        scheduler._launch_after = 0
+        scheduler.step()
+        scheduler._boot(launched[-1])
+
+    assert len(launched) == jobqueue.MAX_BOOT_ATTEMPTS
+    assert queue.get_jobs(JobState.queued)[0].id == job_id
+    # Rather than launching again, the job is failed.
+    scheduler._launch_after = 0
+    scheduler.step()
+    assert len(launched) == jobqueue.MAX_BOOT_ATTEMPTS
+    assert queue.get_jobs(JobState.failed)[0].id == job_id
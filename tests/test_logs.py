@@ -0,0 +1,61 @@
+"""
+Tests for archiving job logs to S3.
+"""
+import gzip
+
+from moto import mock_s3
+
+from cjob import logs, s3
+from tests.utils import settings_factory, create_test_s3_client
+
+
+@mock_s3
+def test_log_archiver__uploads_size_bounded_chunks(monkeypatch):
+    get_test_settings = settings_factory(S3_BUCKET_NAME="test-bucket")
+    monkeypatch.setattr(logs, "get_settings", get_test_settings)
+    monkeypatch.setattr(s3, "get_settings", get_test_settings)
+    client = create_test_s3_client()
+    archiver = logs.LogArchiver(client, "logs/cjob-test/run", max_bytes=50)
+    lines = [f"line number {i}" for i in range(10)]
+    for line in lines:
+        archiver.write(line)
+
+    keys = s3.list_s3_keys(client, "logs/cjob-test/", ".log.gz")
+    # Each chunk is uploaded once it has 50 bytes (4 lines), the rest waits for a flush.
+    assert len(keys) == 2
+    archiver.flush()
+    keys = s3.list_s3_keys(client, "logs/cjob-test/", ".log.gz")
+    assert len(keys) == 3
+    assert keys[0] == "logs/cjob-test/run/000001.log.gz"
+    assert list(logs.read_logs(client, "cjob-test")) == lines
+
+
+def test_log_archiver__is_stale():
+    archiver = logs.LogArchiver(None, "logs/cjob-test/run", max_seconds=0)
+    assert not archiver.is_stale()
+    archiver.write("hello")
+    assert archiver.is_stale()
+
+
+@mock_s3
+def test_read_logs__latest_run_only(monkeypatch):
+    get_test_settings = settings_factory(S3_BUCKET_NAME="test-bucket")
+    monkeypatch.setattr(logs, "get_settings", get_test_settings)
+    monkeypatch.setattr(s3, "get_settings", get_test_settings)
+    client = create_test_s3_client()
+    # Each run starts from the top of the log, so only the latest one is read.
+    for run, lines in [("20210101T000000", ["a"]), ("20210101T000100", ["a", "b"])]:
+        archiver = logs.LogArchiver(client, f"logs/cjob-test/{run}")
+        for line in lines:
+            archiver.write(line)
+
+        archiver.flush()
+
+    assert list(logs.read_logs(client, "cjob-test")) == ["a", "b"]
+
+    # The complete log uploaded when the job finishes is preferred.
+    body = gzip.compress(b"a\nb\nc\n")
+    key = logs.get_complete_log_key("cjob-test")
+    client.put_object(Bucket="test-bucket", Key=key, Body=body)
+    assert list(logs.read_logs(client, "cjob-test")) == ["a", "b", "c"]
+    assert list(logs.read_logs(client, "cjob-missing")) == []
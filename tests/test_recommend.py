@@ -0,0 +1,299 @@
+import sys
+import json
+import time
+import shutil
+import subprocess
+from datetime import datetime
+
+import boto3
+import pytest
+from moto import mock_s3
+from botocore.stub import Stubber
+
+from cjob import metrics, recommend, s3, submit
+from cjob.metrics import JobRecord, JobUsage
+from cjob.recommend import InstanceTypeInfo
+from tests.utils import settings_factory, create_test_s3_client
+
+GIB = 1024 ** 3
+
+
+@pytest.fixture
+def test_settings(monkeypatch):
+    get_test_settings = settings_factory(S3_BUCKET_NAME="test-bucket")
+    for module in (metrics, recommend, s3, submit):
+        monkeypatch.setattr(module, "get_settings", get_test_settings)
+
+    return get_test_settings()
+
+
+INSTANCE_TYPES = {
+    t.name: t
+    for t in [
+        InstanceTypeInfo(
+            name="r5.2xlarge",
+            vcpus=8,
+            memory_mib=65536,
+            architectures=["x86_64"],
+            is_burstable=False,
+        ),
+        InstanceTypeInfo(
+            name="m5.large", vcpus=2, memory_mib=8192, architectures=["x86_64"], is_burstable=False
+        ),
+        InstanceTypeInfo(
+            name="c5.xlarge", vcpus=4, memory_mib=8192, architectures=["x86_64"], is_burstable=False
+        ),
+        InstanceTypeInfo(
+            name="t3.large", vcpus=2, memory_mib=8192, architectures=["x86_64"], is_burstable=True
+        ),
+        InstanceTypeInfo(
+            name="m6g.large", vcpus=2, memory_mib=8192, architectures=["arm64"], is_burstable=False
+        ),
+        InstanceTypeInfo(
+            name="c5.large", vcpus=2, memory_mib=4096, architectures=["x86_64"], is_burstable=False
+        ),
+    ]
+}
+PRICES = {"r5.2xlarge": 0.6, "m5.large": 0.12, "c5.xlarge": 0.2, "t3.large": 0.1, "m6g.large": 0.1}
+
+
+def build_usage(job_id="cjob-foo", **kwargs) -> JobUsage:
+    return JobUsage(
+        **{
+            "job_id": job_id,
+            "instance_type": "r5.2xlarge",
+            "runtime_seconds": 3600,
+            "peak_cpu_percent": 15,
+            "mean_cpu_percent": 10,
+            "peak_memory_bytes": 5 * GIB,
+            "peak_disk_used_bytes": 0,
+            "peak_disk_bytes_per_second": 0,
+            "peak_net_bytes_per_second": 0,
+            **kwargs,
+        }
+    )
+
+
+def build_samples(cpu_percents, memory_bytes=GIB):
+    return [
+        {
+            "time": 1000 + metrics.SAMPLE_SECONDS * i,
+            "cpu_percent": cpu_percent,
+            "memory_bytes": memory_bytes,
+            "disk_used_bytes": 2 * GIB,
+            "disk_read_bytes_per_second": 100,
+            "disk_write_bytes_per_second": 50,
+            "net_rx_bytes_per_second": 10,
+            "net_tx_bytes_per_second": 5,
+        }
+        for i, cpu_percent in enumerate(cpu_percents)
+    ]
+
+
+def test_summarize_usage():
+    record = JobRecord(
+        job_id="cjob-foo",
+        instance_type="r5.2xlarge",
+        script_hash="abc",
+        submitted_at=datetime.utcnow(),
+    )
+    assert metrics.summarize_usage(record, []) is None
+
+    usage = metrics.summarize_usage(record, build_samples([10, 50, 30]))
+    assert usage.runtime_seconds == 3 * metrics.SAMPLE_SECONDS
+    assert usage.peak_cpu_percent == 50
+    assert usage.mean_cpu_percent == 30
+    assert usage.peak_memory_bytes == GIB
+    assert usage.peak_disk_bytes_per_second == 150
+    assert usage.peak_net_bytes_per_second == 15
+
+
+def test_find_candidates():
+    # 15% of 8 vCPUs is 1.2 cores, so 2 vCPUs with headroom, and 6 GiB of memory.
+    candidates = recommend.find_candidates([build_usage()], INSTANCE_TYPES, "r5.2xlarge")
+    assert [t.name for t in candidates] == ["m5.large", "c5.xlarge", "r5.2xlarge"]
+
+    # The peak of every job must fit.
+    usages = [build_usage(), build_usage("cjob-bar", peak_cpu_percent=40)]
+    candidates = recommend.find_candidates(usages, INSTANCE_TYPES, "r5.2xlarge")
+    assert [t.name for t in candidates] == ["c5.xlarge", "r5.2xlarge"]
+
+
+def test_find_candidates__bandwidth():
+    instance_types = {
+        **INSTANCE_TYPES,
+        "m5.large": INSTANCE_TYPES["m5.large"].copy(update={"network_gbps": 0.75}),
+        "c5.xlarge": INSTANCE_TYPES["c5.xlarge"].copy(update={"ebs_mbps": 1150}),
+    }
+    # 100 MB/s of network traffic is 0.8 Gbps, and 200 MB/s of disk traffic is 1600 Mbps.
+    usage = build_usage(peak_net_bytes_per_second=100 * 1000 ** 2)
+    candidates = recommend.find_candidates([usage], instance_types, "r5.2xlarge")
+    assert [t.name for t in candidates] == ["c5.xlarge", "r5.2xlarge"]
+    usage = build_usage(peak_disk_bytes_per_second=200 * 1000 ** 2)
+    candidates = recommend.find_candidates([usage], instance_types, "r5.2xlarge")
+    assert [t.name for t in candidates] == ["m5.large", "r5.2xlarge"]
+
+
+def test_find_candidates__previous_generation():
+    # Jobs can run on previous generation types, but they aren't recommended.
+    m4_large = InstanceTypeInfo(
+        name="m4.large",
+        vcpus=2,
+        memory_mib=8192,
+        architectures=["x86_64"],
+        is_burstable=False,
+        is_current_generation=False,
+    )
+    instance_types = {**INSTANCE_TYPES, "m4.large": m4_large}
+    usage = build_usage(instance_type="m4.large", peak_memory_bytes=GIB, peak_cpu_percent=25)
+    candidates = recommend.find_candidates([usage], instance_types, "m4.large")
+    assert [t.name for t in candidates] == ["c5.large", "m5.large", "c5.xlarge", "r5.2xlarge"]
+
+    with pytest.raises(ValueError):
+        recommend.find_candidates([usage], INSTANCE_TYPES, "m4.large")
+
+
+def test_get_instance_types():
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    response = {
+        "InstanceTypes": [
+            {
+                "InstanceType": "m4.large",
+                "CurrentGeneration": False,
+                "VCpuInfo": {"DefaultVCpus": 2},
+                "MemoryInfo": {"SizeInMiB": 8192},
+                "ProcessorInfo": {"SupportedArchitectures": ["x86_64"]},
+                "NetworkInfo": {"NetworkPerformance": "Moderate"},
+                "EbsInfo": {"EbsOptimizedInfo": {"BaselineBandwidthInMbps": 450}},
+            },
+            {
+                "InstanceType": "m5.large",
+                "CurrentGeneration": True,
+                "VCpuInfo": {"DefaultVCpus": 2},
+                "MemoryInfo": {"SizeInMiB": 8192},
+                "ProcessorInfo": {"SupportedArchitectures": ["x86_64"]},
+                "NetworkInfo": {
+                    "NetworkPerformance": "Up to 10 Gigabit",
+                    "NetworkCards": [{"BaselineBandwidthInGbps": 0.75}],
+                },
+            },
+        ]
+    }
+    with Stubber(client) as stubber:
+        stubber.add_response("describe_instance_types", response)
+        instance_types = recommend.get_instance_types(client)
+
+    assert not instance_types["m4.large"].is_current_generation
+    assert instance_types["m4.large"].network_gbps is None
+    assert instance_types["m4.large"].ebs_mbps == 450
+    assert instance_types["m5.large"].is_current_generation
+    assert instance_types["m5.large"].network_gbps == 0.75
+    assert instance_types["m5.large"].ebs_mbps is None
+
+
+def test_recommend():
+    recommendations = recommend.recommend([build_usage()], INSTANCE_TYPES, PRICES, "r5.2xlarge")
+    assert [r.instance_type for r in recommendations] == ["m5.large", "c5.xlarge", "r5.2xlarge"]
+    best = recommendations[0]
+    assert best.projected_runtime_seconds == 3600
+    assert best.projected_cost == pytest.approx(0.12)
+    assert best.cost_change_percent == pytest.approx(-80)
+    assert recommendations[-1].cost_change_percent == pytest.approx(0)
+
+
+def test_recommend__cpu_bound():
+    # A job using 3 cores on average would slow down with fewer vCPUs.
+    usage = build_usage(peak_cpu_percent=50, mean_cpu_percent=37.5, peak_memory_bytes=GIB)
+    recommendations = recommend.recommend([usage], INSTANCE_TYPES, PRICES, "r5.2xlarge", 0.5)
+    runtimes = {r.instance_type: r.projected_runtime_seconds for r in recommendations}
+    assert runtimes == {"m5.large": 5400, "c5.xlarge": 3600, "r5.2xlarge": 3600}
+
+
+@mock_s3
+def test_recommend_for_job(test_settings, monkeypatch):
+    s3_client = create_test_s3_client()
+    for job_id, script_hash, cpu_percent in [
+        ("cjob-foo", "abc", 10),
+        ("cjob-bar", "abc", 15),
+        ("cjob-baz", "def", 90),
+    ]:
+        record = JobRecord(
+            job_id=job_id,
+            instance_type="r5.2xlarge",
+            script_hash=script_hash,
+            submitted_at=datetime.utcnow(),
+        )
+        job_key = submit.get_job_key(job_id)
+        metrics.write_job_record(s3_client, job_key, record)
+        header = ",".join(metrics.METRICS_COLUMNS)
+        rows = [",".join(str(v) for v in s.values()) for s in build_samples([cpu_percent] * 3)]
+        body = "\n".join([header] + rows) + "\n"
+        s3_client.put_object(Bucket="test-bucket", Key=f"{job_key}/metrics.csv", Body=body)
+
+    records = metrics.get_job_records(s3_client, submit.JOBS_KEY_PREFIX)
+    assert [r.job_id for r in records] == ["cjob-foo", "cjob-bar", "cjob-baz"]
+    assert metrics.read_metrics(s3_client, "jobs/cjob-missing") == []
+
+    priced = []
+
+    def get_prices(ec2_client, pricing_client, instance_types):
+        priced.extend(instance_types)
+        return PRICES
+
+    monkeypatch.setattr(recommend, "get_instance_types", lambda client: INSTANCE_TYPES)
+    monkeypatch.setattr(recommend, "get_prices", get_prices)
+    usages, recommendations = recommend.recommend_for_job(None, s3_client, None, "cjob-foo")
+    # Only jobs running the same script are used.
+    assert sorted(u.job_id for u in usages) == ["cjob-bar", "cjob-foo"]
+    assert priced == ["r5.2xlarge", "c5.large", "m5.large", "c5.xlarge", "r5.2xlarge"]
+    assert recommendations[0].instance_type == "m5.large"
+
+    with pytest.raises(ValueError):
+        recommend.recommend_for_job(None, s3_client, None, "cjob-missing")
+
+
+def test_get_on_demand_price(test_settings):
+    client = boto3.client("pricing", region_name="us-east-1")
+    product = {
+        "terms": {
+            "OnDemand": {
+                "ABC.XYZ": {"priceDimensions": {"ABC.XYZ.123": {"pricePerUnit": {"USD": "0.5"}}}}
+            }
+        }
+    }
+    with Stubber(client) as stubber:
+        stubber.add_response("get_products", {"PriceList": [json.dumps(product)]})
+        stubber.add_response("get_products", {"PriceList": []})
+        prices = recommend.get_prices(None, client, ["r5.2xlarge", "x9.huge"])
+
+    assert prices == {"r5.2xlarge": 0.5}
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Sampler reads /proc")
+def test_sampler(tmpdir):
+    path = str(tmpdir.join("metrics.csv"))
+    script_path = tmpdir.join("sampler.py")
+    script_path.write(metrics.SAMPLER_SCRIPT)
+    header = ",".join(metrics.METRICS_COLUMNS)
+    process = subprocess.Popen([sys.executable, str(script_path), path, "0.1", header])
+    try:
+        time.sleep(0.5)
+    finally:
+        process.kill()
+        process.wait()
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+
+    assert lines[0] == header
+    assert len(lines) > 1
+    assert all(len(line.split(",")) == len(metrics.METRICS_COLUMNS) for line in lines[1:])
+
+
+@pytest.mark.skipif(not shutil.which("bash"), reason="bash is not installed")
+def test_user_data__sampler(test_settings):
+    user_data = submit.build_user_data("cjob-foo")
+    assert "nohup python3 /tmp/cjob-sampler.py /var/log/cjob-metrics.csv" in user_data
+    # The sampler starts before the script is run.
+    assert user_data.index("cjob-sampler.py") < user_data.index("bash script.sh")
+    subprocess.run(["bash", "-n"], input=user_data.encode(), check=True)
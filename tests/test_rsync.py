@@ -0,0 +1,96 @@
+"""
+Tests for copying files to and from instances.
+"""
+from datetime import datetime
+
+from cjob import rsync
+from cjob.ec2 import EC2Instance
+
+
+def _instance():
+    return EC2Instance(
+        id="i-123",
+        name="cjob-test",
+        ip="1.2.3.4",
+        type="t3.small",
+        launched_at=datetime.utcnow(),
+        state="running",
+    )
+
+
+def test_split_files__balances_sizes():
+    files = [("a", 100), ("b", 60), ("c", 50), ("d", 40), ("e", 10)]
+    groups = rsync.split_files(files, 2)
+    assert groups == [["a", "d"], ["b", "c", "e"]]
+
+
+def test_split_files__fewer_files_than_streams():
+    groups = rsync.split_files([("a", 1)], 4)
+    assert groups == [["a"]]
+
+
+def test_build_rsync_args__uses_ssh_key_and_options():
+    args = rsync.build_rsync_args(_instance(), "/keys/test.pem", ["src/", "dest/"])
+    assert args[:2] == ["rsync", "--archive"]
+    ssh_cmd = args[args.index("-e") + 1]
+    assert ssh_cmd.startswith("ssh ")
+    assert "-i /keys/test.pem" in ssh_cmd
+    assert "ubuntu@" not in ssh_cmd
+    assert args[-2:] == ["src/", "dest/"]
+
+
+def test_push__small_folder_uses_one_stream(monkeypatch, tmpdir):
+    tmpdir.join("a.txt").write("hello")
+    tmpdir.mkdir("sub").join("b.txt").write("world")
+    calls = []
+    monkeypatch.setattr(rsync.subprocess, "call", lambda cmd, env=None: calls.append(cmd) or 0)
+    exit_code = rsync.push(_instance(), str(tmpdir), "/home/ubuntu/code", "key.pem")
+    assert exit_code == 0
+    assert len(calls) == 1
+    assert calls[0][-2:] == [f"{tmpdir}/", "ubuntu@1.2.3.4:/home/ubuntu/code/"]
+
+
+def test_push__large_folder_uses_many_streams(monkeypatch, tmpdir):
+    for i in range(8):
+        tmpdir.join(f"{i}.bin").write("x" * 100)
+
+    monkeypatch.setattr(rsync, "MIN_PARALLEL_BYTES", 10)
+    calls = []
+    monkeypatch.setattr(rsync.subprocess, "call", lambda cmd, env=None: calls.append(cmd) or 0)
+    exit_code = rsync.push(_instance(), str(tmpdir), "/data", "key.pem", streams=4)
+    assert exit_code == 0
+    assert len(calls) == 4
+    assert all(any(a.startswith("--files-from=") for a in cmd) for cmd in calls)
+    assert all("ControlPath=none" in cmd[cmd.index("-e") + 1] for cmd in calls)
+
+
+def test_push__many_streams_copy_empty_folders(monkeypatch, tmpdir):
+    for i in range(4):
+        tmpdir.join(f"{i}.bin").write("x" * 100)
+
+    tmpdir.mkdir("empty").mkdir("nested")
+    monkeypatch.setattr(rsync, "MIN_PARALLEL_BYTES", 10)
+    files_from = []
+
+    def call(cmd, env=None):
+        path = next(a for a in cmd if a.startswith("--files-from="))[len("--files-from=") :]
+        with open(path) as f:
+            files_from.extend(f.read().split())
+
+        return 0
+
+    monkeypatch.setattr(rsync.subprocess, "call", call)
+    assert rsync.push(_instance(), str(tmpdir), "/data", "key.pem", streams=2) == 0
+    assert sorted(files_from) == ["0.bin", "1.bin", "2.bin", "3.bin", "empty", "empty/nested"]
+
+
+def test_push__quotes_remote_path(monkeypatch, tmpdir):
+    tmpdir.join("a.txt").write("hello")
+    calls = []
+    monkeypatch.setattr(rsync.subprocess, "call", lambda cmd, env=None: calls.append(env) or 0)
+    rsync.push(_instance(), str(tmpdir.join("a.txt")), "~/my data/a.txt", "key.pem")
+    assert rsync._remote(_instance(), "~/my data") == "ubuntu@1.2.3.4:~/'my data'"
+    assert rsync._remote(_instance(), "/tmp/x y") == "ubuntu@1.2.3.4:'/tmp/x y'"
+    assert rsync._remote(_instance(), "~") == "ubuntu@1.2.3.4:~"
+    # Stop newer rsync versions from escaping the quoted path again.
+    assert calls[0]["RSYNC_OLD_ARGS"] == "1"
@@ -0,0 +1,17 @@
+"""
+Tests for S3 transfer helpers.
+"""
+from cjob import s3
+
+MIB = 1024 ** 2
+
+
+def test_get_part_size():
+    # Small files use the smallest part size.
+    assert s3.get_part_size(20 * MIB) == 8 * MIB
+    assert s3.get_part_size(s3.MAX_PARTS * 8 * MIB) == 8 * MIB
+    # Bigger files use bigger parts, so that they fit in S3's 10,000 parts.
+    size = 200 * 1024 ** 3 + 1
+    part_size = s3.get_part_size(size)
+    assert part_size > 8 * MIB
+    assert len(range(0, size, part_size)) == s3.MAX_PARTS
@@ -0,0 +1,127 @@
+"""
+Tests for running commands on instances over SSH.
+
+The integration test needs a reachable sshd, for example a local container:
+
+    docker run -d -p 2222:2222 -e PUBLIC_KEY="$(cat key.pub)" -e USER_NAME=ubuntu \
+        linuxserver/openssh-server
+
+    CJOB_TEST_SSH_HOST=localhost CJOB_TEST_SSH_PORT=2222 CJOB_TEST_SSH_KEY=key pytest
+"""
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+from cjob import ssh
+from cjob.ec2 import EC2Instance
+
+
+def _instance(ip="1.2.3.4", name="cjob-test"):
+    return EC2Instance(
+        id="i-123",
+        name=name,
+        ip=ip,
+        type="t3.small",
+        launched_at=datetime.utcnow(),
+        state="running",
+    )
+
+
+def _run_locally(monkeypatch):
+    """Replace ssh with a local shell, so that the command runs on this machine"""
+    monkeypatch.setattr(ssh, "build_ssh_args", lambda *args, **kwargs: ["sh", "-c"])
+
+
+def test_build_ssh_args__uses_multiplexing():
+    args = ssh.build_ssh_args("1.2.3.4", "/keys/test.pem", port=2222)
+    assert args[0] == "ssh"
+    assert args[-1] == "ubuntu@1.2.3.4"
+    assert "ControlMaster=auto" in args
+    assert "ControlPersist=10m" in args
+    assert args[args.index("-i") + 1] == "/keys/test.pem"
+    assert args[args.index("-p") + 1] == "2222"
+
+
+def test_ssh_interactive__logs_copyable_command(monkeypatch, caplog):
+    calls = []
+    monkeypatch.setattr(ssh.subprocess, "call", calls.append)
+    caplog.set_level("INFO")
+    ssh.ssh_interactive(_instance(), "/my keys/test.pem")
+    assert calls[0][calls[0].index("-i") + 1] == "/my keys/test.pem"
+    assert "-i '/my keys/test.pem'" in caplog.text
+
+
+def test_run__streams_output_and_returns_exit_code(monkeypatch):
+    _run_locally(monkeypatch)
+    out, err = [], []
+    cmd = "echo hello; echo oops >&2; echo world; exit 3"
+    code = ssh.run(_instance(), cmd, "key.pem", stdout=out.append, stderr=err.append)
+    assert code == 3
+    assert out == ["hello", "world"]
+    assert err == ["oops"]
+
+
+def test_run__times_out(monkeypatch):
+    _run_locally(monkeypatch)
+    monkeypatch.setattr(ssh, "READER_JOIN_TIMEOUT", 0.5)
+    start = time.time()
+    # The shell is killed, but its child keeps the output pipes open.
+    code = ssh.run(_instance(), "sleep 10; echo done", "key.pem", stdout=print, timeout=0.5)
+    assert code is None
+    assert time.time() - start < 5
+
+
+@pytest.mark.parametrize(
+    "output, exit_code, expected",
+    [("status: done", 0, True), ("status: error", 1, False), ("status: error", 0, False)],
+)
+def test_wait_for_user_data(monkeypatch, tmpdir, output, exit_code, expected):
+    _run_locally(monkeypatch)
+    # Older cloud-init versions exit with 0 even when the user data failed.
+    cloud_init = tmpdir.join("cloud-init")
+    cloud_init.write(f"#!/bin/sh\necho .....\necho '{output}'\nexit {exit_code}\n")
+    cloud_init.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmpdir}:{os.environ['PATH']}")
+    assert ssh.wait_for_user_data(_instance(), "key.pem") == expected
+
+
+def test_run_many__prefixes_output_and_collects_exit_codes(monkeypatch, capsys):
+    _run_locally(monkeypatch)
+    instances = [_instance(name=f"cjob-{i}") for i in range(5)]
+    exit_codes = ssh.run_many(instances, "echo hello; exit 2", "key.pem", max_workers=2)
+    assert exit_codes == {f"cjob-{i}": 2 for i in range(5)}
+    lines = capsys.readouterr().out.splitlines()
+    assert sorted(lines) == sorted([f"[cjob-{i}] hello" for i in range(5)])
+
+
+def test_close_connection__without_ssh_client(monkeypatch):
+    def missing_ssh(*args, **kwargs):
+        raise FileNotFoundError("ssh")
+
+    monkeypatch.setattr(ssh.subprocess, "call", missing_ssh)
+    ssh.close_connection(_instance(), "key.pem")
+
+
+def test_control_dir__is_private():
+    ssh.build_ssh_args("1.2.3.4", "key.pem")
+    info = os.stat(ssh.CONTROL_DIR)
+    assert info.st_uid == os.getuid()
+    assert info.st_mode & 0o777 == 0o700
+
+
+@pytest.mark.skipif(not os.environ.get("CJOB_TEST_SSH_HOST"), reason="No test sshd configured")
+def test_run__against_sshd():
+    instance = _instance(ip=os.environ["CJOB_TEST_SSH_HOST"])
+    key = os.environ["CJOB_TEST_SSH_KEY"]
+    port = int(os.environ.get("CJOB_TEST_SSH_PORT", 22))
+    user = os.environ.get("CJOB_TEST_SSH_USER", ssh.SSH_USER)
+    try:
+        for i in range(3):
+            out = []
+            code = ssh.run(instance, f"echo {i}", key, stdout=out.append, user=user, port=port)
+            assert code == 0
+            assert out == [str(i)]
+    finally:
+        ssh.close_connection(instance, key, user=user, port=port)
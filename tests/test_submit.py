@@ -0,0 +1,88 @@
+"""
+Tests for fire-and-forget jobs.
+"""
+import os
+import base64
+
+import boto3
+import pytest
+from moto import mock_ec2, mock_s3
+
+from cjob import ec2, metrics, s3, submit
+from tests.utils import settings_factory, create_test_s3_client
+
+
+@pytest.fixture
+def test_settings(monkeypatch, tmpdir):
+    get_test_settings = settings_factory(
+        S3_BUCKET_NAME="test-bucket",
+        EC2_AMI="ami-076a5bf4a712000ed",
+        EC2_IAM_INSTANCE_PROFILE="worker-profile",
+        EC2_KEY_FILE_PATH=os.path.join(tmpdir, "testkey.pem"),
+    )
+    for module in (ec2, metrics, s3, submit):
+        monkeypatch.setattr(module, "get_settings", get_test_settings)
+
+    return get_test_settings()
+
+
+def test_build_user_data(test_settings):
+    user_data = submit.build_user_data("cjob-foo", setup="echo setup")
+    assert user_data.startswith("#!/bin/bash\n")
+    assert "JOB_URI=s3://test-bucket/jobs/cjob-foo" in user_data
+    assert "export AWS_DEFAULT_REGION=ap-southeast-2" in user_data
+    assert "echo setup" in user_data
+    assert "shutdown -h now" in user_data
+    # The whole log is archived before the status is written.
+    assert "LOG_URI=s3://test-bucket/logs/cjob-foo/complete.log.gz" in user_data
+    assert user_data.index("gzip -c /var/log/cloud-init-output.log") < user_data.index(
+        "$JOB_URI/status"
+    )
+
+
+@mock_ec2
+@mock_s3
+def test_submit_job(test_settings, tmpdir):
+    ec2_client = boto3.client("ec2", region_name="ap-southeast-2")
+    s3_client = create_test_s3_client()
+    script_path = tmpdir.join("run.sh")
+    script_path.write("echo hello > outputs/hello.txt")
+    input_dir = tmpdir.mkdir("data")
+    input_dir.join("a.csv").write("1,2,3")
+
+    instance_id = submit.submit_job(
+        ec2_client, s3_client, "cjob-foo", str(script_path), [str(input_dir)]
+    )
+    keys = s3.list_s3_keys(s3_client, "jobs/cjob-foo/", "")
+    assert sorted(keys) == [
+        "jobs/cjob-foo/inputs/data/a.csv",
+        "jobs/cjob-foo/record.json",
+        "jobs/cjob-foo/script.sh",
+    ]
+    records = metrics.get_job_records(s3_client, submit.JOBS_KEY_PREFIX)
+    assert [(r.job_id, r.instance_type) for r in records] == [("cjob-foo", "r5.2xlarge")]
+
+    response = ec2_client.describe_instance_attribute(InstanceId=instance_id, Attribute="userData")
+    user_data = base64.b64decode(response["UserData"]["Value"]).decode()
+    assert user_data == submit.build_user_data("cjob-foo")
+    assert submit.get_job_status(s3_client, "cjob-foo") is None
+
+    # Pretend the instance finished the job.
+    s3_client.put_object(Bucket="test-bucket", Key="jobs/cjob-foo/status", Body=b"3\n")
+    s3_client.put_object(Bucket="test-bucket", Key="jobs/cjob-foo/outputs/hello.txt", Body=b"hi")
+    assert submit.wait_job(s3_client, "cjob-foo", ec2_client, poll_seconds=0) == 3
+    paths = submit.download_result(s3_client, "cjob-foo", str(tmpdir.join("results")))
+    assert paths == [str(tmpdir.join("results", "hello.txt"))]
+
+    # Resubmitting clears out the old results.
+    submit.upload_job_files(s3_client, "cjob-foo", str(script_path))
+    assert submit.get_job_status(s3_client, "cjob-foo") is None
+
+
+@mock_ec2
+@mock_s3
+def test_wait_job__instance_gone(test_settings):
+    ec2_client = boto3.client("ec2", region_name="ap-southeast-2")
+    s3_client = create_test_s3_client()
+    with pytest.raises(RuntimeError):
+        submit.wait_job(s3_client, "cjob-foo", ec2_client, poll_seconds=0)
@@ -0,0 +1,220 @@
+"""
+Tests for client-side rate limiting and retries.
+"""
+import time
+import asyncio
+
+import boto3
+import pytest
+from botocore.awsrequest import AWSResponse
+from botocore.config import Config
+from botocore.exceptions import ClientError, ReadTimeoutError
+from moto import mock_ec2
+
+from cjob import throttle
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture(autouse=True)
+def fresh_limiters(monkeypatch):
+    monkeypatch.setattr(throttle, "_limiters", {})
+
+
+class _RawBody:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+_THROTTLED_BODY = b"""<Response><Errors><Error>
+<Code>RequestLimitExceeded</Code><Message>Request limit exceeded.</Message>
+</Error></Errors><RequestID>abc</RequestID></Response>"""
+
+
+def _client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "DescribeInstances")
+
+
+def test_token_bucket__allows_burst_then_limits_rate():
+    clock = FakeClock()
+    bucket = throttle.TokenBucket(rate=10, capacity=5, clock=clock, sleeper=clock.sleep)
+    for _ in range(5):
+        bucket.acquire()
+
+    assert clock.now == 0
+    for _ in range(10):
+        bucket.acquire()
+
+    # 10 more tokens at 10 tokens per second.
+    assert clock.now == pytest.approx(1.0)
+
+
+def test_token_bucket__acquire_async():
+    bucket = throttle.TokenBucket(rate=50, capacity=2)
+    ticks = []
+
+    async def tick():
+        while len(ticks) < 10:
+            ticks.append(1)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        start = time.monotonic()
+        await asyncio.gather(tick(), *[bucket.acquire_async() for _ in range(6)])
+        return time.monotonic() - start
+
+    # The burst is free, then the other callers wait in turn, 20ms apart.
+    assert asyncio.run(run()) >= 0.075
+    # Waiting callers don't block the event loop.
+    assert len(ticks) == 10
+
+
+def test_token_bucket__penalize_and_reward():
+    clock = FakeClock()
+    bucket = throttle.TokenBucket(rate=8, capacity=5, clock=clock, sleeper=clock.sleep)
+    bucket.penalize()
+    assert bucket.rate == 4
+    assert bucket.tokens == 0
+    for _ in range(100):
+        bucket.reward()
+
+    assert bucket.rate == 8
+
+
+def test_backoff_delays__are_bounded():
+    delays = throttle.backoff_delays(base=1, cap=10)
+    for _ in range(100):
+        assert 1 <= next(delays) <= 10
+
+
+def test_with_backoff__retries_throttling_errors(monkeypatch):
+    monkeypatch.setattr(throttle, "sleep", lambda s: None)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _client_error("RequestLimitExceeded")
+
+        return "ok"
+
+    assert throttle.with_backoff(flaky)() == "ok"
+    assert len(calls) == 3
+
+
+def test_with_backoff__does_not_retry_other_errors(monkeypatch):
+    monkeypatch.setattr(throttle, "sleep", lambda s: None)
+    calls = []
+
+    def broken():
+        calls.append(1)
+        raise _client_error("InvalidInstanceID.NotFound")
+
+    with pytest.raises(ClientError):
+        throttle.with_backoff(broken)()
+
+    assert len(calls) == 1
+
+
+def test_with_backoff__does_not_retry_timeouts(monkeypatch):
+    """
+    Timed out requests may have reached AWS, so they are left to botocore,
+    which re-sends them with the same idempotency token.
+    """
+    monkeypatch.setattr(throttle, "sleep", lambda s: None)
+    calls = []
+
+    def timed_out():
+        calls.append(1)
+        raise ReadTimeoutError(endpoint_url="https://ec2.amazonaws.com")
+
+    with pytest.raises(ReadTimeoutError):
+        throttle.with_backoff(timed_out)()
+
+    assert len(calls) == 1
+    assert throttle.is_transient_error(ReadTimeoutError(endpoint_url="https://x"))
+
+
+def test_get_family__splits_mutating_ec2_calls():
+    assert throttle.get_family("ec2", "DescribeInstances") == "ec2"
+    assert throttle.get_family("ec2", "TerminateInstances") == "ec2-mutating"
+    assert throttle.get_family("ec2", "RunInstances") == "ec2-mutating"
+    assert throttle.get_family("s3", "PutObject") == "s3"
+
+
+def test_with_backoff__gives_up_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(throttle, "sleep", lambda s: None)
+    calls = []
+
+    def throttled():
+        calls.append(1)
+        raise _client_error("SlowDown")
+
+    with pytest.raises(ClientError):
+        throttle.with_backoff(throttled, max_attempts=4)()
+
+    assert len(calls) == 4
+
+
+@mock_ec2
+def test_wrap_client__uses_shared_limiter(monkeypatch):
+    acquired = []
+    limiter = throttle.get_limiter("ec2")
+    monkeypatch.setattr(limiter, "acquire", lambda: acquired.append(1))
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    client = throttle.wrap_client(client, "ec2")
+    response = client.describe_instances()
+    assert response["Reservations"] == []
+    assert len(acquired) == 1
+    assert throttle.get_limiter("ec2") is limiter
+
+
+def test_wrap_client__throttled_response_lowers_rate(monkeypatch):
+    monkeypatch.setattr(throttle, "sleep", lambda s: None)
+    client = boto3.client(
+        "ec2",
+        region_name="ap-southeast-2",
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+        config=Config(retries={"total_max_attempts": 1}),
+    )
+    client = throttle.wrap_client(client, "ec2")
+
+    def throttled_response(request, **kwargs):
+        return AWSResponse(request.url, 503, {}, _RawBody(_THROTTLED_BODY))
+
+    client.meta.events.register("before-send", throttled_response)
+    limiter = throttle.get_limiter("ec2")
+    monkeypatch.setattr(limiter, "_sleep", lambda s: None)
+    with pytest.raises(ClientError):
+        client.describe_instances()
+
+    # Halved once for each of the MAX_ATTEMPTS attempts, down to the minimum.
+    assert limiter.rate == max(throttle.MIN_RATE, 20.0 / 2 ** throttle.MAX_ATTEMPTS)
+    assert throttle.get_limiter("ec2-mutating").rate == 5.0
+
+
+def test_register_limiter__async():
+    # aiobotocore awaits the coroutines returned by event handlers.
+    clock = FakeClock()
+    limiter = throttle.TokenBucket(rate=10, capacity=1, clock=clock, sleeper=clock.sleep)
+    throttle._limiters["ec2"] = limiter
+    client = boto3.client("ec2", region_name="ap-southeast-2")
+    throttle.register_limiter(client, "ec2", is_async=True)
+    responses = client.meta.events.emit("before-send.ec2.DescribeInstances", request=None)
+    coroutine = next(r for _, r in responses if r is not None)
+    asyncio.run(coroutine)
+    # The token came from the same bucket that blocking clients use.
+    assert limiter.tokens == 0
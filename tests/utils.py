@@ -1,16 +1,21 @@
 import os
 import boto3
+from botocore.config import Config
+
+from cjob.config import Settings
 
 
 def settings_factory(**kwargs):
     def get_settings():
-        return {
-            "AWS_REGION": "ap-southeast-2",
-            "AWS_PROFILE": "default",
-            "EC2_INSTANCE_TYPE": "r5.2xlarge",
-            "EC2_KEY_FILE_PATH": "~/.ssh/testkey.pem",
-            **kwargs,
-        }
+        return Settings(
+            **{
+                "AWS_REGION": "ap-southeast-2",
+                "AWS_PROFILE": "default",
+                "EC2_INSTANCE_TYPE": "r5.2xlarge",
+                "EC2_KEY_FILE_PATH": "~/.ssh/testkey.pem",
+                **kwargs,
+            }
+        )
 
     return get_settings
 
@@ -33,4 +38,22 @@ def create_test_instance(client, name, **kwargs):
         **kwargs,
     }
     resp = client.run_instances(**run_kwargs)
-    return resp["Instances"][0]["InstanceId"]
\ No newline at end of file
+    return resp["Instances"][0]["InstanceId"]
+
+
+def create_test_s3_client(bucket_name: str = "test-bucket"):
+    """
+    Create an S3 client and bucket for use with moto.
+    Newer botocore versions send request checksums that moto 2 can't read, so turn them off.
+    """
+    try:
+        config = Config(request_checksum_calculation="when_required")
+    except TypeError:
+        config = Config()
+
+    client = boto3.client("s3", region_name="ap-southeast-2", config=config)
+    client.create_bucket(
+        Bucket=bucket_name,
+        CreateBucketConfiguration={"LocationConstraint": "ap-southeast-2"},
+    )
+    return client